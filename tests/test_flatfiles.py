@@ -0,0 +1,101 @@
+'''Step 1 gives the same flat files whatever the way it is run: serial, with workers, streaming or not, and with a cold
+or warm extraction cache. Runs on small synthetic CIN Census files (see synthetic.py), with a fixed seed
+
+    python -m pytest tests
+'''
+import filecmp
+import os
+import shutil
+
+import pandas as pd
+import pytest
+
+from wrangling.cincensus.concat import concat
+from wrangling.cincensus.config import load_config
+from wrangling.cincensus.eventstore import EventStore
+from wrangling.cincensus.main import main
+from wrangling.cincensus.synthetic import la_name, write_cincensus
+
+
+LAS = 2
+
+
+@pytest.fixture(scope='module')
+def config():
+    return load_config()
+
+
+@pytest.fixture(scope='module')
+def cin_folder(tmp_path_factory, config):
+    folder = str(tmp_path_factory.mktemp('cincensus'))
+    write_cincensus(folder, las=LAS, files=2, children=150, seed=1, config=config)
+    return folder
+
+
+def run(cin_folder, output_folder, config, **kwargs):
+    os.makedirs(output_folder, exist_ok=True)
+    main(cin_folder, output_folder, config, process_missing_only=False, **kwargs)
+    return output_folder
+
+
+def assert_same_outputs(folder, reference):
+    '''
+    The LA flat files and quality reports of both folders are the same, byte for byte
+    '''
+    for la in [la_name(i) for i in range(LAS)]:
+        for name in ['{}_flatcin.csv'.format(la), '{}_quality.json'.format(la)]:
+            assert filecmp.cmp(os.path.join(folder, name), os.path.join(reference, name), shallow=False), name
+
+
+def store_events(path):
+    with EventStore(path) as store:
+        df = store.sql('SELECT * FROM events ORDER BY LA, LAchildID, Date, Type, rowid')
+    return df.reindex(columns=sorted(df.columns))
+
+
+@pytest.fixture(scope='module')
+def serial(cin_folder, config, tmp_path_factory):
+    return run(cin_folder, str(tmp_path_factory.mktemp('serial')), config)
+
+
+def test_synthetic_files_have_invalid_values(serial):
+    # The data quality paths run on the synthetic files too
+    flatfile = pd.read_csv(os.path.join(serial, '{}_flatcin.csv'.format(la_name(0))), dtype=str)
+    assert flatfile.apply(lambda col: col.str.startswith('Not in proper format', na=False)).any().any()
+
+
+def test_workers(cin_folder, config, serial, tmp_path):
+    assert_same_outputs(run(cin_folder, str(tmp_path), config, workers=2), serial)
+
+
+def test_not_streaming(cin_folder, config, serial, tmp_path):
+    assert_same_outputs(run(cin_folder, str(tmp_path), config, streaming=False), serial)
+
+
+def test_warm_cache(cin_folder, config, serial, tmp_path):
+    cache = str(tmp_path / 'cache')
+    run(cin_folder, str(tmp_path / 'cold'), config, cache_folder=cache)
+    assert_same_outputs(str(tmp_path / 'cold'), serial)
+    # Rows from the cache, in a new folder
+    assert_same_outputs(run(cin_folder, str(tmp_path / 'warm'), config, cache_folder=cache), serial)
+    # LAs up to date in the same folder, with a new event store: the store still gets all the LAs
+    run(cin_folder, str(tmp_path / 'warm'), config, cache_folder=cache, event_store=str(tmp_path / 'warm.db'))
+    run(cin_folder, str(tmp_path / 'store'), config, event_store=str(tmp_path / 'cold.db'))
+    pd.testing.assert_frame_equal(store_events(str(tmp_path / 'warm.db')), store_events(str(tmp_path / 'cold.db')))
+
+
+def test_warm_cache_other_tiebreak(cin_folder, config, tmp_path):
+    cache = str(tmp_path / 'cache')
+    latest = run(cin_folder, str(tmp_path / 'latest'), config, tiebreak='latest')
+    run(cin_folder, str(tmp_path / 'warm'), config, cache_folder=cache)
+    # Same files and cache, but another tiebreak: the LAs are not up to date
+    assert_same_outputs(run(cin_folder, str(tmp_path / 'warm'), config, cache_folder=cache, tiebreak='latest'), latest)
+
+
+def test_concat_modes(serial, tmp_path):
+    for mode in ['default', 'streaming']:
+        shutil.copytree(serial, str(tmp_path / mode))
+    concat(str(tmp_path / 'default'))
+    concat(str(tmp_path / 'streaming'), streaming=True)
+    assert filecmp.cmp(str(tmp_path / 'default' / 'main_flatcin.csv'), str(tmp_path / 'streaming' / 'main_flatcin.csv'),
+                       shallow=False)
@@ -0,0 +1,238 @@
+'''Command line entry point, to run the steps without the notebooks
+
+    python -m wrangling.cincensus flatfile <input_folder> <output_folder> [--workers N]
+    python -m wrangling.cincensus concat <flatfile_folder>
+    python -m wrangling.cincensus flatfile <input_folder> <output_folder> --shard 1/3, then merge <flatfile_folder>
+    python -m wrangling.cincensus star <flatfile_folder>
+    python -m wrangling.cincensus pipeline <main_folder> --census-close 2020-03-31
+    python -m wrangling.cincensus watch <cin_folder> <flatfile_folder> --cache-folder <cache_folder>
+    python -m wrangling.cincensus events <event_store> --child HACC0000001
+    python -m wrangling.cincensus synthetic <cin_folder> --las 3
+    python -m wrangling.cincensus benchmark --scales small medium
+'''
+import argparse
+import logging
+import sys
+
+import pandas as pd
+
+from wrangling.cincensus.config import DEFAULT_CONFIG, load_config
+from wrangling.cincensus.main import main
+from wrangling.cincensus.metrics import JsonLinesSink, LoggingSink, Metrics, PrintSink
+from wrangling.cincensus.concat import concat
+from wrangling.cincensus.eventstore import EventStore
+from wrangling.cincensus.pipeline import cin_pipeline
+from wrangling.cincensus.shards import merge_shards
+from wrangling.cincensus.star import write_star
+from wrangling.cincensus.watch import IngestService
+from wrangling.cincensus.synthetic import write_cincensus
+from wrangling.cincensus.benchmark import SCALES, compare_benchmark, run_benchmark
+
+
+def add_metrics_arguments(parser, profile=False):
+    parser.add_argument('--metrics-file', help='Also append the metrics of each stage (time, rows, memory) to this file, as JSON lines')
+    parser.add_argument('--log', action='store_true', help='Send the metrics to the logging module instead of printing them')
+    if profile:
+        parser.add_argument('--profile-la', help='Profile the extraction of this LA')
+        parser.add_argument('--profile', default='cprofile', choices=['cprofile', 'tracemalloc'],
+                            help='Profile time (cprofile) or Python memory allocations (tracemalloc) (default: cprofile)')
+        parser.add_argument('--profile-folder', help='Folder for the profile (default: current folder)')
+
+
+def metrics_from_args(args):
+    sinks = [LoggingSink() if args.log else PrintSink()]
+    if args.metrics_file:
+        sinks.append(JsonLinesSink(args.metrics_file))
+    return Metrics(sinks, profile_la=getattr(args, 'profile_la', None), profile=getattr(args, 'profile', 'cprofile'),
+                   profile_folder=getattr(args, 'profile_folder', None))
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m wrangling.cincensus', description='LIIA CIN Census ingest')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    # Step 1
+    flatfile = subparsers.add_parser('flatfile', help='Step 1: create one flat file per LA')
+    flatfile.add_argument('input_folder', help='Folder with one folder of CIN Census XML files per LA')
+    flatfile.add_argument('output_folder', help='Folder for the LA flat files')
+    flatfile.add_argument('--config', default=DEFAULT_CONFIG, help='Path to cin_datamap.yaml')
+    flatfile.add_argument('--all', action='store_true', help='Process all LAs, even those with a flat file already')
+    flatfile.add_argument('--no-streaming', action='store_true', help='Load each full XML file in memory instead of streaming it')
+    flatfile.add_argument('--workers', type=int, default=1, help='Number of worker processes (default: 1)')
+    flatfile.add_argument('--cache-folder', help='Folder to cache the rows extracted from each file, to only re-extract new or changed files')
+    flatfile.add_argument('--format', default='csv', choices=['csv', 'parquet'], help='Format of the LA flat files (default: csv)')
+    flatfile.add_argument('--tiebreak', default='first', choices=['first', 'latest'],
+                          help='Duplicate events as complete as each other: keep the first seen or the one from the latest census return (default: first)')
+    flatfile.add_argument('--event-store', help='Also write the events of each LA to this SQLite database, for indexed queries')
+    flatfile.add_argument('--shard', help='Only process shard i of n of the LAs, e.g. 2/4 on the second of 4 machines, and write its manifest for merge')
+    add_metrics_arguments(flatfile, profile=True)
+
+    # Step 2
+    concat_parser = subparsers.add_parser('concat', help='Step 2: concatenate the LA flat files')
+    concat_parser.add_argument('flatfile_folder', help='Folder with the LA flat files')
+    concat_parser.add_argument('--format', default='csv', choices=['csv', 'parquet'], help='Format of main_flatcin (default: csv)')
+    concat_parser.add_argument('--streaming', action='store_true', help='Copy the LA flat files chunk by chunk, to keep memory low')
+    concat_parser.add_argument('--chunksize', type=int, default=100000, help='Rows per chunk when streaming (default: 100000)')
+    concat_parser.add_argument('--event-store', help='Also write the events of each LA to this SQLite database, for indexed queries')
+    concat_parser.add_argument('--partitioned', action='store_true',
+                               help='Save main_flatcin as a folder of one file per LA, only writing again the LAs whose flat file changed')
+    concat_parser.add_argument('--arrow', action='store_true',
+                               help='Also save main_flatcin as an Arrow file (main_flatcin.arrow), memory-mapped by the readers')
+    add_metrics_arguments(concat_parser)
+
+    merge = subparsers.add_parser('merge', help='Step 2 after flatfile --shard: check that all the shards are there and consistent, then concat')
+    merge.add_argument('flatfile_folder', help='Folder with the LA flat files and shard manifests of all the shards')
+    merge.add_argument('--cin-folder', help='Folder of CIN Census files the shards ran on, to check that no LA or file changed since')
+    merge.add_argument('--config', default=DEFAULT_CONFIG, help='Path to cin_datamap.yaml, which the shards must have run with')
+    merge.add_argument('--format', default='csv', choices=['csv', 'parquet'], help='Format of main_flatcin (default: csv)')
+    merge.add_argument('--streaming', action='store_true', help='See concat --streaming')
+    merge.add_argument('--chunksize', type=int, default=100000, help='Rows per chunk when streaming (default: 100000)')
+    merge.add_argument('--event-store', help='Also write the events of each LA to this SQLite database, for indexed queries')
+    merge.add_argument('--partitioned', action='store_true', help='See concat --partitioned')
+    merge.add_argument('--arrow', action='store_true', help='See concat --arrow')
+    add_metrics_arguments(merge)
+
+    star = subparsers.add_parser('star', help='Step 2, as a star schema: children, LAs and a narrow table of events')
+    star.add_argument('flatfile_folder', help='Folder with the LA flat files')
+    star.add_argument('--config', default=DEFAULT_CONFIG, help='Path to cin_datamap.yaml')
+    star.add_argument('--format', default='csv', choices=['csv', 'parquet'], help='Format of the tables (default: csv)')
+    add_metrics_arguments(star)
+
+    # Steps 1 to 3
+    pipeline = subparsers.add_parser('pipeline', help='Steps 1 to 3, only running the steps whose inputs changed since the last run')
+    pipeline.add_argument('main_folder', help='Folder with the cincensus folder; flatfiles and outputs are written next to it')
+    pipeline.add_argument('--census-close', required=True, help='End of the CIN Census, e.g. 2020-03-31')
+    pipeline.add_argument('--config', default=DEFAULT_CONFIG, help='Path to cin_datamap.yaml')
+    pipeline.add_argument('--workers', type=int, default=1, help='Number of worker processes, for step 1 and to run the step 3 tables concurrently (default: 1)')
+    pipeline.add_argument('--cache-folder', help='Folder of the extraction cache (default: <main_folder>/cache)')
+    pipeline.add_argument('--format', default='csv', choices=['csv', 'parquet'], help='Format of the flat files (default: csv)')
+    pipeline.add_argument('--tiebreak', default='first', choices=['first', 'latest'], help='See flatfile --tiebreak (default: first)')
+    pipeline.add_argument('--match', default='first', choices=['first', 'all'],
+                          help='Link each referral / S47 to the first assessment / CPP that followed, or to all of them (default: first)')
+    pipeline.add_argument('--sankey-rows', action='store_true',
+                          help='Save the S47 Sankey input with one row per journey step, instead of counts per Source, Destination and demographics')
+    pipeline.add_argument('--force', action='store_true', help='Run all the steps, even those which are up to date')
+    pipeline.add_argument('--event-store', help='Also write the events to this SQLite database, for indexed queries')
+    pipeline.add_argument('--partitioned', action='store_true', help='Save main_flatcin partitioned by LA (see concat --partitioned)')
+    pipeline.add_argument('--arrow', action='store_true', help='Also save main_flatcin as an Arrow file (see concat --arrow), and build the step 3 tables from it')
+    pipeline.add_argument('--star', action='store_true', help='Also save the events as a star schema (see star), and build the step 3 tables from it')
+    pipeline.add_argument('--partition-workers', type=int, default=1,
+                          help='With --partitioned, worker processes for each step 3 table, one partition each (default: 1, one partition at a time)')
+    add_metrics_arguments(pipeline)
+
+    # Steps 1 and 2 as a service
+    watch = subparsers.add_parser('watch', help='Steps 1 and 2 as a service: process new or changed files as they land in the LA folders')
+    watch.add_argument('input_folder', help='Folder with one folder of CIN Census XML files per LA')
+    watch.add_argument('output_folder', help='Folder for the LA flat files and main_flatcin')
+    watch.add_argument('--config', default=DEFAULT_CONFIG, help='Path to cin_datamap.yaml')
+    watch.add_argument('--cache-folder', help='Folder to cache the rows extracted from each file, to only re-extract the new or changed files of an LA')
+    watch.add_argument('--format', default='csv', choices=['csv', 'parquet'], help='Format of the flat files (default: csv)')
+    watch.add_argument('--tiebreak', default='first', choices=['first', 'latest'], help='See flatfile --tiebreak (default: first)')
+    watch.add_argument('--workers', type=int, default=1, help='Number of LAs processed at once, in worker processes (default: 1)')
+    watch.add_argument('--partitioned', action='store_true', help='Save main_flatcin partitioned by LA (see concat --partitioned)')
+    watch.add_argument('--event-store', help='Also write the events to this SQLite database, for indexed queries')
+    watch.add_argument('--poll-interval', type=float, default=30, help='Seconds between scans of the LA folders (default: 30)')
+    watch.add_argument('--settle', type=float, default=60, help='Seconds a file must be left unchanged before it is processed (default: 60)')
+    watch.add_argument('--once', action='store_true', help='Scan once, process what changed and exit, e.g. from a scheduled task')
+    add_metrics_arguments(watch)
+
+    # Queries
+    events = subparsers.add_parser('events', help='Query the event store: events of some children, LAs, types or dates')
+    events.add_argument('event_store', help='SQLite database written with --event-store')
+    events.add_argument('--child', nargs='+', help='LAchildIDs, as in main_flatcin')
+    events.add_argument('--la', nargs='+', help='LAs')
+    events.add_argument('--type', nargs='+', help='Event types, e.g. CPPstartDate')
+    events.add_argument('--start', help='First date, e.g. 2019-10-01')
+    events.add_argument('--end', help='Last date, e.g. 2019-12-31')
+    events.add_argument('--columns', nargs='+', help='Columns to show (default: all)')
+    events.add_argument('--output', help='Save the events as csv instead of printing them')
+
+    # Test data and benchmark
+    synthetic = subparsers.add_parser('synthetic', help='Write synthetic CIN Census files, one folder per LA')
+    synthetic.add_argument('cin_folder', help='Folder for the LA folders')
+    synthetic.add_argument('--las', type=int, default=3, help='Number of LAs (default: 3)')
+    synthetic.add_argument('--files', type=int, default=3, help='Number of files (years) per LA (default: 3)')
+    synthetic.add_argument('--children', type=int, default=1000, help='Number of children per file (default: 1000)')
+    synthetic.add_argument('--events', type=int, default=3, help='Average number of assessments, S47 and CPP per referral (default: 3)')
+    synthetic.add_argument('--messy', type=float, default=0.05, help='Share of messy or empty values (default: 0.05)')
+    synthetic.add_argument('--invalid', type=float, default=0.005,
+                           help='Share of invalid dates, codes and numbers, which cannot be cleaned (default: 0.005)')
+    synthetic.add_argument('--seed', type=int, default=1, help='Random seed (default: 1)')
+
+    benchmark = subparsers.add_parser('benchmark', help='Time and memory of each step on synthetic files')
+    benchmark.add_argument('--scales', nargs='+', default=['small', 'medium'], choices=list(SCALES), help='Scales to run (default: small medium)')
+    benchmark.add_argument('--folder', help='Folder to keep the synthetic files in, and reuse them (default: temporary folder)')
+    benchmark.add_argument('--seed', type=int, default=1, help='Random seed of the synthetic files (default: 1)')
+    benchmark.add_argument('--format', default='csv', choices=['csv', 'parquet'], help='Format of the flat files (default: csv)')
+    benchmark.add_argument('--workers', type=int, default=1, help='Number of worker processes for step 1 (default: 1)')
+    benchmark.add_argument('--no-memory', action='store_true', help='Only time the stages, without the second run measuring memory')
+    benchmark.add_argument('--output', help='Save the results as csv')
+    benchmark.add_argument('--baseline', help='Results of a previous run (csv) to compare with: exits with an error on regressions')
+    benchmark.add_argument('--tolerance', type=float, default=1.25, help='Slowdown or memory increase ratio counted as a regression (default: 1.25)')
+
+    args = parser.parse_args(argv)
+    if args.command in ('flatfile', 'concat', 'merge', 'star', 'pipeline', 'watch') and args.log:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    if args.command == 'flatfile':
+        main(args.input_folder, args.output_folder, load_config(args.config),
+             process_missing_only=not args.all, streaming=not args.no_streaming, workers=args.workers,
+             cache_folder=args.cache_folder, output_format=args.format, tiebreak=args.tiebreak, metrics=metrics_from_args(args),
+             event_store=args.event_store, shard=args.shard)
+    elif args.command == 'concat':
+        concat(args.flatfile_folder, output_format=args.format, streaming=args.streaming, chunksize=args.chunksize,
+               metrics=metrics_from_args(args), event_store=args.event_store, partitioned=args.partitioned,
+               arrow=args.arrow)
+    elif args.command == 'merge':
+        try:
+            merge_shards(args.flatfile_folder, cin_folder=args.cin_folder, config=load_config(args.config),
+                         output_format=args.format, streaming=args.streaming, chunksize=args.chunksize,
+                         metrics=metrics_from_args(args), event_store=args.event_store, partitioned=args.partitioned,
+                         arrow=args.arrow)
+        except ValueError as error:
+            print("Cannot merge the shards of {}:".format(args.flatfile_folder))
+            print(error)
+            sys.exit(1)
+    elif args.command == 'star':
+        write_star(args.flatfile_folder, output_format=args.format, config=load_config(args.config), metrics=metrics_from_args(args))
+    elif args.command == 'pipeline':
+        pipeline = cin_pipeline(args.main_folder, args.census_close, config_file=args.config, flatfile_format=args.format,
+                                workers=args.workers, cache_folder=args.cache_folder, tiebreak=args.tiebreak, match_how=args.match,
+                                sankey_counts=not args.sankey_rows, metrics=metrics_from_args(args), event_store=args.event_store,
+                                partitioned=args.partitioned, partition_workers=args.partition_workers,
+                                arrow=args.arrow, star=args.star)
+        pipeline.run(workers=args.workers, force=args.force)
+    elif args.command == 'watch':
+        service = IngestService(args.input_folder, args.output_folder, load_config(args.config), cache_folder=args.cache_folder,
+                                output_format=args.format, tiebreak=args.tiebreak, partitioned=args.partitioned,
+                                event_store=args.event_store, workers=args.workers, poll_interval=args.poll_interval,
+                                settle=args.settle, metrics=metrics_from_args(args))
+        service.run(polls=1 if args.once else None)
+    elif args.command == 'events':
+        with EventStore(args.event_store) as store:
+            df = store.query(child=args.child, la=args.la, types=args.type, start=args.start, end=args.end, columns=args.columns)
+        if args.output:
+            df.to_csv(args.output, index=False)
+        else:
+            print(df.to_string(index=False))
+    elif args.command == 'synthetic':
+        paths = write_cincensus(args.cin_folder, las=args.las, files=args.files, children=args.children,
+                                events=args.events, messy=args.messy, invalid=args.invalid, seed=args.seed)
+        print("Wrote {} files in {}".format(len(paths), args.cin_folder))
+    elif args.command == 'benchmark':
+        results = run_benchmark(args.scales, folder=args.folder, seed=args.seed, output_format=args.format,
+                                workers=args.workers, memory=not args.no_memory)
+        print(results.to_string(index=False))
+        if args.output:
+            results.to_csv(args.output, index=False)
+        if args.baseline:
+            regressions = compare_benchmark(results, pd.read_csv(args.baseline), args.tolerance)
+            if len(regressions) > 0:
+                print("Regressions compared to {}:".format(args.baseline))
+                print(regressions.to_string(index=False))
+                sys.exit(1)
+            print("No regressions compared to {}".format(args.baseline))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,140 @@
+'''Benchmark of each step on synthetic CIN Census files (see synthetic.py), at several scales
+
+    python -m wrangling.cincensus benchmark --scales small medium --output benchmark.csv
+    python -m wrangling.cincensus benchmark --scales small medium --baseline benchmark.csv
+
+Peak memory is the peak resident memory of the process during each stage, above what it was before the stage,
+sampled every few milliseconds. Where the resident memory cannot be read (it is read from /proc, on Linux), each stage is
+run a second time with tracemalloc instead, which only sees the memory allocated by Python (not lxml's)
+Results can be saved and compared to a previous run to catch performance regressions
+'''
+import contextlib
+import glob
+import io
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+from wrangling.cincensus.concat import concat
+from wrangling.cincensus.config import load_config
+from wrangling.cincensus.factors import assessment_factors
+from wrangling.cincensus.journeys import referral_journeys, s47_journeys
+from wrangling.cincensus.main import build_cinrecord, cleanfile, degradefile, main
+from wrangling.cincensus.metrics import MemorySampler, resident_memory
+from wrangling.cincensus.storage import flatfile_path
+from wrangling.cincensus.synthetic import write_cincensus
+
+
+# Scales: arguments of write_cincensus. pan-london is the size of a full London dataset (33 LAs, 5 years)
+SCALES = {
+    'small': dict(las=2, files=2, children=500),
+    'medium': dict(las=4, files=3, children=2000),
+    'large': dict(las=8, files=5, children=5000),
+    'pan-london': dict(las=33, files=5, children=6000),
+}
+
+
+def run_benchmark(scales=('small', 'medium'), folder=None, seed=1, events=3, output_format='csv', workers=1,
+                  memory=True, cin_census_close='2020-03-31'):
+    '''
+    Benchmarks each stage at each scale and returns a table with, for each scale and stage:
+    seconds, peak_mb (peak memory allocated during the stage in this process, if memory) and rows (rows of the table built)
+    - degradefile, cleanfile and build_cinrecord run on all the files of the first LA (the files are loaded in memory)
+    - main (with workers), concat and the step 3 builders run on all LAs
+    The synthetic files are written to folder (default: a temporary folder, deleted afterwards)
+    '''
+    config = load_config()
+    results = []
+    for scale in scales:
+        scale_folder = tempfile.mkdtemp() if folder is None else os.path.join(folder, scale)
+        try:
+            cin_folder = os.path.join(scale_folder, 'cincensus')
+            if not os.path.exists(cin_folder):
+                write_cincensus(cin_folder, events=events, seed=seed, config=config, **SCALES[scale])
+            xml_mb = sum(os.path.getsize(file) for file in glob.glob(os.path.join(cin_folder, '*', '*.xml'))) / 2 ** 20
+            # Memory: sampled during the timed run if possible, otherwise in a second run with tracemalloc
+            sampled = memory and resident_memory() is not None
+            passes = [False, True] if memory and not sampled else [False]
+            for traced in passes:
+                for stage, seconds, peak_mb, rows in run_stages(cin_folder, scale_folder, config, output_format, workers,
+                                                                 pd.Timestamp(cin_census_close), sampled, traced):
+                    peak_mb = round(peak_mb, 1) if peak_mb is not None else None
+                    if not traced:
+                        results.append({'scale': scale, 'xml_mb': round(xml_mb, 1), 'stage': stage,
+                                        'seconds': round(seconds, 3), 'peak_mb': peak_mb, 'rows': rows})
+                    else:
+                        for result in results:
+                            if result['scale'] == scale and result['stage'] == stage:
+                                result['peak_mb'] = peak_mb
+        finally:
+            if folder is None:
+                shutil.rmtree(scale_folder, ignore_errors=True)
+    return pd.DataFrame(results, columns=['scale', 'xml_mb', 'stage', 'seconds', 'peak_mb', 'rows'])
+
+
+def run_stages(cin_folder, scale_folder, config, output_format, workers, cin_census_close, sampled, traced):
+    '''
+    Runs each stage in turn, yielding (stage, seconds, peak_mb, rows)
+    '''
+    flatfile_folder = os.path.join(scale_folder, 'flatfiles')
+    os.makedirs(flatfile_folder, exist_ok=True)
+    la_files = sorted(glob.glob(os.path.join(sorted(glob.glob(os.path.join(cin_folder, '*')))[0], '*.xml')))
+    main_flatcin = flatfile_path(flatfile_folder, 'main_flatcin', output_format)
+
+    stages = [
+        ('degradefile', lambda _: [degradefile(file) for file in la_files]),
+        ('cleanfile', lambda trees: [cleanfile(tree, config) for tree in trees]),
+        ('build_cinrecord', lambda trees: build_cinrecord(trees)),
+        ('main', lambda _: main(cin_folder, flatfile_folder, config, process_missing_only=False, workers=workers,
+                                output_format=output_format)),
+        ('concat', lambda _: concat(flatfile_folder, output_format=output_format)),
+        ('assessment_factors', lambda _: assessment_factors(main_flatcin)),
+        ('referral_journeys', lambda _: referral_journeys(main_flatcin)),
+        ('s47_journeys', lambda _: s47_journeys(main_flatcin, cin_census_close)),
+    ]
+    previous = None
+    for stage, func in stages:
+        seconds, peak_mb, result = measure(func, previous, sampled, traced)
+        rows = len(result) if isinstance(result, pd.DataFrame) else None
+        yield stage, seconds, peak_mb, rows
+        # degradefile and cleanfile pass their trees on to the next stage
+        previous = result if stage in ('degradefile', 'cleanfile') else None
+
+
+def measure(func, argument, sampled=False, traced=False):
+    '''
+    Runs func(argument) without printing, returns seconds, peak memory in MB (if sampled or traced) and the result
+    '''
+    peak_mb = None
+    with contextlib.redirect_stdout(io.StringIO()):
+        sampler = MemorySampler() if sampled else None
+        if traced:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            result = func(argument)
+        finally:
+            seconds = time.perf_counter() - start
+            if sampler is not None:
+                peak_mb = sampler.stop() / 2 ** 20
+            if traced:
+                peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+                tracemalloc.stop()
+    return seconds, peak_mb, result
+
+
+def compare_benchmark(results, baseline, tolerance=1.25):
+    '''
+    Compares results with a baseline run (same scales): returns the stages at least tolerance times slower
+    or using tolerance times more memory, with the ratios
+    '''
+    merged = results.merge(baseline, on=['scale', 'stage'], suffixes=('', '_baseline'))
+    merged['time_ratio'] = merged['seconds'] / merged['seconds_baseline']
+    merged['memory_ratio'] = merged['peak_mb'] / merged['peak_mb_baseline']
+    regressions = (merged['time_ratio'] >= tolerance) | (merged['memory_ratio'] >= tolerance)
+    return merged.loc[regressions, ['scale', 'stage', 'seconds_baseline', 'seconds', 'time_ratio',
+                                    'peak_mb_baseline', 'peak_mb', 'memory_ratio']]
@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import pickle
+
+from wrangling.cincensus.inputs import open_input
+
+
+# Modules whose code produces the cached rows and quality counts
+CODE_MODULES = ['main.py', 'factors.py', 'quality.py']
+
+
+def file_hash(file, opener=None):
+    '''
+    Returns the sha256 of the content of a file, opened with opener (default: as is, in binary mode)
+    '''
+    sha = hashlib.sha256()
+    with (opener(file) if opener is not None else open(file, 'rb')) as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def config_hash(config):
+    '''
+    Returns a hash of the config (cin_datamap.yaml) and of the code version
+    The code version is the source of the modules building the flat files (degrade, clean, extract, factors):
+    any change to them invalidates the cache
+    '''
+    sha = hashlib.sha256()
+    sha.update(json.dumps(config, sort_keys=True, default=str).encode('utf-8'))
+    for module in CODE_MODULES:
+        with open(os.path.join(os.path.dirname(__file__), module), 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+class ExtractionCache:
+    '''
+    Cache of the rows extracted from each CIN Census file (after degrade, clean and extract, before the LA dedup),
+    with the data quality counts of the file (quality.QualityCounter), so that cached files still get a quality report,
+    and the ReferenceDate of its census return, so that tiebreak='latest' does not open cached files either
+    - Each file is stored under a key made of the file's content hash and the config hash,
+      so changed files, and all files after a change of config or code, are extracted again
+    - Each LA also has a manifest of the keys its flat file was last built from, and of the settings which change the
+      flat file (options, e.g. tiebreak and output format), so LAs where nothing changed are not rebuilt at all
+    '''
+
+    def __init__(self, cache_folder, config):
+        self.cache_folder = cache_folder
+        self.config_hash = config_hash(config)
+        os.makedirs(os.path.join(cache_folder, 'files'), exist_ok=True)
+        os.makedirs(os.path.join(cache_folder, 'manifests'), exist_ok=True)
+
+    def key(self, file, opener=open_input):
+        '''
+        Key of a CIN Census file: hash of its decompressed content (see inputs.open_input) and of the config
+        '''
+        return hashlib.sha256('{}-{}'.format(file_hash(file, opener), self.config_hash).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_folder, 'files', '{}.pkl'.format(key))
+
+    def manifest_path(self, la):
+        return os.path.join(self.cache_folder, 'manifests', '{}.json'.format(la))
+
+    # Per file rows
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, key):
+        with open(self.path(key), 'rb') as f:
+            return pickle.load(f)
+
+    def put(self, key, entry):
+        write_atomic(self.path(key), pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL))
+
+    # Per LA manifests
+
+    def is_current(self, la, keys, options=None):
+        '''
+        True if the LA's flat file was last built from exactly these files, with the same config and options
+        '''
+        try:
+            with open(self.manifest_path(la)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return manifest == {'config_hash': self.config_hash, 'keys': keys, 'options': options or {}}
+
+    def set_current(self, la, keys, options=None):
+        manifest = {'config_hash': self.config_hash, 'keys': keys, 'options': options or {}}
+        write_atomic(self.manifest_path(la), json.dumps(manifest, indent=1).encode('utf-8'))
+
+
+def write_atomic(path, data):
+    '''
+    Writes to a temporary file first so that an interrupted run never leaves half a file behind
+    '''
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
@@ -1,24 +1,250 @@
 import os
 import glob
+import hashlib
+import json
 import pandas as pd
 
-def concat(flatfile_folder):
+from wrangling.cincensus.cache import file_hash, write_atomic
+from wrangling.cincensus.eventstore import open_store
+from wrangling.cincensus.metrics import default_metrics
+from wrangling.cincensus.storage import (FORMATS, FlatfileWriter, arrow_schema, flatfile_path, iter_flatfile, partition_files,
+                                         read_columns, read_flatfile, to_arrow, write_arrow, write_flatfile)
+
+
+# Modules whose code produces the partitions of main_flatcin: a change to them writes all the partitions again
+PARTITION_MODULES = ['concat.py', 'storage.py', 'schema.py']
+
+def concat(flatfile_folder, output_format='csv', streaming=False, chunksize=100000, metrics=None, event_store=None,
+           partitioned=False, arrow=False):
+    '''Concatenates the LA flatfiles (csv or parquet) into main_flatcin, saved as csv or parquet (output_format)
+    - Option to stream the LA flatfiles chunk by chunk into main_flatcin, so memory stays at one chunk
+      whatever the number of LAs. In this mode csv values are copied as they are, as text
+    - Progress is reported as metrics events (time, rows, memory) per LA flatfile: see metrics.Metrics
+    - Option to also write the events of each LA to an event store (path of the SQLite database, or eventstore.EventStore)
+    - Option to save main_flatcin partitioned, as a folder of one file per LA, where only the LAs whose flatfile changed
+      are written again: see concat_partitions
+    - Option to also save main_flatcin as an Arrow IPC file, main_flatcin.arrow, which readers memory-map: see concat_arrow'''
+    metrics = default_metrics(metrics)
+    store = open_store(event_store)
+    try:
+        if partitioned:
+            concat_partitions(flatfile_folder, output_format, chunksize, metrics, store)
+        else:
+            concat_flatfiles(flatfile_folder, output_format, streaming, chunksize, metrics, store)
+        if arrow:
+            concat_arrow(flatfile_folder, metrics)
+    finally:
+        if store is not None and store is not event_store:
+            store.close()
+
+
+def concat_flatfiles(flatfile_folder, output_format, streaming, chunksize, metrics, store):
     df_list = []
-    
+
     # Identify relevant flatfiles
-    all_flatfiles = glob.glob(os.path.join(flatfile_folder, "*.csv"))
-    target_flatfiles = [f for f in all_flatfiles if f not in os.path.join(flatfile_folder, 'main_flatcin.csv')]
-    
+    target_flatfiles = find_flatfiles(flatfile_folder)
+
     # Run through each file to concatenate
     print("Processing {} flatfiles".format(len(target_flatfiles)))
-    for file in target_flatfiles:
-        prefix = file.split('\\')[-1][:3].upper() # Get first 3 letters of borough name
-        df = pd.read_csv(file)
-        df['LAchildID'] = prefix + df['LAchildID'].astype(str) # Add prefix to Child ID to differentiate across LAs
-        df_list.append(df)
-    data = pd.concat(df_list)
-    # Save
-    data.to_csv(os.path.join(flatfile_folder, "main_flatcin.csv"), index=False)
+    if streaming:
+        with metrics.stage('concat', files=len(target_flatfiles)) as event:
+            event['rows'] = concat_streaming(target_flatfiles, flatfile_folder, output_format, chunksize, metrics, store)
+        print("Done!")
+        return
+
+    with metrics.stage('concat', files=len(target_flatfiles)) as concat_event:
+        for file in target_flatfiles:
+            with metrics.stage('read', file=os.path.basename(file)) as event:
+                prefix = la_prefix(file)
+                # Copied as text, as in streaming mode: values not in the proper format are kept as they are
+                df = read_flatfile(file, typed=False)
+                df['LAchildID'] = prefix + df['LAchildID'].astype(str) # Add prefix to Child ID to differentiate across LAs
+                event['rows'] = len(df)
+            if store is not None:
+                with metrics.stage('event_store', file=os.path.basename(file), rows=len(df)):
+                    store.write_la(flatfile_la(file), df)
+            df_list.append(df)
+        data = pd.concat(df_list)
+        # Save
+        with metrics.stage('write', file="main_flatcin", rows=len(data), format=output_format):
+            write_flatfile(data, flatfile_folder, "main_flatcin", output_format)
+        concat_event['rows'] = len(data)
     print("Done!")
-    
-    return 
\ No newline at end of file
+
+    return
+
+
+def concat_streaming(target_flatfiles, flatfile_folder, output_format='csv', chunksize=100000, metrics=None, store=None):
+    '''
+    Concatenates the flatfiles chunk by chunk, returns the number of rows
+    With an event store, the chunks of each LA are also written to it
+    The columns of main_flatcin are the union of the columns of the flatfiles, in order of appearance (as pd.concat),
+    read beforehand from the headers only
+    '''
+    metrics = default_metrics(metrics)
+    columns = {}
+    for file in target_flatfiles:
+        columns.update(dict.fromkeys(read_columns(file)))
+
+    total = 0
+    with FlatfileWriter(flatfile_folder, "main_flatcin", columns, output_format) as writer:
+        for file in target_flatfiles:
+            with metrics.stage('copy', file=os.path.basename(file)) as event:
+                prefix = la_prefix(file)
+                chunks = prefixed_chunks(file, prefix, chunksize, writer)
+                if store is not None:
+                    rows = store.write_la(flatfile_la(file), chunks)
+                else:
+                    rows = sum(len(chunk) for chunk in chunks)
+                event['rows'] = rows
+            total += rows
+    return total
+
+
+def concat_partitions(flatfile_folder, output_format='csv', chunksize=100000, metrics=None, store=None):
+    '''
+    Updates the partitioned main_flatcin: a folder with one partition per LA (e.g. main_flatcin/Hackney.csv),
+    copied chunk by chunk from the LA flatfile, with prefixed child IDs
+    A manifest keeps the fingerprint of the flatfile (and format and code) each partition was made from,
+    so only the partitions of new or changed LA flatfiles are written, and those of removed LA flatfiles deleted
+    read_flatfile reads the folder as one table. Returns the LAs written
+    '''
+    metrics = default_metrics(metrics)
+    dataset = flatfile_path(flatfile_folder, "main_flatcin", output_format, partitioned=True)
+    os.makedirs(dataset, exist_ok=True)
+    manifest = load_manifest(dataset)
+    target_flatfiles = {flatfile_la(file): file for file in find_flatfiles(flatfile_folder)}
+    stored = set(store.las()['LA']) if store is not None else set()
+    code = code_hash()
+
+    print("Processing {} flatfiles".format(len(target_flatfiles)))
+    written = []
+    with metrics.stage('concat', files=len(target_flatfiles)) as concat_event:
+        for la, file in target_flatfiles.items():
+            fingerprint = partition_fingerprint(file, output_format, code)
+            partition = flatfile_path(dataset, la, output_format)
+            if manifest['partitions'].get(la) == fingerprint and os.path.exists(partition):
+                if store is not None and la not in stored:
+                    store.write_la(la, iter_flatfile(partition, chunksize))
+                continue
+            with metrics.stage('partition', la=la, file=os.path.basename(file)) as event:
+                event['rows'] = write_partition(file, dataset, la, output_format, chunksize, store)
+            manifest['partitions'][la] = fingerprint
+            save_manifest(dataset, manifest)
+            written.append(la)
+
+        # Remove the partitions of LAs without a flatfile any more, or in another format
+        for partition in partition_files(dataset):
+            la, extension = os.path.splitext(os.path.basename(partition))
+            if la not in target_flatfiles or extension != FORMATS[output_format]:
+                os.remove(partition)
+        manifest['partitions'] = {la: fingerprint for la, fingerprint in manifest['partitions'].items()
+                                  if la in target_flatfiles}
+        save_manifest(dataset, manifest)
+        concat_event['partitions_written'] = len(written)
+    print("{} partitions written: {}".format(len(written), written))
+    return written
+
+
+def concat_arrow(flatfile_folder, metrics=None):
+    '''
+    Saves the LA flatfiles as one Arrow IPC file, main_flatcin.arrow, with prefixed child IDs: the same table as main_flatcin,
+    with the types of the flat file schema (see schema.py). The step 3 tables can be built from it like from main_flatcin:
+    read_flatfile memory-maps it, so loading takes a fraction of a second, only the columns used are read, and processes
+    reading it at the same time share one copy in memory (see storage.read_arrow)
+    The LA flatfiles are converted one at a time to compact arrow tables, then written at once. Returns the path
+    '''
+    metrics = default_metrics(metrics)
+    target_flatfiles = find_flatfiles(flatfile_folder)
+    # Columns in order of appearance, as main_flatcin
+    columns = {}
+    for file in target_flatfiles:
+        columns.update(dict.fromkeys(read_columns(file)))
+    schema = arrow_schema(columns)
+
+    tables = []
+    with metrics.stage('arrow', files=len(target_flatfiles)) as arrow_event:
+        for file in target_flatfiles:
+            with metrics.stage('read', file=os.path.basename(file)) as event:
+                df = read_flatfile(file)
+                df['LAchildID'] = la_prefix(file) + df['LAchildID'].astype(str) # Add prefix to Child ID to differentiate across LAs
+                tables.append(to_arrow(df, schema=schema))
+                event['rows'] = len(df)
+        with metrics.stage('write', file="main_flatcin.arrow", format='arrow') as event:
+            path = write_arrow(tables, flatfile_folder, "main_flatcin", schema)
+            event['rows'] = arrow_event['rows'] = sum(len(table) for table in tables)
+    return path
+
+
+def write_partition(file, dataset, la, output_format, chunksize=100000, store=None):
+    '''
+    Writes the partition of an LA from its flatfile, returns the number of rows
+    The partition is written under a hidden name first, so that readers never see half a partition
+    '''
+    partial = '.{}.partial'.format(la)
+    with FlatfileWriter(dataset, partial, read_columns(file), output_format) as writer:
+        chunks = prefixed_chunks(file, la_prefix(file), chunksize, writer)
+        if store is not None:
+            rows = store.write_la(la, chunks)
+        else:
+            rows = sum(len(chunk) for chunk in chunks)
+    os.replace(flatfile_path(dataset, partial, output_format), flatfile_path(dataset, la, output_format))
+    return rows
+
+
+def code_hash():
+    sha = hashlib.sha256()
+    for module in PARTITION_MODULES:
+        with open(os.path.join(os.path.dirname(__file__), module), 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+def partition_fingerprint(file, output_format, code):
+    return hashlib.sha256('{}-{}-{}'.format(file_hash(file), output_format, code).encode('utf-8')).hexdigest()
+
+
+def load_manifest(dataset):
+    try:
+        with open(os.path.join(dataset, 'manifest.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'partitions': {}}
+
+
+def save_manifest(dataset, manifest):
+    write_atomic(os.path.join(dataset, 'manifest.json'), json.dumps(manifest, indent=1, sort_keys=True).encode('utf-8'))
+
+
+def prefixed_chunks(file, prefix, chunksize, writer):
+    '''
+    Yields the chunks of a flatfile with prefixed child IDs, once written to main_flatcin
+    '''
+    for chunk in iter_flatfile(file, chunksize):
+        chunk['LAchildID'] = prefix + chunk['LAchildID'].astype(str) # Add prefix to Child ID to differentiate across LAs
+        writer.write(chunk)
+        yield chunk
+
+
+def find_flatfiles(flatfile_folder):
+    '''
+    Returns the LA flatfiles in the folder (csv and parquet), sorted so that main_flatcin is always in the same order
+    '''
+    all_flatfiles = []
+    for extension in FORMATS.values():
+        all_flatfiles += glob.glob(os.path.join(flatfile_folder, "*{}".format(extension)))
+    return sorted(f for f in all_flatfiles if not os.path.basename(f).startswith('main_flatcin'))
+
+
+def la_prefix(file):
+    '''
+    First 3 letters of the borough name, from the flatfile name (e.g. Hackney_flatcin.csv -> HAC)
+    '''
+    return os.path.basename(file)[:3].upper()
+
+
+def flatfile_la(file):
+    '''
+    LA of a flatfile, from its name (e.g. Hackney_flatcin.csv -> Hackney)
+    '''
+    return os.path.basename(file).rsplit('_flatcin', 1)[0]
@@ -0,0 +1,15 @@
+import os
+import yaml
+
+
+# Config file shipped with the code
+DEFAULT_CONFIG = os.path.join(os.path.dirname(__file__), '..', 'config', 'cin_datamap.yaml')
+
+
+def load_config(path=DEFAULT_CONFIG):
+    '''
+    Loads the config file (cin_datamap.yaml)
+    '''
+    with open(path) as FILE:
+        config = yaml.load(FILE, Loader=yaml.FullLoader)
+    return config
@@ -0,0 +1,108 @@
+'''Episode tables: CIN episodes (referral -> closure) and child protection plans (CPP start -> end)
+
+The end events of an episode carry the date of its start event (e.g. the CINreferralDate of a CINclosureDate row,
+from the same CINdetails). The start and end events of all the children are sorted once by child, start date and date,
+so that each episode is a run of rows: its start event, then its end events. A new episode begins wherever the child or
+the start date changes (a shift and a cumsum), its end is the next row, and the gaps between the episodes of a child
+come from grouped shifts. All the children are done at once, without a loop over the children or a self merge.
+
+An end event whose start is not in the data (e.g. before the first census return) does not make an episode.
+'''
+import numpy as np
+import pandas as pd
+
+from wrangling.cincensus.journeys import NO_DATE, from_days, to_days
+from wrangling.cincensus.partitions import is_partitioned, map_partitions
+from wrangling.cincensus.star import add_children, read_events
+from wrangling.cincensus.storage import concat_tables
+
+
+def build_episodes(events, start_type, end_type, cin_census_close, by=['LA', 'LAchildID']):
+    '''
+    Episodes of each child (same values of by) from its start_type and end_type events, one row per start event, with:
+    - episode_number: 1 for the child's first episode, 2 for the second...
+    - episode_start, episode_end: dates of the start and of the first end of the episode (empty if still open)
+    - open_episode: True if the episode has not ended
+    - episode_days: days from the start to the end, or to cin_census_close if still open
+    - days_since_previous_start, days_since_previous_end: days from the start / end of the child's previous episode
+      (negative if the previous episode was still open)
+    The start date of each event is read from its start_type column
+    '''
+    events = events[events['Type'].isin([start_type, end_type]) & events['Date'].notnull() & events[start_type].notnull()]
+
+    # Sort the events by child, start date, then the start event before the end events, by date
+    child = events.groupby(by, sort=False, dropna=False, observed=True).ngroup().values
+    start = to_days(events[start_type])
+    days = to_days(events['Date'])
+    is_start = (events['Type'] == start_type).values
+    order = np.lexsort((days, ~is_start, start, child))
+    child, start, days, is_start = child[order], start[order], days[order], is_start[order]
+
+    # Episode of each event: a new one starts wherever the child or the start date changes
+    new_episode = np.ones(len(order), dtype=bool)
+    new_episode[1:] = (child[1:] != child[:-1]) | (start[1:] != start[:-1])
+    episode = np.cumsum(new_episode)
+    # End of each episode: the row after its start event, if it is an end event of the same episode
+    next_is_end = np.zeros(len(order), dtype=bool)
+    next_is_end[:-1] = (episode[1:] == episode[:-1]) & ~is_start[1:]
+    next_days = np.append(days[1:], NO_DATE)
+    end = np.where(next_is_end, next_days, NO_DATE)[is_start]
+
+    # One row per episode: the start events, in order
+    episodes = events.iloc[order[is_start]].dropna(axis=1, how='all').reset_index(drop=True)
+    start_child, start_days, is_open = child[is_start], days[is_start], end == NO_DATE
+    close_days = to_days(pd.Series([cin_census_close]))[0]
+    episodes['episode_number'] = pd.Series(start_child).groupby(start_child).cumcount().values + 1
+    episodes['episode_start'] = from_days(start_days)
+    episodes['episode_end'] = from_days(end)
+    episodes['open_episode'] = is_open
+    episodes['episode_days'] = np.where(is_open, close_days, end) - start_days
+
+    # Gaps from the child's previous episode
+    dates = pd.DataFrame({'start': start_days, 'end': np.where(is_open, np.nan, end)}, dtype=float)
+    previous = dates.groupby(start_child).shift()
+    episodes['days_since_previous_start'] = start_days - previous['start'].values
+    episodes['days_since_previous_end'] = start_days - previous['end'].values
+
+    return episodes
+
+
+def cin_episodes(input_file, cin_census_close, rereferral_days=365, workers=1):
+    '''
+    Table of the CIN episodes of main_flatcin (input_file), from each referral to its closure (see build_episodes)
+    - re_referral: True if the referral came within rereferral_days of the child's previous referral
+    - Age at referral
+    A partitioned main_flatcin is processed one partition at a time, or by workers processes (see partitions.py)
+    From main_star, the episodes are built on child_key, and the child and LA columns joined to them (see star.py)
+    '''
+    if is_partitioned(input_file):
+        return concat_tables(map_partitions(cin_episodes, input_file, workers, cin_census_close=cin_census_close,
+                                            rereferral_days=rereferral_days))
+    df, by = read_events(input_file, types=['CINreferralDate', 'CINclosureDate'])
+    episodes = add_children(build_episodes(df, 'CINreferralDate', 'CINclosureDate', pd.Timestamp(cin_census_close), by), input_file)
+    episodes = episodes.rename(columns={'days_since_previous_start': 'days_since_previous_referral',
+                                        'days_since_previous_end': 'days_since_previous_closure'})
+    episodes['re_referral'] = episodes['days_since_previous_referral'] <= rereferral_days
+    episodes['Age at referral'] = episodes['episode_start'].dt.year - episodes['PersonBirthDate']
+    return episodes
+
+
+def cpp_episodes(input_file, cin_census_close, workers=1):
+    '''
+    Table of the child protection plans of main_flatcin (input_file), from each CPP start to its end (see build_episodes)
+    - repeat_cpp: True if the child had a previous plan, in the data or as reported by the LA (NumberOfPreviousCPP)
+    - Age at CPP start
+    A partitioned main_flatcin is processed one partition at a time, or by workers processes (see partitions.py)
+    From main_star, the episodes are built on child_key, and the child and LA columns joined to them (see star.py)
+    '''
+    if is_partitioned(input_file):
+        return concat_tables(map_partitions(cpp_episodes, input_file, workers, cin_census_close=cin_census_close))
+    df, by = read_events(input_file, types=['CPPstartDate', 'CPPendDate'])
+    episodes = add_children(build_episodes(df, 'CPPstartDate', 'CPPendDate', pd.Timestamp(cin_census_close), by), input_file)
+    episodes = episodes.rename(columns={'days_since_previous_start': 'days_since_previous_cpp_start',
+                                        'days_since_previous_end': 'days_since_previous_cpp_end'})
+    episodes['repeat_cpp'] = episodes['episode_number'] > 1
+    if 'NumberOfPreviousCPP' in episodes.columns:
+        episodes['repeat_cpp'] |= (episodes['NumberOfPreviousCPP'] > 0).fillna(False).astype(bool)
+    episodes['Age at CPP start'] = episodes['episode_start'].dt.year - episodes['PersonBirthDate']
+    return episodes
@@ -0,0 +1,203 @@
+'''Local event store: the events of the flat files in an SQLite database, indexed by child, LA, event type and date
+
+Questions about a few children or a cut of the events (e.g. all CPP starts of an LA over a quarter)
+are then indexed reads of the database instead of full reads of main_flatcin:
+
+    store = EventStore('events.db')
+    store.child_history('HACC0000001')
+    store.query(la='Hackney', types=['CPPstartDate'], start='2019-10-01', end='2019-12-31')
+
+The store is written LA by LA (by main or concat, with event_store=...): writing an LA replaces all its events,
+so the store can be refreshed one LA at a time. Child IDs are stored as in main_flatcin, prefixed with the LA (see concat)
+Dates and integers not in the proper format are stored empty, and their text as in the flat files (e.g. the
+"Not in proper format" markers) in a bad_values column, so that the store keeps the data quality markers
+'''
+import json
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from wrangling.cincensus.schema import DATE, INTEGER, columns_of_type, flatfile_schema, to_typed
+
+
+TABLE = 'events'
+INDEXED_COLUMNS = ['LAchildID', 'LA', 'Type', 'Date']
+# One index per indexed column, and one for cuts of an LA by event type and date
+INDEXES = [[col] for col in INDEXED_COLUMNS] + [['LA', 'Type', 'Date']]
+# Text of the dates and integers not in the proper format, by column (JSON)
+BAD_VALUES = 'bad_values'
+
+
+class EventStore:
+    '''
+    SQLite database of events, with one column per flat file column
+    - Dates are stored as text (YYYY-MM-DD), so that they sort and compare as dates
+    - Integer columns (year of birth, FactorsMask...) as integers, all other columns as text
+    - Dates and integers not in the proper format are stored empty, as typed reads of the flat files give them,
+      and their text in the bad_values column, as JSON: {"CINreferralDate": "Not in proper format: 2019-13-40"}
+    New columns are added to the table as flat files with them are written
+    '''
+
+    def __init__(self, path, config=None):
+        self.path = path
+        self.schema = flatfile_schema(config)
+        self.date_columns, self.integer_columns = columns_of_type(self.schema, DATE), columns_of_type(self.schema, INTEGER)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(
+                TABLE, ', '.join('{} {}'.format(quote(col), self.sql_type(col)) for col in INDEXED_COLUMNS)))
+            for index in INDEXES:
+                self.connection.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+                    quote('idx_{}_{}'.format(TABLE, '_'.join(index))), TABLE, ', '.join(quote(col) for col in index)))
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def sql_type(self, col):
+        return 'INTEGER' if col in self.integer_columns else 'TEXT'
+
+    def columns(self):
+        return [row[1] for row in self.connection.execute('PRAGMA table_info({})'.format(TABLE))]
+
+    # --- Write ---
+
+    def write_la(self, la, frames):
+        '''
+        Replaces the events of the LA with those of frames (a DataFrame, or an iterable of DataFrames, e.g. chunks),
+        in one transaction: if writing fails, the LA keeps its previous events
+        Frames may be typed or text (e.g. csv chunks): they are all typed with the flat file schema (see to_storable),
+        so the store is the same whether it is written by main, concat or streaming concat
+        Returns the number of rows written
+        '''
+        if isinstance(frames, pd.DataFrame):
+            frames = [frames]
+        rows = 0
+        with self.connection:
+            self.connection.execute('DELETE FROM {} WHERE LA = ?'.format(TABLE), (la,))
+            for df in frames:
+                rows += self.insert(df)
+        return rows
+
+    def insert(self, df):
+        df = self.to_storable(df)
+        existing = set(self.columns())
+        for col in df.columns:
+            if col not in existing:
+                self.connection.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(TABLE, quote(col), self.sql_type(col)))
+        statement = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            TABLE, ', '.join(quote(col) for col in df.columns), ', '.join('?' for _ in df.columns))
+        self.connection.executemany(statement, df.itertuples(index=False, name=None))
+        return len(df)
+
+    def to_storable(self, df):
+        '''
+        Values as SQLite takes them: the frame is first typed with the flat file schema (see schema.to_typed), whether it
+        was read as text or not, then dates as text, integers as int, empty values (and empty text) as None
+        Whole numbers read from csv as floats (e.g. 0.0 for a code 0) are turned back into integers first,
+        so that the events are stored the same whether they come from main or concat
+        Dates and integers which typing leaves empty keep their text in bad_values
+        '''
+        df = df.copy()
+        for col in df.columns:
+            values = df[col]
+            if pd.api.types.is_float_dtype(values) and (values.dropna() % 1 == 0).all():
+                df[col] = values.astype('Int64')
+        raw = {col: df[col] for col in df.columns if col in self.date_columns or col in self.integer_columns}
+        df = to_typed(df, self.schema)
+        bad = {}
+        for col, values in raw.items():
+            lost = df[col].isnull() & values.notnull() & (values.astype(str).str.strip() != '')
+            for i in np.flatnonzero(lost.values):
+                bad.setdefault(i, {})[col] = str(values.iloc[i])
+        if bad:
+            df[BAD_VALUES] = [json.dumps(bad[i], sort_keys=True) if i in bad else None for i in range(len(df))]
+        for col in df.columns:
+            if pd.api.types.is_datetime64_any_dtype(df[col]):
+                df[col] = df[col].dt.strftime('%Y-%m-%d')
+        df = df.astype(object)
+        return df.where(df.notnull() & (df != ''), None)
+
+    # --- Read ---
+
+    def query(self, child=None, la=None, types=None, start=None, end=None, columns=None):
+        '''
+        Returns the events matching all the filters given, sorted by LA, child and date
+        - child: LAchildID, or list of LAchildIDs
+        - la: LA, or list of LAs
+        - types: list of event types (values of Type)
+        - start, end: first and last dates of the events (included)
+        - columns: the columns needed (default: all)
+        Dates are returned as datetimes and integers as nullable integers
+        '''
+        conditions, params = [], []
+        for col, values in [('LAchildID', child), ('LA', la), ('Type', types)]:
+            if values is None:
+                continue
+            values = [values] if isinstance(values, str) else list(values)
+            conditions.append('{} IN ({})'.format(quote(col), ', '.join('?' for _ in values)))
+            params += values
+        if start is not None:
+            conditions.append('Date >= ?')
+            params.append(pd.Timestamp(start).strftime('%Y-%m-%d'))
+        if end is not None:
+            conditions.append('Date <= ?')
+            params.append(pd.Timestamp(end).strftime('%Y-%m-%d'))
+
+        select = '*' if columns is None else ', '.join(quote(col) for col in columns)
+        statement = 'SELECT {} FROM {}'.format(select, TABLE)
+        if conditions:
+            statement += ' WHERE ' + ' AND '.join(conditions)
+        statement += ' ORDER BY LA, LAchildID, Date'
+        return self.sql(statement, params)
+
+    def child_history(self, child):
+        '''
+        All the events of a child (LAchildID, as in main_flatcin), in date order
+        '''
+        return self.query(child=child)
+
+    def las(self):
+        '''
+        The LAs in the store, with their number of events
+        '''
+        return self.sql('SELECT LA, COUNT(*) AS events FROM {} GROUP BY LA ORDER BY LA'.format(TABLE))
+
+    def sql(self, statement, params=()):
+        '''
+        Runs any SQL query on the store (the table is called events), returned as a DataFrame
+        '''
+        df = pd.read_sql_query(statement, self.connection, params=list(params))
+        return self.to_typed(df)
+
+    def to_typed(self, df):
+        for col in df.columns:
+            if col in self.date_columns:
+                df[col] = pd.to_datetime(df[col], format='%Y-%m-%d', errors='coerce')
+            elif col in self.integer_columns:
+                df[col] = pd.to_numeric(df[col], errors='coerce').astype('Int64')
+        return df
+
+
+def quote(name):
+    '''
+    Quotes a column name for SQL
+    '''
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def open_store(event_store, config=None):
+    '''
+    The event store to write to: event_store may be a path, an EventStore or None (no store)
+    '''
+    if event_store is None or isinstance(event_store, EventStore):
+        return event_store
+    return EventStore(event_store, config)
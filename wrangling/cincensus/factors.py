@@ -0,0 +1,105 @@
+import numpy as np
+import pandas as pd
+
+from wrangling.cincensus.config import load_config
+from wrangling.cincensus.partitions import is_partitioned, map_partitions
+from wrangling.cincensus.star import add_children, read_events
+from wrangling.cincensus.storage import concat_tables
+
+
+# Assessment factors are stored in the flat files as one integer per assessment (FactorsMask):
+# bit i is set if the i-th factor code of cin_datamap.yaml was identified at assessment
+
+
+def factor_codes(config=None):
+    '''
+    Returns the list of assessment factor codes, in the order of the config (cin_datamap.yaml)
+    '''
+    if config is None:
+        config = load_config()
+    category = config['CINdetails']['Assessments']['FactorsIdentifiedAtAssessment']['AssessmentFactors']['category']
+    codes = [str(item['code']) for item in category]
+    if len(codes) > 63:
+        raise ValueError("Too many factor codes ({}) to fit in a 64-bit mask".format(len(codes)))
+    return codes
+
+
+def split_factors(factors):
+    '''
+    Long table of the factors in a column of comma-separated factors (e.g. "1A,3B,21"):
+    one row per (row of the column, factor), with the index of the row in 'row'
+    '''
+    factors = factors.dropna().astype(str)
+    factors = factors[factors != '']
+    long = factors.str.split(',').explode()
+    long = pd.DataFrame({'row': long.index, 'factor': long.values})
+    return long[long['factor'] != ''].drop_duplicates()
+
+
+def encode_factors(factors, codes=None):
+    '''
+    Encodes a column of comma-separated factors into a column of FactorsMask (int64), with the same index
+    Rows without factors get 0. Factors that are not in the codes are left out: see unknown_factors
+    '''
+    if codes is None:
+        codes = factor_codes()
+    long = split_factors(factors)
+    bits = long['factor'].map({code: np.int64(1) << i for i, code in enumerate(codes)})
+    masks = bits.groupby(long['row'].values).sum().astype(np.int64)
+    return masks.reindex(factors.index, fill_value=0).astype(np.int64)
+
+
+def unknown_factors(factors, codes=None):
+    '''
+    Returns the factors of a column of comma-separated factors which are not in the codes, with their counts
+    '''
+    if codes is None:
+        codes = factor_codes()
+    long = split_factors(factors)
+    return long.loc[~long['factor'].isin(codes), 'factor'].value_counts()
+
+
+def expand_factors(masks, codes=None, only_present=True):
+    '''
+    Expands a column of FactorsMask into one column per factor code, with 1 = factor identified, 0 = not identified
+    - only_present: only keep the factors identified in at least one row (default), otherwise one column per code
+    The columns are the codes, in the order of the config, and the index is the one of masks
+    '''
+    if codes is None:
+        codes = factor_codes()
+    values = pd.to_numeric(masks, errors='coerce').fillna(0).values.astype(np.int64)
+    flags = ((values[:, None] >> np.arange(len(codes), dtype=np.int64)) & 1).astype(np.uint8)
+    flags = pd.DataFrame(flags, columns=codes, index=masks.index)
+    if only_present:
+        flags = flags.loc[:, flags.any(axis=0).values]
+    return flags
+
+
+# --- Assessment factors table ---
+
+def assessment_factors(input_file, codes=None, only_present=True, workers=1):
+    '''
+    Table of the authorised assessments of main_flatcin (input_file),
+    with one column per factor: 1 = factor identified at assessment, 0 = factor not identified
+    - only_present: only keep the factors identified in at least one assessment (default), otherwise one column per code
+    A partitioned main_flatcin is processed one partition at a time, or by workers processes (see partitions.py)
+    From main_star, the child and LA columns are joined on child_key (see star.py)
+    '''
+    if is_partitioned(input_file):
+        # All the factor columns in every partition, so that a factor missing from a partition is 0 there
+        table = concat_tables(map_partitions(assessment_factors, input_file, workers, codes=codes, only_present=False))
+        if only_present:
+            codes = factor_codes() if codes is None else codes
+            table = table.drop(columns=[code for code in codes if code in table.columns and not table[code].any()])
+        return table
+
+    # Load flatfile: only keep assessment authorised, without empty columns
+    df, _ = read_events(input_file, types=['AssessmentAuthorisationDate'])
+    df = df.dropna(axis=1, how='all')
+
+    if 'FactorsMask' not in df.columns:
+        # Flat files created before FactorsMask: encode them now
+        df['FactorsMask'] = encode_factors(df['Factors'], codes)
+    factor_cols = expand_factors(df['FactorsMask'], codes, only_present)
+
+    return add_children(pd.concat([df.drop(columns='FactorsMask'), factor_cols], axis=1), input_file)
@@ -0,0 +1,132 @@
+'''CIN Census input files: plain .xml, gzipped .xml.gz, or .zip archives of .xml files, as LAs send them
+
+A file inside a zip archive is named after the archive and the member, e.g. Hackney/returns.zip::cin_2019.xml
+Files are opened decompressed, streamed into the parser without being extracted to disk
+
+Prefetcher reads the next files in a background thread while the current one is processed, into the OS cache only,
+so that parsing does not wait for slow disks or network shares and still streams each file
+'''
+import gzip
+import os
+import threading
+import zipfile
+
+
+ARCHIVE_SEPARATOR = '::'
+# Files which may hold CIN Census data
+INPUT_EXTENSIONS = ('.xml', '.xml.gz', '.zip')
+
+
+def find_inputs(folder):
+    '''
+    Returns the CIN Census files of a folder: .xml, .xml.gz, and the .xml members of the .zip archives, sorted
+    '''
+    files = []
+    for name in sorted(os.listdir(folder)):
+        path = os.path.join(folder, name)
+        lower = name.lower()
+        if lower.endswith('.xml') or lower.endswith('.xml.gz'):
+            files.append(path)
+        elif lower.endswith('.zip'):
+            with zipfile.ZipFile(path) as archive:
+                members = [member for member in archive.namelist()
+                           if member.lower().endswith('.xml') and not member.startswith('__MACOSX/')]
+            files += [path + ARCHIVE_SEPARATOR + member for member in sorted(members)]
+    return sorted(files)
+
+
+def split_archive(file):
+    '''
+    Returns (path on disk, member of the zip archive or None)
+    '''
+    if ARCHIVE_SEPARATOR in file:
+        path, member = file.split(ARCHIVE_SEPARATOR, 1)
+        return path, member
+    return file, None
+
+
+def input_name(file):
+    '''
+    Name of the file for messages and metrics, e.g. cin_2019.xml or returns.zip::cin_2019.xml
+    '''
+    path, member = split_archive(file)
+    return os.path.basename(path) if member is None else '{}{}{}'.format(os.path.basename(path), ARCHIVE_SEPARATOR, member)
+
+
+def input_size(file):
+    '''
+    Size of the file as stored, in bytes (compressed size for .gz and zip members)
+    '''
+    path, member = split_archive(file)
+    if member is None:
+        return os.path.getsize(path)
+    with zipfile.ZipFile(path) as archive:
+        return archive.getinfo(member).compress_size
+
+
+def open_input(file):
+    '''
+    Opens a CIN Census file for reading, decompressed, as a binary file object
+    '''
+    path, member = split_archive(file)
+    raw = open(path, 'rb')
+    if member is not None:
+        archive = zipfile.ZipFile(raw)
+        return archive.open(member)
+    if path.lower().endswith('.gz'):
+        return gzip.GzipFile(fileobj=raw)
+    return raw
+
+
+class Prefetcher:
+    '''
+    Reads files (or their zip archives) from disk in a background thread, in the order given and up to `ahead` files
+    ahead of the file last opened, so that they are in the OS cache by the time they are parsed
+    The data read is not kept: open(file) opens the file from disk (see open_input), and the parser streams from it
+    as usual, so memory stays at one block of block_size bytes whatever the size of the files
+    '''
+
+    def __init__(self, files, ahead=2, block_size=1 << 20):
+        self.paths = list(dict.fromkeys(split_archive(file)[0] for file in files))
+        self.position = {path: i for i, path in enumerate(self.paths)}
+        self.ahead = ahead
+        self.block_size = block_size
+        self.opened = -1 # Position of the last file opened
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.read, daemon=True)
+        self.thread.start()
+
+    def read(self):
+        for i, path in enumerate(self.paths):
+            with self.condition:
+                self.condition.wait_for(lambda: self.stopped or i <= self.opened + self.ahead)
+            if self.stopped:
+                return
+            try:
+                with open(path, 'rb') as f:
+                    while not self.stopped and f.read(self.block_size):
+                        pass
+            except OSError:
+                # Raised when the file is opened
+                pass
+
+    def open(self, file):
+        position = self.position.get(split_archive(file)[0])
+        if position is not None:
+            with self.condition:
+                self.opened = max(self.opened, position)
+                self.condition.notify()
+        return open_input(file)
+
+    def close(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,292 @@
+import numpy as np
+import pandas as pd
+
+from wrangling.cincensus.partitions import is_partitioned, map_partitions
+from wrangling.cincensus.star import add_children, read_events
+from wrangling.cincensus.storage import concat_tables
+
+
+# --- Time-window event matching ---
+
+def match_events(left, right, left_on, right_on, window, by=['LAchildID', 'LA'], how='first',
+                 right_cols=None, days_col=None, suffix='_match'):
+    '''
+    Matches each left event with the right events of the same child (same values of by) that happened within a window of days
+    - left_on: date column of the left events, or a list of date columns (a right event matches if it is within the window of any of them)
+    - right_on: date column of the right events
+    - window: (min days, max days) from the left date to the right date, both included, e.g. (0, 30)
+      With several left_on, a list of windows (one per left_on) or the same window for all
+    - how='first': only the earliest matching right event, one row per left event
+      how='all': all the matching right events, one row per match
+    - right_cols: right columns to bring in (default: right_on); those already in left get the suffix
+    - days_col: name of the column for the number of days from the left date to the right date (one per left_on)
+    Left events without a match are kept, with empty right columns.
+
+    The right events are sorted once by child and date, and the matches of each left event found by binary search,
+    so memory is linear in the number of events and matches rather than the pairs of events of each child.
+    '''
+    if how not in ('first', 'all'):
+        raise ValueError("how must be 'first' or 'all', not {}".format(how))
+    left_on = [left_on] if isinstance(left_on, str) else list(left_on)
+    windows = [window] * len(left_on) if np.ndim(window) == 1 else list(window)
+    days_cols = [] if days_col is None else [days_col] if isinstance(days_col, str) else list(days_col)
+    right_cols = [right_on] if right_cols is None else list(right_cols)
+    if len(windows) != len(left_on) or len(days_cols) not in (0, len(left_on)):
+        raise ValueError("Give one window and one days_col per left_on")
+
+    # Child of each event, as one integer code shared by left and right (-1: no child)
+    left_group, right_group = group_codes(left, right, by)
+
+    # Sort the right events by child and date: the events of a child within a window are then a contiguous range
+    # Child and date are combined into one sorted int64 key, searched with np.searchsorted
+    right_days = to_days(right[right_on])
+    left_days = [to_days(left[col]) for col in left_on]
+    keep = (right_group >= 0) & (right_days != NO_DATE)
+    order = np.flatnonzero(keep)[np.lexsort((right_days[keep], right_group[keep]))]
+    first_day, width = day_range(right_days, left_days, windows)
+    sorted_key = right_group[order] * width + (right_days[order] - first_day)
+
+    # Range of sorted right events within the window of each left date
+    ranges = []
+    for days, (min_days, max_days) in zip(left_days, windows):
+        valid = (left_group >= 0) & (days != NO_DATE)
+        key = np.where(valid, left_group * width + (days - first_day), 0)
+        start = np.searchsorted(sorted_key, key + min_days, 'left')
+        end = np.searchsorted(sorted_key, key + max_days, 'right')
+        ranges.append((start, np.where(valid, end, start)))
+
+    # Pairs of (left row, sorted right position), -1 when there is no match
+    if how == 'first':
+        first = np.full(len(left), len(order))
+        for start, end in ranges:
+            first = np.where(end > start, np.minimum(first, start), first)
+        left_index = np.arange(len(left))
+        right_position = np.where(first < len(order), first, -1)
+    else:
+        left_pairs, right_pairs = [], []
+        for start, end in ranges:
+            counts = end - start
+            left_pairs.append(np.repeat(np.arange(len(left)), counts))
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            right_pairs.append(np.repeat(start, counts) + offsets)
+        pairs = pd.DataFrame({'left': np.concatenate(left_pairs), 'right': np.concatenate(right_pairs)})
+        pairs = pairs.drop_duplicates()
+        # Keep the left events without a match
+        unmatched = np.setdiff1d(np.arange(len(left)), pairs['left'].values)
+        pairs = pd.concat([pairs, pd.DataFrame({'left': unmatched, 'right': -1})])
+        pairs = pairs.sort_values(['left', 'right'], kind='stable')
+        left_index = pairs['left'].values
+        right_position = pairs['right'].values
+
+    # Build the output: left rows, with the matched right columns
+    matched = right_position >= 0
+    position = np.where(matched, right_position, 0)
+    right_index = order[position] if len(order) > 0 else position
+    matched_days = np.where(matched, right_days[right_index] if len(order) > 0 else 0, NO_DATE)
+    result = left.iloc[left_index].reset_index(drop=True)
+    for col in right_cols:
+        name = col + suffix if col in left.columns else col
+        if col == right_on:
+            result[name] = from_days(matched_days)
+        elif len(order) > 0:
+            result[name] = right[col].iloc[right_index].reset_index(drop=True).where(matched)
+        else:
+            result[name] = np.nan
+    for days, name in zip(left_days, days_cols):
+        days = days[left_index]
+        result[name] = np.where(matched & (days != NO_DATE), matched_days - days, np.nan)
+
+    return result
+
+
+# --- Helper functions ---
+
+# Days are stored as int64 days since 1970, with NO_DATE for empty or invalid dates
+NO_DATE = np.iinfo(np.int64).min
+
+
+def to_days(values):
+    '''
+    Converts a column of dates (or text dates) to days since 1970
+    '''
+    dates = pd.to_datetime(values, errors='coerce')
+    days = dates.values.astype('datetime64[D]').astype(np.int64)
+    return np.where(dates.isnull().values, NO_DATE, days)
+
+
+def from_days(days):
+    '''
+    Converts days since 1970 back to dates
+    '''
+    # NO_DATE is NaT as datetime64
+    return pd.Series(np.asarray(days).astype('datetime64[D]').astype('datetime64[ns]'))
+
+
+def group_codes(left, right, by):
+    '''
+    Codes the by columns of the left and right events into one integer per child, the same on both sides
+    Events with an empty by value get -1
+    '''
+    keys = pd.concat([left[by], right[by]], ignore_index=True)
+    codes = keys.groupby(by, sort=False, dropna=False, observed=True).ngroup().values.astype(np.int64)
+    codes[keys.isnull().any(axis=1).values] = -1
+    return codes[:len(left)], codes[len(left):]
+
+
+def day_range(right_days, left_days, windows):
+    '''
+    First day and number of days covering all the right days and the windows of all the left days
+    '''
+    first, last = [], []
+    for days, (min_days, max_days) in [(right_days, (0, 0))] + list(zip(left_days, windows)):
+        days = days[days != NO_DATE]
+        if len(days) > 0:
+            first.append(days.min() + min_days)
+            last.append(days.max() + max_days)
+    if len(first) == 0:
+        return 0, 1
+    return min(first), max(last) - min(first) + 1
+
+
+# --- Journey tables ---
+
+def referral_journeys(input_file, ref_assessment=30, match_how='first', workers=1):
+    '''
+    Table of the referrals of main_flatcin (input_file), each with its outcome:
+    - days_to_s17 / days_to_s47: days from the referral to the S17 / S47 assessment that followed, within ref_assessment days
+    - referral_outcome: S17, S47, Both S17 & S47 or NFA
+    - Age at referral
+    See match_events for match_how
+    A partitioned main_flatcin is processed one partition at a time, or by workers processes (see partitions.py)
+    From main_star, the events are linked on child_key, and the child and LA columns joined to the result (see star.py)
+    '''
+    if is_partitioned(input_file):
+        return concat_tables(map_partitions(referral_journeys, input_file, workers,
+                                            ref_assessment=ref_assessment, match_how=match_how))
+
+    # Load flatfile: only the events we need, and the columns identifying the child of each event
+    df, by = read_events(input_file, types=['CINreferralDate', 'AssessmentActualStartDate', 'S47ActualStartDate'])
+
+    # Only keep 3 subsets: Referral, Assessment and S47 events, without their empty cols
+    ref = df[df.Type == 'CINreferralDate'].dropna(axis=1, how='all')
+    s17 = df[df.Type == 'AssessmentActualStartDate'].dropna(axis=1, how='all')
+    s47 = df[df.Type == 'S47ActualStartDate'].dropna(axis=1, how='all')
+
+    # Match each referral event with the S17 and S47 assessments that followed (if they occurred)
+    # Rule: if the Assessment happened before the Referral, or more than ref_assessment days later, they are not related
+    referral_outcomes = match_events(ref, s17, left_on='CINreferralDate', right_on='AssessmentActualStartDate',
+                                     window=(0, ref_assessment), by=by, how=match_how, days_col='days_to_s17')
+    referral_outcomes = match_events(referral_outcomes, s47, left_on='CINreferralDate', right_on='S47ActualStartDate',
+                                     window=(0, ref_assessment), by=by, how=match_how, days_col='days_to_s47')
+
+    # Add clear outcomes column
+    s17_outcome = referral_outcomes.AssessmentActualStartDate.notnull()
+    s47_outcome = referral_outcomes.S47ActualStartDate.notnull()
+    referral_outcomes["referral_outcome"] = 'NFA'
+    referral_outcomes.loc[s17_outcome, "referral_outcome"] = 'S17'
+    referral_outcomes.loc[s47_outcome, "referral_outcome"] = 'S47'
+    referral_outcomes.loc[s17_outcome & s47_outcome, "referral_outcome"] = 'Both S17 & S47'
+
+    # Age of child during the Referral (dates are read as dates: see schema.py)
+    referral_outcomes = add_children(referral_outcomes, input_file)
+    referral_outcomes['Age at referral'] = referral_outcomes['CINreferralDate'].dt.year - referral_outcomes['PersonBirthDate']
+
+    return referral_outcomes
+
+
+def s47_journeys(input_file, cin_census_close, s47_cpp=60, icpc_cpp=45, match_how='first', workers=1):
+    '''
+    Table of the S47 journeys of main_flatcin (input_file), shaped for a PowerBI Sankey diagram:
+    one row per step (S47 -> ICPC / CPP start / No ICPC nor CPP, then ICPC -> CPP start / No CPP), with Source and Destination
+    - s47_cpp / icpc_cpp: max days from the S47 / ICPC to the CPP start for both to be linked
+    - cin_census_close: end of the CIN Census, S47 and ICPC too recent to know what followed are TBD
+    See match_events for match_how
+    A partitioned main_flatcin is processed one partition at a time, or by workers processes (see partitions.py)
+    From main_star, the events are linked on child_key, and the child and LA columns joined to the result (see star.py)
+    '''
+    if is_partitioned(input_file):
+        s47_journey = concat_tables(map_partitions(s47_journeys, input_file, workers, cin_census_close=cin_census_close,
+                                                   s47_cpp=s47_cpp, icpc_cpp=icpc_cpp, match_how=match_how))
+        # All the steps 1, then all the steps 2, as from the whole table
+        return s47_journey.iloc[np.argsort((s47_journey['Source'] == 'ICPC').values, kind='stable')]
+
+    # Dates from which S47 / ICPC are too recent to determine next journey
+    s47_max_date = cin_census_close - pd.Timedelta(days=s47_cpp)
+    icpc_max_date = cin_census_close - pd.Timedelta(days=icpc_cpp)
+
+    # Load flatfile: only the events we need, and the columns identifying the child of each event
+    df, by = read_events(input_file, types=['S47ActualStartDate', 'CPPstartDate'])
+
+    # Only keep 2 subsets: S47 events and CPP start events, without their empty cols
+    s47 = df[df.Type == 'S47ActualStartDate'].dropna(axis=1, how='all')
+    cpp = df[df.Type == 'CPPstartDate'].dropna(axis=1, how='all')
+
+    # Match each S47 event with the CPP that followed (if it occurred)
+    # Rule: the CPP is related if it started within icpc_cpp days of the ICPC, or within s47_cpp days of the S47
+    s47_outcomes = match_events(s47, cpp, left_on=['DateOfInitialCPC', 'S47ActualStartDate'], right_on='CPPstartDate',
+                                window=[(0, icpc_cpp), (0, s47_cpp)], by=by, how=match_how, days_col=['icpc_to_cpp', 's47_to_cpp'])
+
+    # Step 1: S47 -> ICPC, CPP directly, TBD (too recent) or nothing
+    step1 = s47_outcomes.copy()
+    step1['Source'] = 'S47 strategy discussion'
+    step1['Destination'] = None
+    step1.loc[step1['DateOfInitialCPC'].notnull(), 'Destination'] = 'ICPC'
+    step1.loc[step1['DateOfInitialCPC'].isnull() & step1['CPPstartDate'].notnull(), 'Destination'] = 'CPP start'
+    step1.loc[step1['Destination'].isnull() & (step1['S47ActualStartDate'] >= s47_max_date), 'Destination'] = 'TBD - S47 too recent'
+    step1.loc[step1['Destination'].isnull(), 'Destination'] = 'No ICPC nor CPP'
+
+    # Step 2: from all S47 that got to ICPC, ICPC -> CPP, TBD (too recent) or no CPP
+    step2 = step1[step1.Destination == 'ICPC'].copy()
+    step2['Source'] = 'ICPC'
+    step2['Destination'] = None
+    step2.loc[step2['CPPstartDate'].notnull(), 'Destination'] = 'CPP start'
+    step2.loc[step2['Destination'].isnull() & (step2['DateOfInitialCPC'] >= icpc_max_date), 'Destination'] = 'TBD - ICPC too recent'
+    step2.loc[step2['Destination'].isnull(), 'Destination'] = 'No CPP'
+
+    # Bring Steps 1 & 2 together, with the age of child during the S47
+    s47_journey = add_children(pd.concat([step1, step2]), input_file)
+    s47_journey['Age at S47'] = s47_journey['S47ActualStartDate'].dt.year - s47_journey['PersonBirthDate']
+
+    return s47_journey
+
+
+def s47_sankey(input_file, cin_census_close, s47_cpp=60, icpc_cpp=45, match_how='first', counts=True, workers=1):
+    '''
+    PowerBI Sankey input of the S47 journeys of main_flatcin (input_file):
+    - counts=True (default): the number of journeys per Source, Destination, LA and demographics (see sankey_counts)
+    - counts=False: the journeys themselves, one row per step (see s47_journeys)
+    '''
+    s47_journey = s47_journeys(input_file, cin_census_close, s47_cpp, icpc_cpp, match_how, workers)
+    if not counts:
+        return s47_journey
+    return sankey_counts(s47_journey, age_col='Age at S47')
+
+
+# Dimensions the Sankey diagrams can be filtered by, and age bands (as in the DfE children in need statistics)
+SANKEY_DIMENSIONS = ['LA', 'GenderCurrent', 'Age band', 'Ethnicity', 'Disabilities']
+AGE_BANDS = {'Under 1': 0, '1 to 4': 4, '5 to 9': 9, '10 to 15': 15, '16 and over': float('inf')}
+
+
+def age_bands(ages):
+    '''
+    Age band of each age in years (see AGE_BANDS), empty if the age is unknown
+    '''
+    return pd.cut(pd.to_numeric(ages, errors='coerce'), bins=[-float('inf')] + list(AGE_BANDS.values()),
+                  labels=list(AGE_BANDS))
+
+
+def sankey_counts(journeys, age_col, dimensions=SANKEY_DIMENSIONS):
+    '''
+    Counts the rows of a journey table (Source, Destination and demographics) per Source, Destination and dimensions,
+    in one groupby: the table PowerBI needs, with Count as the value of the flows
+    Empty values are kept as a group of their own, so that Count adds up to the number of rows
+    '''
+    keys = ['Source', 'Destination'] + list(dimensions)
+    table = journeys.reindex(columns=['Source', 'Destination'] + [col for col in dimensions if col != 'Age band'])
+    if 'Age band' in dimensions:
+        table['Age band'] = age_bands(journeys[age_col]).astype(object)
+    for col in table.columns:
+        # Codes read from csv as floats (e.g. 2.0 for gender 2)
+        if pd.api.types.is_float_dtype(table[col]) and (table[col].dropna() % 1 == 0).all():
+            table[col] = table[col].astype('Int64')
+    return table.groupby(keys, dropna=False, sort=True, observed=True).size().reset_index(name='Count')
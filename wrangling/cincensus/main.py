@@ -1,86 +1,342 @@
 from lxml import etree
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 import pandas as pd
-import glob
+import contextlib
+import io
 import re
 import os
 
+from wrangling.cincensus.cache import ExtractionCache
+from wrangling.cincensus.concat import la_prefix
+from wrangling.cincensus.eventstore import open_store
+from wrangling.cincensus.factors import encode_factors, factor_codes
+from wrangling.cincensus.inputs import Prefetcher, find_inputs, input_name, input_size, open_input
+from wrangling.cincensus.metrics import ListSink, Metrics, StageTimer, default_metrics
+from wrangling.cincensus.quality import NOT_IN_PROPER_FORMAT, QualityCounter, la_report, quality_path, write_quality
+from wrangling.cincensus.shards import assign_shards, parse_shard, write_manifest
+from wrangling.cincensus.storage import flatfile_path, iter_flatfile, write_flatfile
 
-def main(input_folder, output_folder, config, process_missing_only=True):
+
+# Events included in the flat file
+# We recommend including all of the events into the cin log: you can edit if you only need certain events
+TAG_LIST = ['CINreferralDate', 'CINclosureDate', 'DateOfInitialCPC',
+            'AssessmentActualStartDate', 'AssessmentAuthorisationDate', 'S47ActualStartDate',
+            'CPPstartDate', 'CPPendDate']
+
+
+def main(input_folder, output_folder, config, process_missing_only=True, streaming=True, workers=1, cache_folder=None,
+         output_format='csv', tiebreak='first', metrics=None, event_store=None, shard=None, las=None):
     '''Runs the degradation, cleaning and flat file steps
-    - Identifies all LA CIN files in cin_folder
+    - Identifies all LA CIN files in cin_folder: .xml, .xml.gz or .zip archives of .xml files, read without unzipping them
+    - Reads the next file in a background thread while the current one is processed (when run without workers)
     - Option to only process the files that haven't been converted into a flatfile
-    - Outputs the flatfiles into the flatfiles folder'''
-    
+    - Option to stream the files child by child (default) rather than loading each full file in memory
+    - Option to extract the files in a pool of worker processes (workers > 1): the output is the same as a serial run
+    - Option to cache the rows extracted from each file in cache_folder: only new or changed files are then extracted,
+      and LAs where no file changed are skipped
+    - Duplicate events across files are removed as the files are extracted, keeping the most complete one,
+      then the first one seen (tiebreak='first') or the one from the latest census return (tiebreak='latest')
+    - Outputs the flatfiles into the flatfiles folder, as csv or parquet (output_format)
+    - Outputs a data quality report for each LA next to its flatfile (<LA>_quality.json): the values not in the proper format,
+      counted per file, field and value as the files are cleaned (see quality.py)
+    - Option to also write the events of each LA to an event store (path of the SQLite database, or eventstore.EventStore),
+      replacing the LA's previous events, with child IDs prefixed as in main_flatcin
+    - Option to only process some LAs (las), e.g. those with new files (see watch.py)
+    - Option to only process one shard of the LAs (shard="i/n", e.g. on machine i of n), split by the size of their files,
+      and write the shard's manifest for check_shards before concat (see shards.py)
+    - Progress is reported as metrics events (time, rows, memory) per LA, file and stage: see metrics.Metrics'''
+    metrics = default_metrics(metrics)
+
     # Identify LAs
     # All
-    all_las = os.listdir(input_folder)
+    all_las = sorted(os.listdir(input_folder))
+    # Only this shard's LAs
+    if shard is not None:
+        shard = parse_shard(shard)
+        shard_las = assign_shards(input_folder, shard[1])[shard[0] - 1]
+        print("Shard {}/{}: {} LAs of {}".format(shard[0], shard[1], len(shard_las), len(all_las)))
+    else:
+        shard_las = all_las
+    selected_las = shard_las if las is None else [la for la in shard_las if la in las]
     # Already processed
     processed_las = [x.split('_')[0] for x in os.listdir(output_folder)]
     
     # Process all or only missing data
     if process_missing_only:
-        las_to_process = [la for la in all_las if la not in processed_las]
+        las_to_process = [la for la in selected_las if la not in processed_las]
     else:
-        las_to_process = all_las
+        las_to_process = selected_las
+
+    # Find CIN files in each LA folder - sorted so that runs are deterministic
+    cin_files = {la: find_inputs(os.path.join(input_folder, la)) for la in las_to_process}
+
+    # With a cache, find the files already extracted, and the LAs that are up to date
+    cache = None
+    up_to_date = []
+    if cache_folder is not None:
+        cache = ExtractionCache(cache_folder, config)
+        # Settings which change the flat file, whatever the files: an LA built with others is not up to date
+        options = {'output_format': output_format, 'tiebreak': tiebreak}
+        with Prefetcher([file for la in las_to_process for file in cin_files[la]]) as prefetcher:
+            cache_keys = {la: [cache.key(file, prefetcher.open) for file in cin_files[la]] for la in las_to_process}
+        up_to_date = [la for la in las_to_process if cache.is_current(la, cache_keys[la], options)
+                      and os.path.exists(flatfile_path(output_folder, "{}_flatcin".format(la), output_format))
+                      and os.path.exists(quality_path(output_folder, la))]
+        if len(up_to_date) > 0:
+            print("{} LAs are up to date: {}".format(len(up_to_date), up_to_date))
+        las_to_process = [la for la in las_to_process if la not in up_to_date]
+
+    def is_cached(la, i):
+        return cache is not None and cache_keys[la][i] in cache
+
+    # Compile the config once for the whole run
+    plan = compile_cleaningplan(config)
+    codes = factor_codes(config)
+
+    # With workers, all the files of all the LAs are sent to the pool straight away
+    # Results are then collected LA by LA and file by file, in the same order as a serial run
+    # The LA being profiled, if any, is extracted in this process so that the profile covers it
+    pool = None
+    if workers > 1:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        futures = {(la, i): pool.submit(_extractrows_worker, file, plan, streaming, la)
+                   for la in las_to_process if la != metrics.profile_la
+                   for i, file in enumerate(cin_files[la]) if not is_cached(la, i)}
     
+    store = open_store(event_store, config)
+
+    # Without workers, the files to extract are read ahead into the OS cache in a background thread
+    prefetcher = None
+    if pool is None:
+        prefetcher = Prefetcher([file for la in las_to_process for i, file in enumerate(cin_files[la]) if not is_cached(la, i)])
+    opener = prefetcher.open if prefetcher is not None else open_input
+
     # Go through the process for each LA to process
     print("Processing {} LAs: {}".format(len(las_to_process), las_to_process))
-    for la in las_to_process:
-    
-        # Find CIN files in the LA folder
-        cin_files = glob.glob(os.path.join(input_folder, la, "*.xml"))
-        print("{} --- Found {} CIN files".format(la, len(cin_files)))
+    try:
+        # LAs skipped as up to date still go to the store if it does not have them yet, from their flat file
+        if store is not None and len(up_to_date) > 0:
+            stored = set(store.las()['LA'])
+            for la in up_to_date:
+                if la not in stored:
+                    with metrics.stage('event_store', la=la) as event:
+                        file = flatfile_path(output_folder, "{}_flatcin".format(la), output_format)
+                        chunks = (chunk.assign(LAchildID=la_prefix(la) + chunk['LAchildID'].astype(str))
+                                  for chunk in iter_flatfile(file))
+                        event['rows'] = store.write_la(la, chunks)
+
+        for la in las_to_process:
+            with metrics.profile(la), metrics.stage('la', la=la, files=len(cin_files[la])) as la_event:
+                # Go through each CIN file: we only keep the extracted rows, not the trees
+                # Duplicate events are removed as the rows of each file come in
+                records = EventDeduplicator(tiebreak)
+                quality = []
+                for i, file in enumerate(cin_files[la]):
+                    name = input_name(file)
+                    if is_cached(la, i):
+                        with metrics.stage('cache_load', la=la, file=name) as event:
+                            file_rows, file_quality, referencedate = cache.get(cache_keys[la][i])
+                            event['rows'] = len(file_rows)
+                    else:
+                        if pool is None or la == metrics.profile_la:
+                            file_quality = QualityCounter()
+                            file_rows = extractrows(file, plan, streaming, metrics, la, opener, file_quality)
+                        else:
+                            # Send on the worker's events, and what it printed, in order
+                            file_rows, file_quality, output, events = futures[(la, i)].result()
+                            print(output, end='')
+                            for event in events:
+                                metrics.emit(event)
+                        # Cached with the rows whatever the tiebreak, so that warm runs never open the file again
+                        referencedate = None
+                        if tiebreak == 'latest' or cache is not None:
+                            with opener(file) as f:
+                                referencedate = get_referencedate(f)
+                        if cache is not None:
+                            cache.put(cache_keys[la][i], (file_rows, file_quality, referencedate))
+                    quality.append((name, file_quality))
+                    with metrics.stage('dedup', la=la, file=name, rows=len(file_rows)) as event:
+                        records.add(file_rows, referencedate)
+                        event['unique_rows'] = len(records.records)
+                    del file_rows
+
+                # Create LA CIN flatfile
+                with metrics.stage('flatfile', la=la) as event:
+                    flatfile = rows_to_cinrecord(records)
+
+                    # Remove Reviews col: we've extracted the review dates in 'CPPreview' already
+                    if "Reviews" in flatfile.columns:
+                        flatfile.drop("Reviews", axis=1, inplace=True)
+
+                    # Add col with LA name
+                    flatfile['LA'] = la
+
+                    # Encode the assessment factors into one integer per assessment, expanded with expand_factors when needed
+                    if 'Factors' in flatfile.columns:
+                        flatfile['FactorsMask'] = encode_factors(flatfile['Factors'], codes).astype('Int64').where(flatfile['Factors'].notnull())
+                    event['rows'] = la_event['rows'] = len(flatfile)
+
+                # Save in output folder, with the data quality report
+                with metrics.stage('write', la=la, rows=len(flatfile), format=output_format):
+                    write_flatfile(flatfile, output_folder, "{}_flatcin".format(la), output_format, config)
+                    report = la_report(la, quality)
+                    write_quality(report, output_folder)
+                la_event['bad_values'] = report['bad_values']
+                if store is not None:
+                    with metrics.stage('event_store', la=la, rows=len(flatfile)):
+                        store.write_la(la, flatfile.assign(LAchildID=la_prefix(la) + flatfile['LAchildID'].astype(str)))
+                if cache is not None:
+                    cache.set_current(la, cache_keys[la], options)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        if prefetcher is not None:
+            prefetcher.close()
+        if store is not None and store is not event_store:
+            store.close()
+
+    # The manifest is only written once all the shard's LAs are done
+    if shard is not None:
+        write_manifest(output_folder, input_folder, shard, all_las, shard_las, config, output_format, tiebreak)
     
-        # Go through each CIN file
-        clean_tree_list = []
-        for i, file in enumerate(cin_files):
-            print("File {} out of {}".format(i+1, len(cin_files)))
+    return 
 
-            # Degrade and clean
-            print("--- Degrade file {}".format(i+1))
-            degraded_tree = degradefile(file)
-            print("--- Clean file {}".format(i+1))
-            cleaned_tree = cleanfile(degraded_tree, config)
 
-            # Save
-            clean_tree_list.append(cleaned_tree)
+def extractrows(file, config, streaming=True, metrics=None, la=None, opener=open_input, quality=None):
+    '''
+    Degrades, cleans and extracts one CIN Census file, and returns its rows
+    The file is opened with opener (default: open_input, which decompresses .gz and zip members)
+    Sends a metrics event for the file and for each sub-stage (parse, degrade, clean, extract)
+    The values not in the proper format are counted in quality (quality.QualityCounter), if given
+    '''
+    metrics = default_metrics(metrics)
+    name = input_name(file)
+    with metrics.stage('file', la=la, file=name, size_mb=round(input_size(file) / 2 ** 20, 2)) as event:
+        if streaming:
+            # Degrade, clean and extract one child at a time
+            rows = extractfile(file, config, metrics=metrics, la=la, opener=opener, quality=quality)
+        else:
+            # Degrade and clean the full tree, then extract
+            degraded_tree = degradefile(file, metrics, la, opener)
+            cleaned_tree = cleanfile(degraded_tree, config, metrics, la, quality)
+            with metrics.stage('extract', la=la, file=name) as extract_event:
+                rows = buildtree(cleaned_tree, TAG_LIST)
+                extract_event['rows'] = len(rows)
+        event['rows'] = len(rows)
+    return rows
 
-        # Create LA CIN flatfile
-        print("--- Create CIN flatfile")
-        flatfile = build_cinrecord(clean_tree_list)
 
-        # Remove Reviews col: we've extracted the review dates in 'CPPreview' already
-        if "Reviews" in flatfile.columns:
-            flatfile.drop("Reviews", axis=1, inplace=True)
+def _extractrows_worker(file, config, streaming, la=None):
+    '''
+    Runs extractrows in a worker process
+    Its metrics events, and anything printed, are sent back with the rows and quality counts
+    for the main process to send on in order
+    '''
+    events = ListSink()
+    output = io.StringIO()
+    quality = QualityCounter()
+    with contextlib.redirect_stdout(output):
+        rows = extractrows(file, config, streaming, Metrics([events]), la, quality=quality)
+    return rows, quality, output.getvalue(), list(events)
+
+
+
+# --- Streaming mode ---
+
+def extractfile(file, config, tag_list=TAG_LIST, metrics=None, la=None, opener=open_input, quality=None):
+    '''
+    Degrades, cleans and flattens a CIN Census file in a single pass, one child at a time.
+    Each <Child> element is cleared once its rows are extracted, so memory is bounded by one child plus the rows.
+    Returns the same rows as degradefile, cleanfile and buildtree on the full tree.
+    The time spent parsing, degrading, cleaning and extracting is added up over the children, and sent as one metrics event each
+    The values not in the proper format are counted in quality (quality.QualityCounter), if given
+    '''
+    metrics = default_metrics(metrics)
+    rows = []
+    birthdates_found, birthdates_degraded, children = 0, 0, 0
+    NS = None
+    plan = compile_cleaningplan(config)
+    timer = StageTimer()
+    with opener(file) as f:
+        for _, child in etree.iterparse(f, events=('end',), tag='{*}Child'):
+            parent = child.getparent()
+            if not parent.tag.endswith('Children'):
+                continue
+            if NS is None:
+                NS = get_namespace(child.getroottree().getroot())
+            children += 1
+            timer.lap('parse')
+
+            # Degrade, clean and extract the child
+            found, degraded = degradeelement(child, NS)
+            birthdates_found += found
+            birthdates_degraded += degraded
+            timer.lap('degrade')
+            cleanchild(child, plan, quality)
+            timer.lap('clean')
+            child_rows = buildchild(child, tag_list, NS)
+            if child_rows is not None:
+                rows.extend(child_rows)
+
+            # Free the child, and the children already processed
+            child.clear(keep_tail=True)
+            while child.getprevious() is not None:
+                del parent[0]
+            timer.lap('extract')
+        timer.lap('parse')
+
+    counts = {
+        'parse': {'elements': children},
+        'degrade': {'elements': children, 'birthdates_found': birthdates_found, 'birthdates_degraded': birthdates_degraded},
+        'clean': {'elements': children},
+        'extract': {'elements': children, 'rows': len(rows)},
+    }
+    timer.record(metrics, counts, la=la, file=input_name(file))
+    if quality is not None:
+        quality.children += children
+
+    return rows
 
-        # Add col with LA name
-        flatfile['LA'] = la
 
-        # Save in output folder
-        flatfile.to_csv(os.path.join(output_folder, "{}_flatcin.csv".format(la)), index=False)
-    
-    return 
-    
-    
 
 # --- Degrade step ---
 
-def degradefile(file):
+def degradefile(file, metrics=None, la=None, opener=open_input):
     '''
     Degrades fields in the CIN Census. We are only degrading the birthdate here. We can adapt this function to degrade more fields.
     '''
+    metrics = default_metrics(metrics)
+    name = input_name(file)
 
     # Upload file and set root
-    tree = etree.parse(file)
-    root = tree.getroot()
-    NS = get_namespace(root)
+    with metrics.stage('parse', la=la, file=name) as event:
+        with opener(file) as f:
+            tree = etree.parse(f, base_url=file)
+        root = tree.getroot()
+        NS = get_namespace(root)
+        children = root.find('Children', NS)
+        event['elements'] = len(children) if children is not None else 0
+
+    # Degrade all birthdates
+    with metrics.stage('degrade', la=la, file=name, elements=event['elements']) as event:
+        event['birthdates_found'], event['birthdates_degraded'] = degradeelement(root, NS)
+    
+    return tree
+
+
+def degradeelement(element, NS):
+    '''
+    Degrades the birthdates found within element (a full tree root or a single child)
+    Returns the number of birthdates found and degraded
+    '''
 
     # Set counter to 0
     birthdates_degraded = 0
 
     # Find all birthdates
-    dates = root.findall('.//PersonBirthDate', NS)
+    dates = element.findall('.//PersonBirthDate', NS)
     for date in dates:
         if len(date.text) > 4: #if birthdate not degraded
             birthdate = date.text
@@ -97,12 +353,8 @@ def degradefile(file):
             etree.SubElement(parent, 'PersonSchoolYear').text = str(school_year)
             # Count changes done
             birthdates_degraded += 1              
-                
-        
-    changes = "{} PersonBirthDate events were found, of which {} were degraded to year of birth and school year".format(len(dates), birthdates_degraded)
-    print(changes)
-    
-    return tree
+
+    return len(dates), birthdates_degraded
 
 
 # Function to identify namespace
@@ -118,56 +370,76 @@ def get_namespace(root):
     return NS
 
 
+# Function to get the census ReferenceDate in the Header
+
+def get_referencedate(source):
+    '''
+    Returns the ReferenceDate of the census return, from the Header of a root element or of a file
+    Only the Header is parsed when reading from a file
+    '''
+    if etree.iselement(source):
+        header = [element for element in source if isinstance(element.tag, str) and element.tag.endswith('Header')]
+        elements = header[0].iter('{*}ReferenceDate') if len(header) > 0 else []
+    else:
+        elements = []
+        for event, element in etree.iterparse(source, events=('start', 'end')):
+            if event == 'start' and element.tag.endswith('Children'):
+                break
+            if event == 'end' and element.tag.endswith('ReferenceDate'):
+                elements = [element]
+                break
+    for element in elements:
+        if element.text is not None:
+            return element.text.strip()
+    return None
+
+
 # --- Clean step ---
 
 # Main cleaner function
 
-def cleanfile(tree, config):
-    ''' Takes tree from degradefile step and conducts simple cleaning checks'''
-    
+def cleanfile(tree, config, metrics=None, la=None, quality=None):
+    ''' Takes tree from degradefile step and conducts simple cleaning checks
+    The values not in the proper format are counted in quality (quality.QualityCounter), if given'''
+    metrics = default_metrics(metrics)
+    name = input_name(tree.docinfo.URL) if tree.docinfo.URL else None
+
     # Upload files and set root
-    root = tree.getroot()
-    NS = get_namespace(root)
-    children = root.find('Children', NS)
-    for child in children:
-        child = cleanchild(child, config)
+    with metrics.stage('clean', la=la, file=name) as event:
+        root = tree.getroot()
+        NS = get_namespace(root)
+        children = root.find('Children', NS)
+        plan = compile_cleaningplan(config)
+        for child in children:
+            child = cleanchild(child, plan, quality)
+        event['elements'] = len(children)
+        if quality is not None:
+            quality.children += len(children)
         
     return tree
 
 
 # Cleaner functions depending on XML tag for each file
+# The cleaning plan (see compile_cleaningplan) dispatches each tag to its cleaner function
 
-def cleanchild(value, config):
-    for group in value:
-        if group.tag.endswith('ChildIdentifiers'):
-            group = childidentifiers(group, config['ChildIdentifiers'])
-        elif group.tag.endswith('ChildCharacteristics'):
-            group = childcharacteristics(group, config['ChildCharacteristics'])
-        elif group.tag.endswith('CINdetails'):
-            group = cindetails(group, config['CINdetails'])
-    return value
+def cleanchild(value, config, quality=None):
+    return cleangroup(value, compile_cleaningplan(config), quality)
 
-# Child Identifiers functions
-def childidentifiers(value, config):
+def cleangroup(value, plan, quality=None):
     for group in value:
-        if group.tag.endswith('LAchildID'):
-            group = lachildid(group)
-        if group.tag.endswith('UPN'):
-            group = upn(group)
-        if group.tag.endswith('FormerUPN'):
-            group = formerupn(group)
-        if group.tag.endswith('UPNunknown'):
-            group = upnunknown(group, config['UPNunknown'])
-        if group.tag.endswith('PersonBirthDate'):
-            group = personbirthdate(group, config['PersonBirthDate'])
-        if group.tag.endswith('ExpectedPersonBirthDate'):
-            group = expectedpersonbirthdate(group, config['ExpectedPersonBirthDate'])
-        if group.tag.endswith('GenderCurrent'):
-            group = gendercurrent(group, config['GenderCurrent'])
-        if group.tag.endswith('PersonDeathDate'):
-            group = persondeathdate(group, config['PersonDeathDate'])
+        step = plan[group.tag]
+        if step is not None:
+            cleaner, config = step
+            if cleaner is cleangroup:
+                group = cleangroup(group, config, quality)
+            else:
+                group = cleaner(group, config)
+                # Count the values the cleaner could not read, for the data quality report
+                if quality is not None:
+                    quality.add_cleaned(group)
     return value
 
+# Child Identifiers functions
 def lachildid(value, config=None):
     if value.text is None:
         node = value.getparent()
@@ -245,14 +517,6 @@ def persondeathdate(value, config):
     return value
 
 # Child Characteristics functions
-def childcharacteristics(value, config):
-    for group in value:
-        if group.tag.endswith('Ethnicity'):
-            group = ethnicity(group, config['Ethnicity'])
-        if group.tag.endswith('Disabilities'):
-            group = disabilities(group, config['Disabilities'])
-    return value
-
 def ethnicity(value, config):
     if value.text is None:
         node = value.getparent()
@@ -262,14 +526,6 @@ def ethnicity(value, config):
         value.text = to_category(value.text, config['category'])
     return value
 
-def disabilities(value, config):
-    for group in value:
-        if group.tag.endswith('Disability'):
-            group = disability(group, config['Disability'])
-        else:
-            pass #Here add a flag if we are getting something else
-    return value
-
 def disability(value, config):
     if value.text is None:
         node = value.getparent()
@@ -280,30 +536,6 @@ def disability(value, config):
     return value
 
 # CIN Details functions
-def cindetails(value, config):
-    for group in value:
-        if group.tag.endswith('CINreferralDate'):
-            group = cinreferraldate(group, config['CINreferralDate'])
-        if group.tag.endswith('ReferralSource'):
-            group = referralsource(group, config['ReferralSource'])
-        if group.tag.endswith('PrimaryNeedCode'):
-            group = primaryneedcode(group, config['PrimaryNeedCode'])
-        if group.tag.endswith('CINclosureDate'):
-            group = cinclosuredate(group, config['CINclosureDate'])
-        if group.tag.endswith('ReasonForClosure'):
-            group = reasonforclosure(group, config['ReasonForClosure'])
-        if group.tag.endswith('ReferralNFA'):
-            group = referralnfa(group, config['ReferralNFA'])
-        if group.tag.endswith('DateOfInitialCPC'):
-            group = dateofinitialcpc(group, config['DateOfInitialCPC'])
-        if group.tag.endswith('Assessments'):
-            group = assessments(group, config['Assessments'])
-        if group.tag.endswith('Section47'):
-            group = section47(group, config['Section47'])
-        if group.tag.endswith('ChildProtectionPlans'):
-            group = childprotectionplans(group, config['ChildProtectionPlans'])
-    return value
-
 def cinreferraldate(value, config):
     if value.text is None:
         node = value.getparent()
@@ -367,18 +599,6 @@ def dateofinitialcpc(value, config):
         value.text = to_date(value.text, config['date'])
     return value
 
-def assessments(value, config):
-    for group in value:
-        if group.tag.endswith('AssessmentActualStartDate'):
-            group = assessmentactualstartdate(group, config['AssessmentActualStartDate'])
-        if group.tag.endswith('AssessmentInternalReviewDate'):
-            group = assessmentinternalreviewdate(group, config['AssessmentInternalReviewDate'])
-        if group.tag.endswith('AssessmentAuthorisationDate'):
-            group = assessmentauthorisationdate(group, config['AssessmentAuthorisationDate'])
-        if group.tag.endswith('FactorsIdentifiedAtAssessment'):
-            group = factorsidentifiedatassessment(group, config['FactorsIdentifiedAtAssessment'])
-    return value
-
 def assessmentactualstartdate(value, config):
     if value.text is None:
         node = value.getparent()
@@ -422,18 +642,6 @@ def factorsidentifiedatassessment(value, config):
         add_factor.text = factor
     return value     
 
-def section47(value, config):
-    for group in value:
-        if group.tag.endswith('S47ActualStartDate'):
-            group = s47actualstartdate(group, config['S47ActualStartDate'])
-        if group.tag.endswith('InitialCPCtarget'):
-            group = initialcpctarget(group, config['InitialCPCtarget'])
-        if group.tag.endswith('DateOfInitialCPC'):
-            group = dateofinitialcpc(group, config['DateOfInitialCPC'])
-        if group.tag.endswith('ICPCnotRequired'):
-            group = icpcnotrequired(group, config['ICPCnotRequired'])
-    return value
-
 def s47actualstartdate(value, config):
     if value.text is None:
         node = value.getparent()
@@ -449,15 +657,6 @@ def initialcpctarget(value, config):
         value.text = to_date(value.text, config['date'])
     return value
 
-def dateofinitialcpc(value, config):
-    if value.text is None:
-        node = value.getparent()
-        node.remove(value)
-    else:
-        value.text = value.text.strip()
-        value.text = to_date(value.text, config['date'])
-    return value
-
 def icpcnotrequired(value, config):
     if value.text is None:
         node = value.getparent()
@@ -467,22 +666,6 @@ def icpcnotrequired(value, config):
         value.text = to_category(value.text, config['category'])
     return value
 
-def childprotectionplans(value, config):
-    for group in value:
-        if group.tag.endswith('CPPstartDate'):
-            group = cppstartdate(group, config['CPPstartDate'])
-        if group.tag.endswith('InitialCategoryOfAbuse'):
-            group = initialcategoryofabuse(group, config['InitialCategoryOfAbuse'])
-        if group.tag.endswith('LatestCategoryOfAbuse'):
-            group = latestcategoryofabuse(group, config['LatestCategoryOfAbuse'])
-        if group.tag.endswith('NumberOfPreviousCPP'):
-            group = numberofpreviouscpp(group)
-        if group.tag.endswith('CPPendDate'):
-            group = cppenddate(group, config['CPPendDate'])
-        if group.tag.endswith('Reviews'):
-            group = reviews(group, config['Reviews'])
-    return value
-
 def cppstartdate(value, config):
     if value.text is None:
         node = value.getparent()
@@ -525,14 +708,6 @@ def cppenddate(value, config):
         value.text = to_date(value.text, config['date'])
     return value
 
-def reviews(value, config):
-    for group in value:
-        if group.tag.endswith('CPPreviewDate'):
-            group = cppreviewdate(group, config['CPPreviewDate'])
-        else:
-            pass # if time, flag whatever else we find here
-    return value
-
 def cppreviewdate(value, config):
     if value.text is None:
         node = value.getparent()
@@ -543,26 +718,164 @@ def cppreviewdate(value, config):
     return value
 
 
+# Cleaning plan: which cleaner function to run on each tag, within each group of tags
+# The groups follow the structure of cin_datamap.yaml
+
+CLEANERS = {
+    'ChildIdentifiers': {
+        'LAchildID': lachildid,
+        'UPN': upn,
+        'FormerUPN': formerupn,
+        'UPNunknown': upnunknown,
+        'PersonBirthDate': personbirthdate,
+        'ExpectedPersonBirthDate': expectedpersonbirthdate,
+        'GenderCurrent': gendercurrent,
+        'PersonDeathDate': persondeathdate,
+    },
+    'ChildCharacteristics': {
+        'Ethnicity': ethnicity,
+        'Disabilities': {
+            'Disability': disability,
+        },
+    },
+    'CINdetails': {
+        'CINreferralDate': cinreferraldate,
+        'ReferralSource': referralsource,
+        'PrimaryNeedCode': primaryneedcode,
+        'CINclosureDate': cinclosuredate,
+        'ReasonForClosure': reasonforclosure,
+        'ReferralNFA': referralnfa,
+        'DateOfInitialCPC': dateofinitialcpc,
+        'Assessments': {
+            'AssessmentActualStartDate': assessmentactualstartdate,
+            'AssessmentInternalReviewDate': assessmentinternalreviewdate,
+            'AssessmentAuthorisationDate': assessmentauthorisationdate,
+            'FactorsIdentifiedAtAssessment': factorsidentifiedatassessment,
+        },
+        'Section47': {
+            'S47ActualStartDate': s47actualstartdate,
+            'InitialCPCtarget': initialcpctarget,
+            'DateOfInitialCPC': dateofinitialcpc,
+            'ICPCnotRequired': icpcnotrequired,
+        },
+        'ChildProtectionPlans': {
+            'CPPstartDate': cppstartdate,
+            'InitialCategoryOfAbuse': initialcategoryofabuse,
+            'LatestCategoryOfAbuse': latestcategoryofabuse,
+            'NumberOfPreviousCPP': numberofpreviouscpp,
+            'CPPendDate': cppenddate,
+            'Reviews': {
+                'CPPreviewDate': cppreviewdate,
+            },
+        },
+    },
+}
+
+
+class CleaningPlan(dict):
+    '''
+    Tag -> (cleaner function, config) dispatch table for one group of tags, compiled from cin_datamap.yaml
+    Tags are looked up with their namespace: the first time a tag is seen, it is matched on its local name
+    and the result is stored (None if there is no cleaner), so that cleaning costs one dict lookup per element
+    '''
+    def __missing__(self, tag):
+        if not isinstance(tag, str): # comments and processing instructions
+            return None
+        localname = tag.rpartition('}')[2]
+        step = dict.get(self, localname)
+        self[tag] = step
+        return step
+
+
+def compile_cleaningplan(config, cleaners=CLEANERS):
+    '''
+    Compiles the config (cin_datamap.yaml) into a CleaningPlan, once per run
+    Category lists are turned into CategoryLookup for fast matching
+    A CleaningPlan passed as config is returned as is
+    '''
+    if isinstance(config, CleaningPlan):
+        return config
+    plan = CleaningPlan()
+    for tag, cleaner in cleaners.items():
+        if isinstance(cleaner, dict):
+            plan[tag] = (cleangroup, compile_cleaningplan(config[tag], cleaner))
+        else:
+            plan[tag] = (cleaner, compile_config(config.get(tag)))
+    return plan
+
+
+def compile_config(config):
+    '''
+    Copies a field's config, replacing the category lists with CategoryLookup
+    '''
+    if not isinstance(config, dict):
+        return config
+    compiled = {}
+    for key, value in config.items():
+        if key == 'category':
+            compiled[key] = CategoryLookup(value)
+        else:
+            compiled[key] = compile_config(value)
+    return compiled
+
+
+class CategoryLookup:
+    '''
+    Precomputed version of a category list from the config, giving the same result as scanning the list:
+    the first category whose code is the value, or whose name is in the value (not case sensitive)
+    Results are memoized, as the same raw values come up again and again
+    '''
+    max_cached = 10000
+
+    def __init__(self, categories):
+        self.categories = categories
+        self.codes = {} # lower case code -> (position in the list, code)
+        self.names = [] # (position in the list, lower case name, code)
+        for position, category in enumerate(categories):
+            self.codes.setdefault(str(category['code']).lower(), (position, category['code']))
+            if 'name' in category:
+                self.names.append((position, str(category['name']).lower(), category['code']))
+        self.cache = {}
+
+    def lookup(self, string):
+        try:
+            return self.cache[string]
+        except KeyError:
+            pass
+        value = str(string).lower()
+        position, result = self.codes.get(value, (len(self.categories), '{}{}'.format(NOT_IN_PROPER_FORMAT, string)))
+        # A name matching earlier in the list wins over the exact code
+        for name_position, name, code in self.names:
+            if name_position >= position:
+                break
+            if name in value:
+                result = code
+                break
+        if len(self.cache) < self.max_cached:
+            self.cache[string] = result
+        return result
+
+
 # Generic cleaner functions
 
 def to_category(string, categories):
-    for code in categories:
-        if str(string).lower() == str(code['code']).lower():
-            return code['code']
-        elif 'name' in code:
-            if str(code['name']).lower() in str(string).lower():
-                return code['code']
-    return 'Not in proper format: {}'.format(string)
-    # If time, add here the matching report
+    if not isinstance(categories, CategoryLookup):
+        categories = CategoryLookup(categories)
+    return categories.lookup(string)
 
 def to_date(string, dateformat):
     string = string.replace('/', '-')
+    if not is_date(string, dateformat):
+        string = '{}{}'.format(NOT_IN_PROPER_FORMAT, string)
+    return string
+
+@lru_cache(maxsize=65536)
+def is_date(string, dateformat):
     try:
         datetime.strptime(string, dateformat) # Check this is possible
-    except:
-        string = 'Not in proper format: {}'.format(string)
-    return string
-    # If time, add here the matching report
+    except (ValueError, TypeError):
+        return False
+    return True
     
 
         
@@ -572,58 +885,116 @@ def to_date(string, dateformat):
 # We recommend including all of the events into the cin log: it is the default list included below in build_cinrecord
 # You can edit if you only need certain events
 
-def build_cinrecord(trees, tag_list=['CINreferralDate', 'CINclosureDate', 'DateOfInitialCPC',
-                                                        'AssessmentActualStartDate', 'AssessmentAuthorisationDate', 'S47ActualStartDate', 
-                                                        'CPPstartDate', 'CPPendDate']):
-    data_list = []
-    for i, tree in enumerate(trees):
-        # Upload trees and set root
-        root = tree.getroot()
-        NS = get_namespace(root)
-        children = root.find('Children', NS)
+def build_cinrecord(trees, tag_list=TAG_LIST, tiebreak='first', metrics=None, la=None):
+    metrics = default_metrics(metrics)
+    records = EventDeduplicator(tiebreak)
+    for tree in trees:
+        name = input_name(tree.docinfo.URL) if tree.docinfo.URL else None
         # Get data
-        print('Extracting data from file {} out of {} from CIN Census'.format(i+1, len(trees)))
-        file_data = buildchildren(children, tag_list, NS)
-        data_list.append(file_data)
-    cinrecord = pd.concat(data_list, sort=False)
+        with metrics.stage('extract', la=la, file=name) as event:
+            rows = buildtree(tree, tag_list)
+            event['rows'] = len(rows)
+        with metrics.stage('dedup', la=la, file=name, rows=len(rows)) as event:
+            records.add(rows, get_referencedate(tree.getroot()))
+            event['unique_rows'] = len(records.records)
+    with metrics.stage('flatfile', la=la) as event:
+        cinrecord = rows_to_cinrecord(records)
+        event['rows'] = len(cinrecord)
+    return cinrecord
+
 
+def rows_to_cinrecord(rows, tiebreak='first'):
+    '''
+    Builds the LA dataframe from the rows extracted from all its files (or from an EventDeduplicator they were added to)
+    '''
     # Remove duplicates of LAchildID, Date and Type - we keep the one with the least null values
-    cinrecord['null_values'] = cinrecord.isnull().sum(axis=1)
-    cinrecord = cinrecord.sort_values('null_values')
-    cinrecord.drop_duplicates(subset=['LAchildID', 'Date', 'Type'], keep='first', inplace=True)
-    cinrecord.drop(labels='null_values', axis=1, inplace=True)
+    if isinstance(rows, EventDeduplicator):
+        records = rows
+    else:
+        records = EventDeduplicator(tiebreak)
+        records.add(rows)
+    cinrecord = pd.DataFrame(records.rows(), columns=list(records.columns))
 
     # Re-arrange columns
     firstcols = ['LAchildID', 'Date', 'Type']
     newcols = firstcols + [col for col in list(cinrecord.columns) if col not in firstcols]
     cinrecord = cinrecord[newcols]
-
-    print('Done!')
     
     return cinrecord
 
 
+class EventDeduplicator:
+    '''
+    Removes duplicates of LAchildID, Date and Type as the rows of each file arrive, with a hash map on those keys
+    We keep the most complete row (the one with the least null values). When rows are as complete:
+    - tiebreak='first': the row seen first is kept
+    - tiebreak='latest': the row from the latest census return is kept (latest ReferenceDate, then file added last)
+    Rows are kept in the order their key was first seen
+    '''
 
-# Functions to build dataframes containing information of the child within each file
+    def __init__(self, tiebreak='first'):
+        if tiebreak not in ('first', 'latest'):
+            raise ValueError("tiebreak must be 'first' or 'latest', not {}".format(tiebreak))
+        self.tiebreak = tiebreak
+        self.records = {} # key -> (number of non null values, census rank, row)
+        self.columns = {} # all the columns seen, in order of appearance
+        self.files = 0
+
+    def add(self, rows, referencedate=None):
+        '''
+        Adds the rows of one file, with the ReferenceDate of its census return
+        '''
+        self.files += 1
+        census = (referencedate or '', self.files)
+        latest = self.tiebreak == 'latest'
+        for row in rows:
+            self.columns.update(dict.fromkeys(row))
+            key = (row.get('LAchildID'), row['Date'], row['Type'])
+            completeness = sum(value is not None for value in row.values())
+            current = self.records.get(key)
+            if current is None or completeness > current[0] or \
+            (latest and completeness == current[0] and census > current[1]):
+                self.records[key] = (completeness, census, row)
+
+    def rows(self):
+        return [row for _, _, row in self.records.values()]
+
+
+def buildtree(tree, tag_list):
+    '''
+    Returns the rows of all the children in a (degraded and cleaned) tree
+    '''
+    # Upload tree and set root
+    root = tree.getroot()
+    NS = get_namespace(root)
+    children = root.find('Children', NS)
+    return buildchildren(children, tag_list, NS)
+
+
+
+# Functions to build the rows containing information of the child within each file
+# Rows are plain dicts: the dataframe is only built once, at LA level, in build_cinrecord
 
 def buildchildren(children, tag_list, NS):
-    df_list = []
+    rows = []
     for child in children:
-        data = buildchild(child, tag_list, NS)
-        df_list.append(data)
-    children_data = pd.concat(df_list, sort=False)    
-    return children_data
+        child_rows = buildchild(child, tag_list, NS)
+        if child_rows is not None:
+            rows.extend(child_rows)
+    return rows
 
 
 def buildchild(child, tag_list, NS):
     '''
-    Creates a dataframe storing all the events (specified in tag_list) that happened to the child
+    Creates the list of rows storing all the events (specified in tag_list) that happened to the child
+    Each row is a dict, with the child identifiers and characteristics attached
     Pass if no ChildIdentifiers, ChildCharacteristics and CINdetails
     '''
-    df_list = []
-    if 'ChildIdentifiers' in get_childrentags(child) and \
-    'ChildCharacteristics' in get_childrentags(child) and \
-    'CINdetails' in get_childrentags(child):
+    event_list = []
+    childrentags = get_childrentags(child)
+    if 'ChildIdentifiers' in childrentags and \
+    'ChildCharacteristics' in childrentags and \
+    'CINdetails' in childrentags:
         for group in child:
             if group.tag.endswith('ChildIdentifiers'):
                 childidentifiers = get_ChildIdentifiers(group)
@@ -631,20 +1002,35 @@ def buildchild(child, tag_list, NS):
                 childcharacteristics = get_ChildCharacteristics(group, NS)
             if group.tag.endswith('CINdetails'):
                 for tag in tag_list:
-                    event_list = group.findall('.//{}'.format(tag), NS)
-                    for event in event_list:
-                        event_group = get_group(event, NS)
-                        df = pd.DataFrame(event_group)
-                        df_list.append(df)        
-        child_data = pd.concat(df_list, sort=False)
-        for key, value in childidentifiers.items() :
-            child_data[key] = value
-        for key, value in childcharacteristics.items() :
-            child_data[key] = value
+                    for event in group.findall('.//{}'.format(tag), NS):
+                        event_list.append(get_group(event, NS))
+        if len(event_list) == 0:
+            return None
+
+        # Columns of the child, in order of appearance: events first, then identifiers and characteristics
+        # All the child's rows carry all the columns so that the LA dataframe keeps the same column order
+        columns = {}
+        for event in event_list:
+            columns.update(dict.fromkeys(event))
+        columns.update(dict.fromkeys(childidentifiers))
+        columns.update(dict.fromkeys(childcharacteristics))
+        child_rows = []
+        for event in event_list:
+            row = dict.fromkeys(columns)
+            row.update(event)
+            row.update(childidentifiers)
+            row.update(childcharacteristics)
+            child_rows.append(row)
+
         # Fill forward the referral source, to make sure all events can be linked to the original referral partner
-        if 'ReferralSource' in child_data.columns:
-            child_data['ReferralSource'].fillna(method='ffill', inplace=True)
-        return(child_data)
+        if 'ReferralSource' in columns:
+            referralsource = None
+            for row in child_rows:
+                if row['ReferralSource'] is None:
+                    row['ReferralSource'] = referralsource
+                else:
+                    referralsource = row['ReferralSource']
+        return child_rows
     
     return None
 
@@ -700,7 +1086,7 @@ def get_group(element, NS):
         if len(sibling.getchildren())==0: # if siblings don't have children, just get their value
             column = etree.QName(sibling).localname
             value = sibling.text
-            group[column] = [value]
+            group[column] = value
     # If we're in the Assessment or ChildProtectionPlans modules, we need to get down one level
     # to collect all AssessmentFactors and CPPreviewDate
     if element.getparent().tag.endswith('Assessments'):
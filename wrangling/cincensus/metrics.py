@@ -0,0 +1,254 @@
+'''Structured metrics of each step: timings, rows processed, throughput and memory, per LA and per file
+
+Each stage (and sub-stage: parse, degrade, clean, extract, dedup, write...) sends an event, a dict with:
+- stage, la, file
+- wall_s and cpu_s: wall clock and CPU time of the stage
+- rows and/or elements: rows output, XML elements (children) processed
+- rows_per_s / elements_per_s: throughput
+- rss_mb and peak_rss_mb: resident memory of the process at the end of the stage, and its peak so far
+Events go to sinks: any function taking the event, e.g. PrintSink (default), LoggingSink, JsonLinesSink or ListSink
+
+Metrics can also profile one LA, with cProfile or tracemalloc, to see where its time or memory goes
+'''
+import contextlib
+import cProfile
+import datetime
+import io
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+
+class Metrics:
+    '''
+    Sends the events of the stages to the sinks
+    - sinks: list of sinks (default: PrintSink)
+    - profile_la: LA to profile, with profile = 'cprofile' or 'tracemalloc'
+      The profile is saved in profile_folder (default: current folder) as <LA>.prof (open with pstats or snakeviz)
+      or <LA>.tracemalloc.txt, and a summary is sent as a 'profile' event
+    '''
+
+    def __init__(self, sinks=None, profile_la=None, profile='cprofile', profile_folder=None):
+        if profile not in ('cprofile', 'tracemalloc'):
+            raise ValueError("profile must be 'cprofile' or 'tracemalloc', not {}".format(profile))
+        self.sinks = [PrintSink()] if sinks is None else list(sinks)
+        self.profile_la = profile_la
+        self.profile_mode = profile
+        self.profile_folder = profile_folder or os.getcwd()
+
+    def emit(self, event):
+        for sink in self.sinks:
+            sink(event)
+
+    def record(self, stage, wall_s, cpu_s, **fields):
+        '''
+        Sends the event of a stage which has been timed already
+        '''
+        event = {'time': datetime.datetime.now().isoformat(timespec='seconds'), 'stage': stage}
+        event.update(fields)
+        event['wall_s'] = round(wall_s, 4)
+        event['cpu_s'] = round(cpu_s, 4)
+        for count in ('rows', 'elements'):
+            if event.get(count) is not None and wall_s > 0:
+                event['{}_per_s'.format(count)] = round(event[count] / wall_s, 1)
+        event['rss_mb'] = to_mb(resident_memory())
+        event['peak_rss_mb'] = to_mb(peak_resident_memory())
+        self.emit(event)
+        return event
+
+    @contextlib.contextmanager
+    def stage(self, stage, **fields):
+        '''
+        Times the block and sends its event. The block can add counts to the event it gets, e.g. event['rows'] = len(rows)
+        '''
+        event = dict(fields)
+        wall, cpu = time.perf_counter(), time.process_time()
+        yield event
+        self.record(stage, time.perf_counter() - wall, time.process_time() - cpu, **event)
+
+    @contextlib.contextmanager
+    def profile(self, la):
+        '''
+        Profiles the block if la is the LA to profile
+        '''
+        if la is None or la != self.profile_la:
+            yield
+            return
+        os.makedirs(self.profile_folder, exist_ok=True)
+        if self.profile_mode == 'cprofile':
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                path = os.path.join(self.profile_folder, '{}.prof'.format(la))
+                profiler.dump_stats(path)
+                summary = io.StringIO()
+                pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(15)
+                self.emit({'stage': 'profile', 'la': la, 'profile': 'cprofile', 'path': path, 'summary': summary.getvalue()})
+        else:
+            tracemalloc.start(10)
+            try:
+                yield
+            finally:
+                snapshot = tracemalloc.take_snapshot()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                top = snapshot.statistics('lineno')[:15]
+                path = os.path.join(self.profile_folder, '{}.tracemalloc.txt'.format(la))
+                with open(path, 'w') as f:
+                    f.write('\n'.join(str(stat) for stat in snapshot.statistics('traceback')[:50]))
+                self.emit({'stage': 'profile', 'la': la, 'profile': 'tracemalloc', 'path': path,
+                           'peak_traced_mb': to_mb(peak), 'summary': '\n'.join(str(stat) for stat in top)})
+
+
+class StageTimer:
+    '''
+    Accumulates the wall and CPU time of sub-stages which alternate many times, e.g. degrade, clean and extract
+    for each child of a file, to send one event per sub-stage at the end
+    '''
+
+    def __init__(self):
+        self.times = {}
+        self.wall, self.cpu = time.perf_counter(), time.process_time()
+
+    def lap(self, stage):
+        '''
+        Adds the time since the previous lap to stage
+        '''
+        wall, cpu = time.perf_counter(), time.process_time()
+        total = self.times.setdefault(stage, [0.0, 0.0])
+        total[0] += wall - self.wall
+        total[1] += cpu - self.cpu
+        self.wall, self.cpu = wall, cpu
+
+    def record(self, metrics, counts=None, **fields):
+        '''
+        Sends one event per sub-stage, with its counts (stage -> dict of counts)
+        '''
+        for stage, (wall_s, cpu_s) in self.times.items():
+            metrics.record(stage, wall_s, cpu_s, **fields, **(counts or {}).get(stage, {}))
+
+
+def default_metrics(metrics=None):
+    return Metrics() if metrics is None else metrics
+
+
+# --- Sinks ---
+
+class PrintSink:
+    '''
+    Prints one line per event, for the notebooks
+    '''
+
+    def __call__(self, event):
+        print(format_event(event))
+
+
+class LoggingSink:
+    '''
+    Logs one line per event, with the event in the extra 'metrics' attribute of the log record
+    '''
+
+    def __init__(self, logger='wrangling.cincensus', level=logging.INFO):
+        self.logger = logging.getLogger(logger) if isinstance(logger, str) else logger
+        self.level = level
+
+    def __call__(self, event):
+        self.logger.log(self.level, format_event(event), extra={'metrics': event})
+
+
+class JsonLinesSink:
+    '''
+    Appends each event as a line of JSON to a file
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, event):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(event, default=str) + '\n')
+
+
+class ListSink(list):
+    '''
+    Keeps the events in a list, e.g. to send them back from a worker process
+    '''
+
+    def __call__(self, event):
+        self.append(event)
+
+
+def format_event(event):
+    where = ' '.join(str(event[key]) for key in ('la', 'file') if event.get(key) is not None)
+    if event['stage'] == 'profile':
+        return "{} --- Profile ({}) saved in {}\n{}".format(where, event['profile'], event['path'], event['summary'])
+    counts = ', '.join('{} {}'.format(event[key], key) for key in ('rows', 'elements') if event.get(key) is not None)
+    line = "{} --- {}: {:.2f}s (CPU {:.2f}s)".format(where, event['stage'], event['wall_s'], event['cpu_s'])
+    if counts:
+        line += ', ' + counts
+    if event.get('peak_rss_mb') is not None:
+        line += ', peak memory {} MB'.format(event['peak_rss_mb'])
+    return line.strip()
+
+
+# --- Memory ---
+
+def to_mb(size):
+    return None if size is None else round(size / 2 ** 20, 1)
+
+
+def resident_memory():
+    '''
+    Resident memory of this process in bytes, None if it cannot be read (it is read from /proc, on Linux)
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_resident_memory():
+    '''
+    Peak resident memory of this process so far in bytes, None if it cannot be read
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+class MemorySampler:
+    '''
+    Samples the resident memory in a thread until stop(), which returns the peak above the memory at the start
+    '''
+
+    def __init__(self, interval=0.005):
+        self.start = self.peak = resident_memory()
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, resident_memory())
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, resident_memory())
+        return self.peak - self.start
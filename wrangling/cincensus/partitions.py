@@ -0,0 +1,57 @@
+'''Step 3 on a partitioned main_flatcin, one partition at a time
+
+The step 3 tables only ever link the events of the same child, so they can be built on each partition of main_flatcin
+(one LA, or one share of the children: see split_by_child) and put together, giving the same rows as on the whole table.
+The builders (assessment_factors, referral_journeys, s47_journeys, cin_episodes, cpp_episodes) do this when their input
+is a partitioned flat file (a folder, see concat --partitioned), with map_partitions:
+- workers=1: the partitions are processed one after the other, so memory is bounded by one partition (and the results)
+- workers > 1: the partitions are processed in a pool of worker processes
+'''
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from wrangling.cincensus.star import is_star
+from wrangling.cincensus.storage import FlatfileWriter, iter_flatfile, partition_files, read_columns
+
+
+def is_partitioned(input_file):
+    # A main_star folder is not partitioned: its files are the tables of the star schema
+    return os.path.isdir(input_file) and not is_star(input_file)
+
+
+def map_partitions(builder, input_file, workers=1, **kwargs):
+    '''
+    Runs builder(partition, **kwargs) on each partition of a partitioned flat file, returns the tables in partition order
+    '''
+    partitions = partition_files(input_file)
+    if workers <= 1 or len(partitions) <= 1:
+        return [builder(partition, **kwargs) for partition in partitions]
+    with ProcessPoolExecutor(max_workers=min(workers, len(partitions))) as pool:
+        futures = [pool.submit(builder, partition, **kwargs) for partition in partitions]
+        return [future.result() for future in futures]
+
+
+def split_by_child(input_file, output_folder, partitions=8, output_format='csv', chunksize=100000):
+    '''
+    Splits a flat file (e.g. main_flatcin) into partitions by a hash of LA and LAchildID, copied chunk by chunk:
+    all the events of a child end up in the same partition (output_folder/part-000.csv...), which the step 3 builders
+    can then process one at a time (see map_partitions). Use it when one LA is too big to be processed at once
+    Returns the paths of the partitions
+    '''
+    os.makedirs(output_folder, exist_ok=True)
+    columns = read_columns(input_file)
+    names = ['part-{:03d}'.format(i) for i in range(partitions)]
+    writers = [FlatfileWriter(output_folder, name, columns, output_format) for name in names]
+    try:
+        for chunk in iter_flatfile(input_file, chunksize):
+            # The hash is stable from one run to the next
+            keys = chunk['LA'].astype(str) + '/' + chunk['LAchildID'].astype(str)
+            partition = pd.util.hash_pandas_object(keys, index=False).values % partitions
+            for i, writer in enumerate(writers):
+                writer.write(chunk[partition == i])
+    finally:
+        for writer in writers:
+            writer.close()
+    return [writer.path for writer in writers]
@@ -0,0 +1,297 @@
+'''Headless pipeline: runs steps 1 to 3 as stages, skipping the stages whose inputs, parameters and code have not changed
+
+    main (step 1) -> concat (step 2) -> assessment factors, referral journeys, S47 journeys, CIN and CPP episodes (step 3)
+
+The state of the last run (fingerprint of each stage, content hash of each input file) is saved in a JSON file,
+so a refresh only runs the stages affected by what changed
+'''
+import hashlib
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import pandas as pd
+
+from wrangling.cincensus.cache import file_hash, write_atomic
+from wrangling.cincensus.concat import concat, find_flatfiles
+from wrangling.cincensus.config import DEFAULT_CONFIG, load_config
+from wrangling.cincensus.episodes import cin_episodes, cpp_episodes
+from wrangling.cincensus.factors import assessment_factors
+from wrangling.cincensus.journeys import referral_journeys, s47_sankey
+from wrangling.cincensus.main import main
+from wrangling.cincensus.star import write_star
+from wrangling.cincensus.storage import arrow_path, flatfile_path
+
+
+class Stage:
+    '''
+    A step of the pipeline: func(**params, **options) is run if the stage is out of date
+    - params: arguments the outputs depend on, part of the fingerprint
+    - options: arguments which do not change the outputs (e.g. workers), not part of the fingerprint
+    - inputs: files or folders read by the stage (or a function returning them, evaluated when the upstream stages are done)
+    - outputs: files or folders written by the stage; the stage is run again if one is missing
+    - after: names of the stages to run before this one
+    - modules: modules of this package whose code is part of the stage (a change to them runs the stage again)
+    '''
+
+    def __init__(self, name, func, inputs=(), outputs=(), params=None, options=None, after=(), modules=()):
+        self.name = name
+        self.func = func
+        self.inputs = inputs
+        self.outputs = list(outputs)
+        self.params = params or {}
+        self.options = options or {}
+        self.after = list(after)
+        self.modules = list(modules)
+
+    def input_files(self):
+        inputs = self.inputs() if callable(self.inputs) else self.inputs
+        files = []
+        for path in inputs:
+            if os.path.isdir(path):
+                for folder, _, names in os.walk(path):
+                    files += [os.path.join(folder, name) for name in names]
+            elif os.path.exists(path):
+                files.append(path)
+        return sorted(files)
+
+    def run(self):
+        return self.func(**self.params, **self.options)
+
+
+class Pipeline:
+    '''
+    Runs stages in order of their dependencies, skipping those which are up to date
+    With workers > 1, stages which do not depend on each other (e.g. the step 3 stages) run concurrently in worker processes
+    '''
+
+    def __init__(self, stages, state_file):
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_file = state_file
+        for stage in stages:
+            unknown = [name for name in stage.after if name not in self.stages]
+            if unknown:
+                raise ValueError("Stage {} runs after unknown stages {}".format(stage.name, unknown))
+
+    def load_state(self):
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'stages': {}, 'files': {}}
+
+    def save_state(self, state):
+        write_atomic(self.state_file, json.dumps(state, indent=1, sort_keys=True).encode('utf-8'))
+
+    def content_hash(self, file, state):
+        '''
+        Content hash of a file, only recomputed when its size or modification time changed since the last run
+        '''
+        stat = os.stat(file)
+        known = state['files'].get(file)
+        if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return known[2]
+        sha = file_hash(file)
+        state['files'][file] = [stat.st_size, stat.st_mtime_ns, sha]
+        return sha
+
+    def fingerprint(self, stage, state):
+        '''
+        Hash of what the stage's outputs depend on: its parameters, code and input files
+        '''
+        sha = hashlib.sha256()
+        sha.update(json.dumps(stage.params, sort_keys=True, default=describe).encode('utf-8'))
+        for module in stage.modules:
+            with open(os.path.join(os.path.dirname(__file__), module), 'rb') as f:
+                sha.update(f.read())
+        for file in stage.input_files():
+            sha.update('{}:{}\n'.format(file, self.content_hash(file, state)).encode('utf-8'))
+        return sha.hexdigest()
+
+    def is_current(self, stage, fingerprint, state):
+        return (state['stages'].get(stage.name) == fingerprint
+                and all(os.path.exists(output) for output in stage.outputs))
+
+    def run(self, workers=1, force=False):
+        '''
+        Runs the out of date stages (all stages with force=True)
+        Returns the names of the stages run. If a stage fails, the stages depending on it are not run and the error is raised
+        once the running stages are done
+        '''
+        state = self.load_state()
+        done, failed, ran = set(), {}, []
+        pending = list(self.stages)
+        running = {}
+        pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        try:
+            while pending or running:
+                # Start the stages whose upstream stages are done
+                for name in list(pending):
+                    stage = self.stages[name]
+                    if any(upstream in failed for upstream in stage.after):
+                        print("Stage {}: not run, an upstream stage failed".format(name))
+                        pending.remove(name)
+                        failed[name] = None
+                        continue
+                    if not all(upstream in done for upstream in stage.after):
+                        continue
+                    pending.remove(name)
+                    fingerprint = self.fingerprint(stage, state)
+                    if not force and self.is_current(stage, fingerprint, state):
+                        print("Stage {}: up to date".format(name))
+                        done.add(name)
+                    elif pool is None or (not running and not self.startable(pending, done)):
+                        # Alone: run in this process, so that the stage can use its own workers
+                        print("Stage {}: running".format(name))
+                        self.finish(name, fingerprint, stage.run, state, done, failed, ran)
+                    else:
+                        print("Stage {}: running".format(name))
+                        running[pool.submit(stage.func, **stage.params, **stage.options)] = (name, fingerprint)
+
+                if not running:
+                    if pending and not self.startable(pending, done | set(failed)):
+                        raise ValueError("Stages {} depend on each other".format(pending))
+                    continue
+
+                # Wait for a stage to finish
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name, fingerprint = running.pop(future)
+                    self.finish(name, fingerprint, future.result, state, done, failed, ran)
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+            self.save_state(state)
+
+        errors = [error for error in failed.values() if error is not None]
+        if errors:
+            raise errors[0]
+        return ran
+
+    def startable(self, pending, done):
+        '''
+        True if a pending stage could start now, i.e. all its upstream stages are done
+        '''
+        return any(all(upstream in done for upstream in self.stages[name].after) for name in pending)
+
+    def finish(self, name, fingerprint, result, state, done, failed, ran):
+        try:
+            result()
+        except Exception as error:
+            print("Stage {}: failed ({!r})".format(name, error))
+            failed[name] = error
+            state['stages'].pop(name, None)
+            return
+        print("Stage {}: done".format(name))
+        state['stages'][name] = fingerprint
+        done.add(name)
+        ran.append(name)
+
+
+def describe(value):
+    '''
+    Stable description of a parameter for the fingerprint: functions by their name, other values as text
+    '''
+    if callable(value):
+        return '{}.{}'.format(value.__module__, value.__qualname__)
+    return str(value)
+
+
+# --- The CIN Census pipeline ---
+
+def save_table(builder, output_file, **kwargs):
+    '''
+    Builds a step 3 table with builder(**kwargs) and saves it as csv
+    '''
+    table = builder(**kwargs)
+    table.to_csv(output_file, index=False)
+
+
+def cin_pipeline(main_folder, cin_census_close, config_file=DEFAULT_CONFIG, flatfile_format='csv', workers=1,
+                 cache_folder=None, tiebreak='first', match_how='first', state_file=None, metrics=None,
+                 event_store=None, sankey_counts=True, partitioned=False, partition_workers=1,
+                 arrow=False, star=False):
+    '''
+    The CIN Census pipeline, with the folders of 00-config under main_folder:
+    cincensus (input), flatfiles and outputs
+    By default the extraction cache is kept in main_folder/cache and the pipeline state in main_folder/pipeline_state.json
+    metrics (metrics.Metrics) gets the events of steps 1 and 2
+    event_store: path of an SQLite database to write the events to, in step 2 (see eventstore.py)
+    sankey_counts: save the S47 Sankey as counts per Source, Destination and demographics (default), or one row per journey step
+    partitioned: save main_flatcin as a folder of one file per LA, where only the LAs whose flat file changed are written again
+    partition_workers: worker processes for each step 3 table, over the partitions of main_flatcin (see partitions.py)
+    arrow: also save main_flatcin as an Arrow file, memory-mapped by the step 3 tables (see concat_arrow)
+    star: also save the events as a star schema in flatfiles/main_star, which the step 3 tables are then built from (see star.py)
+    '''
+    cin_folder = os.path.join(main_folder, 'cincensus')
+    flatfile_folder = os.path.join(main_folder, 'flatfiles')
+    output_folder = os.path.join(main_folder, 'outputs')
+    cache_folder = cache_folder or os.path.join(main_folder, 'cache')
+    state_file = state_file or os.path.join(main_folder, 'pipeline_state.json')
+    for folder in [flatfile_folder, output_folder]:
+        os.makedirs(folder, exist_ok=True)
+
+    main_flatcin = flatfile_path(flatfile_folder, 'main_flatcin', flatfile_format, partitioned)
+    cin_census_close = pd.Timestamp(cin_census_close)
+    main_star = os.path.join(flatfile_folder, 'main_star')
+    main_arrow = arrow_path(flatfile_folder, 'main_flatcin')
+    step3_input, step3_after = (main_star, 'star') if star else (main_arrow if arrow else main_flatcin, 'concat')
+    step3_modules = ['journeys.py', 'factors.py', 'partitions.py', 'star.py', 'storage.py', 'schema.py']
+
+    stages = [
+        Stage('main', main_stage, inputs=[cin_folder, config_file], outputs=[flatfile_folder],
+              params=dict(input_folder=cin_folder, output_folder=flatfile_folder, config_file=config_file,
+                          output_format=flatfile_format, tiebreak=tiebreak),
+              options=dict(workers=workers, cache_folder=cache_folder, metrics=metrics),
+              modules=['main.py', 'factors.py', 'quality.py', 'storage.py', 'schema.py']),
+        Stage('concat', concat, inputs=lambda: find_flatfiles(flatfile_folder),
+              outputs=[main_flatcin] + ([main_arrow] if arrow else []) + ([event_store] if event_store else []),
+              params=dict(flatfile_folder=flatfile_folder, output_format=flatfile_format, event_store=event_store,
+                          partitioned=partitioned, arrow=arrow),
+              options=dict(metrics=metrics), after=['main'], modules=['concat.py', 'storage.py', 'schema.py', 'eventstore.py']),
+        Stage('assessment-factors', save_table, inputs=[step3_input, config_file],
+              outputs=[os.path.join(output_folder, 'assessments.csv')],
+              params=dict(builder=assessment_factors, input_file=step3_input,
+                          output_file=os.path.join(output_folder, 'assessments.csv')),
+              options=dict(workers=partition_workers), after=[step3_after], modules=step3_modules),
+        Stage('referral-journeys', save_table, inputs=[step3_input],
+              outputs=[os.path.join(output_folder, 'referral_outcomes.csv')],
+              params=dict(builder=referral_journeys, input_file=step3_input, match_how=match_how,
+                          output_file=os.path.join(output_folder, 'referral_outcomes.csv')),
+              options=dict(workers=partition_workers), after=[step3_after], modules=step3_modules),
+        Stage('s47-journeys', save_table, inputs=[step3_input],
+              outputs=[os.path.join(output_folder, 's47-sankey.csv')],
+              params=dict(builder=s47_sankey, input_file=step3_input, cin_census_close=cin_census_close,
+                          match_how=match_how, counts=sankey_counts, output_file=os.path.join(output_folder, 's47-sankey.csv')),
+              options=dict(workers=partition_workers), after=[step3_after], modules=step3_modules),
+        Stage('cin-episodes', save_table, inputs=[step3_input],
+              outputs=[os.path.join(output_folder, 'cin_episodes.csv')],
+              params=dict(builder=cin_episodes, input_file=step3_input, cin_census_close=cin_census_close,
+                          output_file=os.path.join(output_folder, 'cin_episodes.csv')),
+              options=dict(workers=partition_workers), after=[step3_after], modules=step3_modules + ['episodes.py']),
+        Stage('cpp-episodes', save_table, inputs=[step3_input],
+              outputs=[os.path.join(output_folder, 'cpp_episodes.csv')],
+              params=dict(builder=cpp_episodes, input_file=step3_input, cin_census_close=cin_census_close,
+                          output_file=os.path.join(output_folder, 'cpp_episodes.csv')),
+              options=dict(workers=partition_workers), after=[step3_after], modules=step3_modules + ['episodes.py']),
+    ]
+    if star:
+        stages.append(Stage('star', star_stage, inputs=lambda: find_flatfiles(flatfile_folder) + [config_file],
+                            outputs=[main_star], params=dict(flatfile_folder=flatfile_folder, output_format=flatfile_format,
+                                                             config_file=config_file),
+                            options=dict(metrics=metrics), after=['main'], modules=['star.py', 'storage.py', 'schema.py']))
+    return Pipeline(stages, state_file)
+
+
+def main_stage(input_folder, output_folder, config_file, **kwargs):
+    '''
+    Step 1 for all LAs: LAs whose files did not change are skipped thanks to the extraction cache
+    '''
+    main(input_folder, output_folder, load_config(config_file), process_missing_only=False, **kwargs)
+
+
+def star_stage(flatfile_folder, output_format, config_file, **kwargs):
+    '''
+    The star schema layout of the LA flat files (see star.py)
+    '''
+    write_star(flatfile_folder, output_format, load_config(config_file), **kwargs)
@@ -0,0 +1,132 @@
+'''Data quality report: the values the cleaning step could not read, counted per LA, file, field and value
+
+The cleaners replace a value which is not one of the field's codes (to_category) or not a date (to_date)
+with "Not in proper format: <value>". As each file is cleaned, these values are counted per field and value.
+Only the first MAX_VALUES distinct values of a field get a count of their own, and only the TOP_VALUES most common
+are written in the report: all the others are counted together as other_values, so the counters and the report
+stay small however bad a file is.
+
+main writes each LA's report next to its flat file as <LA>_quality.json, so an LA's data quality can be checked
+without reading its flat file again:
+
+    {"LA": "Hackney", "children": 5230, "bad_values": 14,
+     "fields": {"GenderCurrent": {"count": 12, "values": {"X": 10, "Unknown": 2}, "other_values": 0}, ...},
+     "files": [{"file": "cin_2019.xml", "children": 2610, "bad_values": 6, "fields": {...}}, ...]}
+'''
+import glob
+import json
+import os
+from collections import Counter
+
+import pandas as pd
+
+from wrangling.cincensus.cache import write_atomic
+
+
+NOT_IN_PROPER_FORMAT = 'Not in proper format: '
+# Distinct bad values counted per field, and most common ones written in the report
+MAX_VALUES = 100
+TOP_VALUES = 10
+
+
+class QualityCounter:
+    '''
+    Counts of the bad values found while cleaning one file (or, merged with update, several files)
+    '''
+
+    def __init__(self, max_values=MAX_VALUES):
+        self.max_values = max_values
+        self.children = 0
+        self.fields = {} # field -> Counter of bad values
+        self.other_values = Counter() # field -> bad values beyond max_values distinct ones
+
+    def add(self, field, value, count=1):
+        values = self.fields.setdefault(field, Counter())
+        if value in values or len(values) < self.max_values:
+            values[value] += count
+        else:
+            self.other_values[field] += count
+
+    def add_cleaned(self, element):
+        '''
+        Counts the element if the cleaner marked its value as not in the proper format
+        '''
+        text = element.text
+        if text is not None and text.startswith(NOT_IN_PROPER_FORMAT):
+            field = element.tag.rpartition('}')[2]
+            self.add(field, text[len(NOT_IN_PROPER_FORMAT):])
+
+    def update(self, other):
+        '''
+        Adds the counts of another QualityCounter, e.g. those of each file of an LA
+        '''
+        self.children += other.children
+        for field, values in other.fields.items():
+            for value, count in values.items():
+                self.add(field, value, count)
+        for field, count in other.other_values.items():
+            self.fields.setdefault(field, Counter())
+            self.other_values[field] += count
+
+    @property
+    def bad_values(self):
+        return sum(sum(values.values()) for values in self.fields.values()) + sum(self.other_values.values())
+
+    def to_dict(self, top=TOP_VALUES):
+        '''
+        Compact report: per field, the total count, the top most common bad values, and the count of all the other values
+        '''
+        fields = {}
+        for field in sorted(self.fields):
+            values = self.fields[field]
+            count = sum(values.values()) + self.other_values[field]
+            top_values = dict(values.most_common(top))
+            fields[field] = {'count': count, 'values': top_values, 'other_values': count - sum(top_values.values())}
+        return {'children': self.children, 'bad_values': self.bad_values, 'fields': fields}
+
+
+def la_report(la, files):
+    '''
+    Report of an LA from the QualityCounter of each of its files, given as (file name, QualityCounter)
+    Values are counted as they are in the files: a bad value repeated in several census returns is counted in each
+    '''
+    total = QualityCounter()
+    for _, counter in files:
+        total.update(counter)
+    report = {'LA': la}
+    report.update(total.to_dict())
+    report['files'] = [dict(file=name, **counter.to_dict()) for name, counter in files]
+    return report
+
+
+def quality_path(folder, la):
+    return os.path.join(folder, '{}_quality.json'.format(la))
+
+
+def write_quality(report, folder):
+    path = quality_path(folder, report['LA'])
+    write_atomic(path, json.dumps(report, indent=1).encode('utf-8'))
+    return path
+
+
+def read_quality(folder, las=None):
+    '''
+    Reads the quality reports of a flat file folder (all LAs, or the LAs given) as one table:
+    one row per LA, file, field and bad value, with its count
+    The other_values of each field are in a row with the value "(other)"
+    '''
+    if las is None:
+        paths = sorted(glob.glob(quality_path(folder, '*')))
+    else:
+        paths = [quality_path(folder, la) for la in las]
+    rows = []
+    for path in paths:
+        with open(path) as f:
+            report = json.load(f)
+        for file in report['files']:
+            for field, counts in file['fields'].items():
+                for value, count in counts['values'].items():
+                    rows.append((report['LA'], file['file'], field, value, count))
+                if counts['other_values'] > 0:
+                    rows.append((report['LA'], file['file'], field, '(other)', counts['other_values']))
+    return pd.DataFrame(rows, columns=['LA', 'File', 'Field', 'Value', 'Count'])
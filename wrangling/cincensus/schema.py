@@ -0,0 +1,132 @@
+'''Schema of the flat files: the type of each column, from the config (cin_datamap.yaml)
+
+- date: fields with a date format, and the event Date -> datetimes
+- integer: year of birth and school year (degraded birth date), NumberOfPreviousCPP and FactorsMask -> nullable integers
+- category: fields with a category list, with its codes as categories, and the event Type, LA and Disabilities -> categories
+  Values which are not in the codes are kept, as extra categories after the codes
+- string: everything else, including the IDs (LAchildID, UPN), so that they keep their leading zeros
+
+Readers (storage.read_flatfile) apply the schema as they read, so every load gives the same types whatever the LA
+'''
+import os
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from wrangling.cincensus.config import DEFAULT_CONFIG, load_config
+
+
+DATE, INTEGER, CATEGORY, STRING = 'date', 'integer', 'category', 'string'
+
+# Columns added by the flat file step, which are not fields of the config
+EXTRA_COLUMNS = {'Date': DATE, 'Type': CATEGORY, 'LA': CATEGORY, 'Disabilities': CATEGORY,
+                 'PersonSchoolYear': INTEGER, 'FactorsMask': INTEGER,
+                 # Keys of the star schema layout (see star.py)
+                 'child_key': INTEGER, 'LA_key': INTEGER}
+# Birth date is degraded into year of birth
+INTEGER_FIELDS = ['PersonBirthDate', 'NumberOfPreviousCPP']
+
+
+def flatfile_schema(config=None):
+    '''
+    Returns the schema of the flat files: {column: (type, codes)}, codes being the list of codes of category columns
+    from the config (None for the other columns, and for the categories without a fixed list of codes)
+    Columns which are not in the schema are strings
+    '''
+    if config is None:
+        # The schema of the default config is only built again if the file changed
+        return dict(default_schema(os.path.getmtime(DEFAULT_CONFIG)))
+    schema = {}
+
+    def walk(section):
+        for field, spec in section.items():
+            if not isinstance(spec, dict):
+                continue
+            if 'date' in spec:
+                schema[field] = (DATE, None)
+            elif 'category' in spec:
+                schema[field] = (CATEGORY, [str(item['code']) for item in spec['category']])
+            else:
+                walk(spec)
+    walk(config)
+
+    for column, kind in EXTRA_COLUMNS.items():
+        schema.setdefault(column, (kind, None))
+    for column in INTEGER_FIELDS:
+        schema[column] = (INTEGER, None)
+    return schema
+
+
+@lru_cache(maxsize=1)
+def default_schema(mtime):
+    return flatfile_schema(load_config())
+
+
+def columns_of_type(schema, kind):
+    return [column for column, (column_kind, _) in schema.items() if column_kind == kind]
+
+
+def column_type(schema, column):
+    return schema.get(column, (STRING, None))[0]
+
+
+def csv_dtypes(schema, columns):
+    '''
+    dtype argument of pd.read_csv for these columns: categories are read as categories straight away, everything else
+    as text. Integers are read as text too, and only made numbers by to_typed, so that a value which is not a number
+    (e.g. "two" previous CPPs) becomes empty instead of failing the read
+    '''
+    dtypes = {CATEGORY: 'category'}
+    return {column: dtypes.get(column_type(schema, column), object) for column in columns}
+
+
+def to_typed(df, schema=None, config=None):
+    '''
+    Returns a copy of the flat file with the types of the schema (default: flatfile_schema of the config)
+    Dates and integers that are not in the proper format become empty
+    Whatever the storage format the values come from, dates are datetime64[ns] (those out of its range become empty,
+    as read from csv) and missing text is NaN, as pd.read_csv gives them (parquet and arrow give datetime64[ms] and None)
+    '''
+    if schema is None:
+        schema = flatfile_schema(config)
+    df = df.copy()
+    for column in df.columns:
+        kind, codes = schema.get(column, (STRING, None))
+        values = df[column]
+        if kind == DATE:
+            if not pd.api.types.is_datetime64_any_dtype(values):
+                df[column] = pd.to_datetime(values, format='%Y-%m-%d', errors='coerce')
+            elif values.dtype != 'datetime64[ns]':
+                in_range = (values >= pd.Timestamp.min) & (values <= pd.Timestamp.max)
+                df[column] = values.where(in_range).astype('datetime64[ns]')
+        elif kind == INTEGER:
+            if not pd.api.types.is_numeric_dtype(values):
+                values = pd.to_numeric(values, errors='coerce')
+            if pd.api.types.is_float_dtype(values):
+                # Fractions (e.g. 2.5) are not in the proper format either
+                values = values.where(values % 1 == 0)
+            df[column] = values.astype('Int64')
+        elif kind == CATEGORY:
+            df[column] = to_category(values, codes)
+        else:
+            if values.dtype != object:
+                values = values.astype(object).where(values.isnull(), values.astype(str))
+            df[column] = values.where(values.notnull(), np.nan)
+    return df
+
+
+def to_category(values, codes=None):
+    '''
+    Categories of a column: the codes, in the order of the config, then any other value found, sorted
+    '''
+    if not isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.where(values.isnull(), values.astype(str)).astype('category')
+    elif len(values.cat.categories) > 0 and values.cat.categories.dtype != object:
+        values = values.cat.rename_categories([str(category) for category in values.cat.categories])
+    if codes is None:
+        categories = sorted(values.cat.categories)
+    else:
+        known = set(codes)
+        categories = list(codes) + sorted(category for category in values.cat.categories if category not in known)
+    return values.cat.set_categories(categories)
@@ -0,0 +1,159 @@
+'''Step 1 split over several machines, each running one shard of the LAs, and checked before concat
+
+    machine 1: python -m wrangling.cincensus flatfile <cin_folder> <flatfile_folder> --all --shard 1/3
+    machine 2: python -m wrangling.cincensus flatfile <cin_folder> <flatfile_folder> --all --shard 2/3
+    machine 3: python -m wrangling.cincensus flatfile <cin_folder> <flatfile_folder> --all --shard 3/3
+    then:      python -m wrangling.cincensus merge <flatfile_folder> --cin-folder <cin_folder>
+
+assign_shards splits the LA folders into shards of about the same size (total size of their CIN Census files),
+the same way on every machine: the LAs, largest first, each go to the shard with the smallest total so far.
+Each shard writes its flat files and a manifest (shards/shard-1-of-3.json) to the shared flat file folder.
+check_shards then checks that the manifests are complete and consistent (all the shards, same config and code, every LA
+in exactly one shard, all the flat files there) before concat. The flat file of an LA does not depend on the shard
+that made it, so main_flatcin is the same as from a run on one machine.
+'''
+import glob
+import json
+import os
+
+from wrangling.cincensus.cache import config_hash, file_hash, write_atomic
+from wrangling.cincensus.concat import concat, find_flatfiles
+from wrangling.cincensus.inputs import find_inputs, input_name, input_size, open_input
+from wrangling.cincensus.storage import FORMATS, flatfile_path
+
+
+def parse_shard(shard):
+    '''
+    Shard i of n, from "i/n" (i from 1 to n) or (i, n)
+    '''
+    try:
+        i, n = shard.split('/') if isinstance(shard, str) else shard
+        i, n = int(i), int(n)
+    except (TypeError, ValueError):
+        raise ValueError("Shard must be given as i/n, e.g. 2/4, not {}".format(shard))
+    if not 1 <= i <= n:
+        raise ValueError("Shard {}/{}: i must be between 1 and {}".format(i, n, n))
+    return i, n
+
+
+def la_inputs(input_folder, la):
+    '''
+    The CIN Census files of an LA, as {file name: hash of its decompressed content}, as the keys of the extraction cache
+    so that a file corrected without changing its size (e.g. a fixed date) counts as changed
+    '''
+    return {input_name(file): file_hash(file, open_input) for file in find_inputs(os.path.join(input_folder, la))}
+
+
+def assign_shards(input_folder, shards):
+    '''
+    Splits the LAs of input_folder into shards of about the same size, returns one sorted list of LAs per shard
+    Depends only on the LA folders and the size of their files, so every machine gets the same shards
+    '''
+    sizes = {la: sum(input_size(file) for file in find_inputs(os.path.join(input_folder, la)))
+             for la in sorted(os.listdir(input_folder))}
+    assigned = [[] for _ in range(shards)]
+    totals = [0] * shards
+    # Largest LAs first (then by name), each to the smallest shard so far (then the first one)
+    for la in sorted(sizes, key=lambda la: (-sizes[la], la)):
+        smallest = min(range(shards), key=lambda i: (totals[i], i))
+        assigned[smallest].append(la)
+        totals[smallest] += sizes[la]
+    return [sorted(las) for las in assigned]
+
+
+def manifest_path(output_folder, i, n):
+    return os.path.join(output_folder, 'shards', 'shard-{}-of-{}.json'.format(i, n))
+
+
+def write_manifest(output_folder, input_folder, shard, all_las, las, config, output_format, tiebreak):
+    '''
+    Manifest of a shard: its LAs with the files they were made from, and what the flat files depend on
+    '''
+    i, n = shard
+    manifest = {
+        'shard': i, 'shards': n,
+        'config_hash': config_hash(config), 'output_format': output_format, 'tiebreak': tiebreak,
+        'all_las': list(all_las),
+        'las': {la: la_inputs(input_folder, la) for la in las},
+    }
+    path = manifest_path(output_folder, i, n)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_atomic(path, json.dumps(manifest, indent=1, sort_keys=True).encode('utf-8'))
+    return path
+
+
+def check_shards(flatfile_folder, cin_folder=None, config=None):
+    '''
+    Checks the shard manifests of a flat file folder before concat. Raises a ValueError listing the problems:
+    missing shards, manifests of different runs or configs, LAs missing or in several shards, missing or extra flat files,
+    and with cin_folder, LAs or files which changed since the shards ran. With config, the config and code must be
+    those of this run
+    Returns the manifests, by shard
+    '''
+    paths = sorted(glob.glob(manifest_path(flatfile_folder, '*', '*')))
+    if len(paths) == 0:
+        raise ValueError("No shard manifests in {}".format(os.path.dirname(manifest_path(flatfile_folder, 1, 1))))
+    manifests = []
+    for path in paths:
+        with open(path) as f:
+            manifests.append(json.load(f))
+
+    problems = []
+    first = manifests[0]
+    for key in ['shards', 'config_hash', 'output_format', 'tiebreak', 'all_las']:
+        if any(manifest[key] != first[key] for manifest in manifests):
+            problems.append("The shards do not all have the same {}: manifests of different runs? "
+                            "Remove the old manifests and run the shards again".format(key))
+    if problems:
+        raise ValueError('\n'.join(problems))
+
+    n = first['shards']
+    missing = sorted(set(range(1, n + 1)) - set(manifest['shard'] for manifest in manifests))
+    if missing:
+        problems.append("Missing shards: {} of {}".format(missing, n))
+    if config is not None and first['config_hash'] != config_hash(config):
+        problems.append("The shards ran with another config or code version than this one")
+
+    # Every LA in exactly one shard, with its flat file
+    shard_of = {}
+    for manifest in manifests:
+        for la in manifest['las']:
+            if la in shard_of:
+                problems.append("{} is in shards {} and {}".format(la, shard_of[la], manifest['shard']))
+            shard_of[la] = manifest['shard']
+    if not missing:
+        not_done = [la for la in first['all_las'] if la not in shard_of]
+        if not_done:
+            problems.append("LAs in no shard: {}".format(not_done))
+    no_flatfile = [la for la in shard_of
+                   if not os.path.exists(flatfile_path(flatfile_folder, '{}_flatcin'.format(la), first['output_format']))]
+    if no_flatfile:
+        problems.append("LAs without a flat file: {}".format(no_flatfile))
+    expected = ['{}_flatcin{}'.format(la, FORMATS[first['output_format']]) for la in shard_of]
+    extra = [os.path.basename(file) for file in find_flatfiles(flatfile_folder) if os.path.basename(file) not in expected]
+    if extra:
+        problems.append("Flat files of no shard, which concat would add: {}".format(extra))
+
+    # The inputs are still those the shards ran on
+    if cin_folder is not None:
+        if sorted(os.listdir(cin_folder)) != sorted(first['all_las']):
+            problems.append("The LA folders of {} changed since the shards ran".format(cin_folder))
+        changed = [la for manifest in manifests for la, files in manifest['las'].items()
+                   if os.path.isdir(os.path.join(cin_folder, la)) and la_inputs(cin_folder, la) != files]
+        if changed:
+            problems.append("The files of these LAs changed since the shards ran: {}".format(changed))
+
+    if problems:
+        raise ValueError('\n'.join(problems))
+    return {manifest['shard']: manifest for manifest in manifests}
+
+
+def merge_shards(flatfile_folder, cin_folder=None, config=None, **kwargs):
+    '''
+    Step 2 after a sharded step 1: checks the shards (see check_shards), then concatenates the LA flat files
+    (kwargs are passed to concat). Returns the manifests, by shard
+    '''
+    manifests = check_shards(flatfile_folder, cin_folder, config)
+    print("{} shards complete: {} LAs".format(len(manifests), len(manifests[1]['all_las'])))
+    concat(flatfile_folder, **kwargs)
+    return manifests
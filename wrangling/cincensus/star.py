@@ -0,0 +1,159 @@
+'''Star schema layout of the combined events: an LA dimension, a child dimension and a narrow event fact table
+
+In main_flatcin every event row carries all the identifiers and characteristics of its child, and the step 3 tables
+link the events of a child on two text columns (LAchildID and LA). write_star saves the events as three tables instead,
+in a main_star folder next to main_flatcin:
+- las: one row per LA, with an integer LA_key and the prefix of its child IDs
+- children: one row per child per LA, with an integer child_key, its LA_key, and its identifiers and characteristics
+  (ChildIdentifiers and ChildCharacteristics of the config, PersonSchoolYear), LAchildID prefixed as in main_flatcin
+- events: one row per event, with child_key, LA_key, Date, Type, the columns of the event itself, and the identifiers
+  and characteristics of the child as given in the census return of the event
+A child's identifiers and characteristics can change from one census return to the next: children keeps the latest
+known value of each (from the child's latest event where it is filled), for lookups by child, while events keep the
+value of each event, so that the step 3 tables are the same from main_star as from main_flatcin. Only LAchildID and LA
+are moved out of the events. Type stays a category, dictionary-encoded in parquet (one small integer code per row),
+so read_flatfile can still only read the events of some types.
+
+The step 3 builders also take main_star as input_file: they link the events of each child on child_key, a single
+integer, and only join LAchildID and LA to the rows of their result (see read_events and add_children).
+'''
+import os
+
+import numpy as np
+import pandas as pd
+
+from wrangling.cincensus.concat import find_flatfiles, flatfile_la, la_prefix
+from wrangling.cincensus.config import load_config
+from wrangling.cincensus.metrics import default_metrics
+from wrangling.cincensus.storage import FORMATS, concat_tables, flatfile_path, read_flatfile, write_flatfile
+
+
+CHILD_KEY, LA_KEY = 'child_key', 'LA_key'
+
+
+def child_columns(config=None):
+    '''
+    Columns of the flat files which describe the child rather than the event
+    '''
+    if config is None:
+        config = load_config()
+    return list(config['ChildIdentifiers']) + list(config['ChildCharacteristics']) + ['PersonSchoolYear']
+
+
+def star_table(folder, name):
+    '''
+    Path of a table of a star schema folder, in the format it was saved in (None if it is not there)
+    '''
+    for output_format in FORMATS:
+        path = flatfile_path(folder, name, output_format)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def is_star(input_file):
+    return os.path.isdir(input_file) and star_table(input_file, 'events') is not None
+
+
+def la_star(df, la, la_key, first_child_key, columns):
+    '''
+    Children and events tables of one LA flat file, the child keys of the LA starting at first_child_key
+    Also returns the number of children whose identifiers or characteristics are not the same on all their events
+    '''
+    columns = [col for col in columns if col in df.columns and col != 'LAchildID']
+    df = df.assign(LAchildID=la_prefix(la) + df['LAchildID'].astype(str))
+    # Children in order of ID, so that the keys are the same from one run to the next
+    child = df.groupby('LAchildID', sort=True, dropna=False, observed=True).ngroup().values
+
+    # Latest known value of each column: the last one filled, with the events in order of date
+    order = np.argsort(df['Date'].values, kind='stable')
+    by_child = df[columns].iloc[order].groupby(child[order], sort=True)
+    children = by_child.last()
+    changed = int((by_child.nunique() > 1).any(axis=1).sum()) if len(columns) > 0 else 0
+    ids = df.groupby(child, sort=True)['LAchildID'].first()
+    children.insert(0, 'LAchildID', ids.values)
+    children.insert(0, LA_KEY, la_key)
+    children.insert(0, CHILD_KEY, first_child_key + np.arange(len(children)))
+
+    # The child's columns stay on the events as they were in each census return: only the IDs are replaced by keys,
+    # in their place, so that add_children gives back the columns of main_flatcin in the same order
+    events = df.assign(LAchildID=first_child_key + child, LA=la_key).rename(columns={'LAchildID': CHILD_KEY, 'LA': LA_KEY})
+    return children.reset_index(drop=True), events, changed
+
+
+def write_star(flatfile_folder, output_format='csv', config=None, metrics=None):
+    '''
+    Saves the events of the LA flat files as a star schema (las, children and events tables, see the module docstring)
+    in flatfile_folder/main_star, as csv or parquet (output_format). Returns the folder
+    LAs get their keys in the order of their flat files, and the children of each LA in order of ID
+    '''
+    metrics = default_metrics(metrics)
+    if config is None:
+        config = load_config()
+    columns = child_columns(config)
+    folder = os.path.join(flatfile_folder, 'main_star')
+    os.makedirs(folder, exist_ok=True)
+
+    las, children, events = [], [], []
+    next_child_key = 1
+    target_flatfiles = find_flatfiles(flatfile_folder)
+    print("Processing {} flatfiles".format(len(target_flatfiles)))
+    with metrics.stage('star', files=len(target_flatfiles)) as star_event:
+        for la_key, file in enumerate(target_flatfiles, start=1):
+            la = flatfile_la(file)
+            with metrics.stage('la_star', la=la, file=os.path.basename(file)) as event:
+                df = read_flatfile(file, config=config)
+                la_children, la_events, changed = la_star(df, la, la_key, next_child_key, columns)
+                las.append((la_key, la, la_prefix(la)))
+                children.append(la_children)
+                events.append(la_events)
+                next_child_key += len(la_children)
+                event.update(rows=len(la_events), children=len(la_children), children_changed=changed)
+
+        tables = {
+            'las': pd.DataFrame(las, columns=[LA_KEY, 'LA', 'prefix']),
+            'children': concat_tables(children) if children else pd.DataFrame(columns=[CHILD_KEY, LA_KEY, 'LAchildID']),
+            'events': concat_tables(events) if events else pd.DataFrame(columns=[CHILD_KEY, LA_KEY, 'Date', 'Type']),
+        }
+        for name, table in tables.items():
+            with metrics.stage('write', file=name, rows=len(table), format=output_format):
+                write_flatfile(table, folder, name, output_format, config)
+            # The same table in the other format would be out of date
+            for other in FORMATS:
+                if other != output_format and os.path.exists(flatfile_path(folder, name, other)):
+                    os.remove(flatfile_path(folder, name, other))
+        star_event.update(rows=len(tables['events']), children=len(tables['children']))
+    print("Done!")
+    return folder
+
+
+# --- Reading for the step 3 tables ---
+
+def read_events(input_file, types, config=None):
+    '''
+    Events of these types from main_flatcin (flat file or partition) or main_star, with the columns that identify
+    the child of each event: ['LAchildID', 'LA'] in main_flatcin, [child_key] in main_star
+    '''
+    if is_star(input_file):
+        return read_flatfile(star_table(input_file, 'events'), types=types, config=config), [CHILD_KEY]
+    return read_flatfile(input_file, types=types, config=config), ['LAchildID', 'LA']
+
+
+def add_children(table, input_file, config=None):
+    '''
+    Replaces the keys of a table built from main_star (child_key, LA_key) with the LAchildID and LA of each row's child:
+    the table is then the same as built from main_flatcin, whose rows already have them (returned as it is)
+    '''
+    if not is_star(input_file):
+        return table
+    children = read_flatfile(star_table(input_file, 'children'), columns=[CHILD_KEY, LA_KEY, 'LAchildID'], config=config)
+    las = read_flatfile(star_table(input_file, 'las'), columns=[LA_KEY, 'LA'], config=config)
+    children = children.merge(las, on=LA_KEY, how='left').set_index(CHILD_KEY)
+    table = table.copy()
+    la = table[CHILD_KEY].map(children['LA'])
+    table[CHILD_KEY] = table[CHILD_KEY].map(children['LAchildID'])
+    if LA_KEY in table.columns:
+        table[LA_KEY] = la
+    else:
+        table['LA'] = la
+    return table.rename(columns={CHILD_KEY: 'LAchildID', LA_KEY: 'LA'})
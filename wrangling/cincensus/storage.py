@@ -0,0 +1,312 @@
+import os
+import pandas as pd
+
+from wrangling.cincensus.schema import CATEGORY, DATE, INTEGER, column_type, csv_dtypes, flatfile_schema, to_category, to_typed
+
+
+# Flat file formats and their extension
+FORMATS = {'csv': '.csv', 'parquet': '.parquet'}
+# main_flatcin can also be saved as an Arrow IPC (Feather v2) file, to be memory-mapped by the readers: see read_arrow
+ARROW_EXTENSION = '.arrow'
+
+
+def flatfile_path(folder, name, output_format='csv', partitioned=False):
+    '''
+    Path of a flat file (e.g. name = "Hackney_flatcin") in the given format
+    With partitioned=True, path of the folder of a partitioned flat file (one file per LA: see read_flatfile)
+    '''
+    if output_format not in FORMATS:
+        raise ValueError("Unknown output format {}: use one of {}".format(output_format, list(FORMATS)))
+    if partitioned:
+        return os.path.join(folder, name)
+    return os.path.join(folder, '{}{}'.format(name, FORMATS[output_format]))
+
+
+def arrow_path(folder, name):
+    return os.path.join(folder, '{}{}'.format(name, ARROW_EXTENSION))
+
+
+def partition_files(folder):
+    '''
+    Returns the partitions of a partitioned flat file (e.g. main_flatcin/Hackney.csv), sorted by LA
+    '''
+    names = [name for name in os.listdir(folder) if os.path.splitext(name)[1] in FORMATS.values()
+             and not name.startswith('.')]
+    return [os.path.join(folder, name) for name in sorted(names)]
+
+
+def import_pyarrow():
+    '''
+    pyarrow is only needed for the Parquet and Arrow formats
+    '''
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("The parquet and arrow formats need pyarrow: pip install pyarrow")
+    return pyarrow
+
+
+# --- Column types: see schema.py ---
+
+def arrow_schema(columns, config=None):
+    '''
+    Parquet schema of a flat file with these columns: the types of the flat file schema (see schema.py), whatever the values
+    so that files or chunks with different values can be written to, or read as, one table
+    '''
+    pa = import_pyarrow()
+    schema = flatfile_schema(config)
+    fields = []
+    for col in columns:
+        kind = column_type(schema, col)
+        if kind == DATE:
+            fields.append(pa.field(col, pa.date32()))
+        elif kind == INTEGER:
+            fields.append(pa.field(col, pa.int64()))
+        elif kind == CATEGORY:
+            fields.append(pa.field(col, pa.dictionary(pa.int32(), pa.string())))
+        else:
+            fields.append(pa.field(col, pa.string()))
+    return pa.schema(fields)
+
+
+def to_arrow(df, config=None, schema=None):
+    '''
+    Converts a flat file to an arrow table with the schema given (default: arrow_schema of its columns)
+    '''
+    pa = import_pyarrow()
+    if schema is None:
+        schema = arrow_schema(df.columns, config)
+    df = to_typed(df, config=config)
+    columns = []
+    for field in schema:
+        if field.name in df.columns:
+            values = df[field.name]
+            if pa.types.is_string(field.type):
+                # Text columns may hold numbers (e.g. IDs read from csv) or be empty
+                values = values.astype('string')
+            column = pa.Array.from_pandas(values)
+            columns.append(column.cast(field.type))
+        else:
+            columns.append(pa.nulls(len(df), field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+# --- Write and read ---
+
+def write_flatfile(df, folder, name, output_format='csv', config=None):
+    '''
+    Saves a flat file in the given format, returns its path
+    - csv: as is
+    - parquet: typed (see schema.py), with dates stored as dates and codes dictionary-encoded
+    '''
+    path = flatfile_path(folder, name, output_format)
+    # Written to a temporary file first, so that an interrupted run never leaves half a flat file behind
+    tmp = '{}.tmp'.format(path)
+    if output_format == 'csv':
+        df.to_csv(tmp, index=False)
+    else:
+        pa = import_pyarrow()
+        pa.parquet.write_table(to_arrow(df, config), tmp)
+    os.replace(tmp, path)
+    return path
+
+
+class FlatfileWriter:
+    '''
+    Writes a flat file chunk by chunk, with a fixed list of columns (missing columns are left empty)
+    '''
+
+    def __init__(self, folder, name, columns, output_format='csv', config=None):
+        self.path = flatfile_path(folder, name, output_format)
+        self.columns = list(columns)
+        self.output_format = output_format
+        self.config = config
+        if output_format == 'csv':
+            pd.DataFrame(columns=self.columns).to_csv(self.path, index=False)
+        else:
+            pa = import_pyarrow()
+            self.schema = arrow_schema(self.columns, config)
+            self.writer = pa.parquet.ParquetWriter(self.path, self.schema)
+
+    def write(self, df):
+        if self.output_format == 'csv':
+            df.reindex(columns=self.columns).to_csv(self.path, mode='a', header=False, index=False)
+        else:
+            self.writer.write_table(to_arrow(df, self.config, self.schema))
+
+    def close(self):
+        if self.output_format != 'csv':
+            self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_columns(path):
+    '''
+    Returns the columns of a flat file, from its header or schema only
+    '''
+    if path.endswith(FORMATS['parquet']):
+        pa = import_pyarrow()
+        return pa.parquet.read_schema(path).names
+    if path.endswith(ARROW_EXTENSION):
+        return open_arrow(path).column_names
+    return list(pd.read_csv(path, nrows=0).columns)
+
+
+def iter_flatfile(path, chunksize=100000):
+    '''
+    Reads a flat file in chunks of chunksize rows
+    csv values are kept as text, as they were written
+    '''
+    if path.endswith(FORMATS['parquet']):
+        pa = import_pyarrow()
+        for batch in pa.parquet.ParquetFile(path).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas(date_as_object=False)
+    else:
+        for chunk in pd.read_csv(path, dtype=str, chunksize=chunksize):
+            yield chunk
+
+
+def read_flatfile(path, columns=None, types=None, typed=True, config=None, **kwargs):
+    '''
+    Reads a flat file (csv, parquet or arrow), or a partitioned flat file (folder of one flat file per LA) as one table,
+    only keeping:
+    - columns: the columns needed (default: all)
+    - types: the events needed, i.e. the values of Type (default: all)
+    With parquet, only those columns and the row groups with those types are read (predicate pushdown)
+    The columns get the types of the flat file schema (see schema.py), or are all kept as text with typed=False (csv only)
+    Extra arguments are passed on to pd.read_csv
+    '''
+    schema = flatfile_schema(config)
+    if os.path.isdir(path):
+        return read_partitions(path, columns, types, typed, config, **kwargs)
+    if path.endswith(ARROW_EXTENSION):
+        return read_arrow(path, columns, types, config)
+    if path.endswith(FORMATS['parquet']):
+        pa = import_pyarrow()
+        filters = None if types is None else [('Type', 'in', list(types))]
+        table = pa.parquet.read_table(path, columns=columns, filters=filters)
+        return to_typed(table.to_pandas(date_as_object=False), schema)
+
+    usecols = None
+    if columns is not None:
+        usecols = list(columns) + (['Type'] if types is not None and 'Type' not in columns else [])
+    dtype = csv_dtypes(schema, usecols or read_columns(path)) if typed else str
+    df = pd.read_csv(path, usecols=usecols, dtype=dtype, **kwargs)
+    if types is not None:
+        df = df[df['Type'].isin(types)]
+    if columns is not None:
+        df = df[list(columns)]
+    return to_typed(df, schema) if typed else df
+
+
+# --- Arrow IPC files, memory-mapped ---
+
+def write_arrow(tables, folder, name, schema):
+    '''
+    Saves arrow tables with the same schema (see to_arrow) as one Arrow IPC file (Feather v2), returns its path
+    The file is not compressed, so that readers can memory-map it (see open_arrow), and the dictionaries of the category
+    columns are unified across the tables
+    '''
+    pa = import_pyarrow()
+    path = arrow_path(folder, name)
+    table = pa.concat_tables(tables) if tables else schema.empty_table()
+    tmp = '{}.tmp'.format(path)
+    with pa.ipc.new_file(tmp, schema, options=pa.ipc.IpcWriteOptions(unify_dictionaries=True)) as writer:
+        writer.write_table(table)
+    os.replace(tmp, path)
+    return path
+
+
+def open_arrow(path):
+    '''
+    Memory-maps an Arrow IPC file as an arrow table, without reading it: the columns point into the file, and are only
+    read from disk as they are used. Every process opening the same file shares the same pages of the OS page cache
+    '''
+    pa = import_pyarrow()
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def read_arrow(path, columns=None, types=None, config=None):
+    '''
+    Reads an Arrow IPC file (see open_arrow) as a typed DataFrame, only converting the columns and events needed
+    (see read_flatfile): the other columns are never read from disk nor copied
+    '''
+    pa = import_pyarrow()
+    table = open_arrow(path)
+    rows = None
+    if types is not None:
+        # Only the Type column is decoded to find the rows
+        rows = pa.compute.is_in(table.column('Type').cast(pa.string()), value_set=pa.array(list(types), pa.string()))
+    if columns is not None:
+        table = table.select([col for col in columns if col in table.column_names])
+    if rows is not None:
+        table = table.filter(rows)
+    df = table.to_pandas(date_as_object=False)
+    if columns is not None:
+        df = df.reindex(columns=list(columns))
+    return to_typed(df, config=config)
+
+
+def read_partitions(folder, columns, types, typed, config, **kwargs):
+    '''
+    Reads the partitions of a partitioned flat file as one table, with the union of their columns (see concat_tables)
+    The partitions are read one by one with the same filters
+    '''
+    parts = []
+    for file in partition_files(folder):
+        part_columns = None if columns is None else [col for col in columns if col in read_columns(file)]
+        parts.append(read_flatfile(file, part_columns, types, typed, config, **kwargs))
+    if len(parts) == 0:
+        return pd.DataFrame(columns=columns)
+    df = concat_tables(parts)
+    if columns is not None:
+        df = df.reindex(columns=list(columns))
+    return to_typed(df, config=config) if typed else df
+
+
+def concat_tables(tables):
+    '''
+    Puts together tables made from different partitions (e.g. the partitions of a flat file, or the tables built from them)
+    - Their categories are merged first, so that codes stay categories, in the order of the schema (see schema.to_category)
+    - The columns are the union of their columns, in the order they have in the tables (see merge_columns)
+    '''
+    schema = flatfile_schema()
+    tables = [table.copy() for table in tables]
+    for col in set(col for table in tables for col in table.columns):
+        values = [table[col] for table in tables if col in table.columns]
+        if all(isinstance(value.dtype, pd.CategoricalDtype) for value in values):
+            union = pd.api.types.union_categoricals(values, ignore_order=True).categories
+            categories = to_category(pd.Series(union, dtype='category'), schema.get(col, (None, None))[1]).cat.categories
+            for table in tables:
+                if col in table.columns:
+                    table[col] = table[col].cat.set_categories(categories)
+    columns = merge_columns([list(table.columns) for table in tables])
+    return pd.concat(tables, ignore_index=True).reindex(columns=columns)
+
+
+def merge_columns(column_lists):
+    '''
+    Merges lists of columns into one list which keeps the order of every list where they agree
+    The next column is the first column of a list which does not come later in any other list
+    (the first list wins when several columns could come next)
+    '''
+    lists = [list(columns) for columns in column_lists if len(columns) > 0]
+    merged = []
+    while lists:
+        later = set(col for columns in lists for col in columns[1:])
+        candidates = [columns[0] for columns in lists if columns[0] not in later]
+        # Lists in contradicting orders: take the first list's column
+        col = candidates[0] if candidates else lists[0][0]
+        merged.append(col)
+        lists = [[c for c in columns if c != col] for columns in lists]
+        lists = [columns for columns in lists if len(columns) > 0]
+    return merged
@@ -0,0 +1,342 @@
+'''Synthetic CIN Census files, to test and benchmark the pipeline without real (sensitive) data
+
+    python -m wrangling.cincensus synthetic <cin_folder> --las 3 --files 3 --children 1000 --events 3 --seed 1
+
+Writes one folder per LA with one CIN Census XML file per year, in the same layout as the real cin_folder.
+Children are followed from one year to the next, so the events of open cases appear again in the next year's file
+(duplicates across years). Each file also has the messy values the cleaners deal with, at the rate given by messy:
+empty tags, dates with '/', codes in the wrong case or given by name, several factors on one AssessmentFactors line.
+A few values, at the rate given by invalid, cannot be cleaned at all: impossible dates (2019-13-40), unknown codes and
+numbers in words, which end up marked "Not in proper format" in the flat files and counted in the quality report
+'''
+import datetime
+import os
+import random
+
+from lxml import etree
+
+from wrangling.cincensus.config import load_config
+
+
+def write_cincensus(cin_folder, las=3, files=3, children=1000, events=3, messy=0.05, invalid=0.005, seed=1,
+                    first_year=2018, namespace=None, config=None):
+    '''
+    Writes the synthetic CIN Census files and returns their paths
+    - las: number of LAs (folders Aaaton, Aabton...: the first 3 letters are different, as concat uses them as prefix)
+    - files: number of files per LA, one per census year from first_year
+    - children: number of children per file
+    - events: average number of assessments, S47 and CPP per referral
+    - messy: share of values written in a messy way, or left empty
+    - invalid: share of values which are not valid at all (dates, codes and NumberOfPreviousCPP)
+    - namespace: namespace of the XML files (default: none)
+    '''
+    if config is None:
+        config = load_config()
+    codes = category_codes(config)
+    paths = []
+    for la in range(las):
+        la_folder = os.path.join(cin_folder, la_name(la))
+        os.makedirs(la_folder, exist_ok=True)
+        generator = CINGenerator(codes, events, messy, random.Random('{}-{}'.format(seed, la)), invalid)
+        # Children of the LA, followed across the years: about a third are new each year
+        population = [generator.new_child(first_year - 1) for _ in range(children)]
+        for year in range(first_year, first_year + files):
+            if year > first_year:
+                kept = generator.random.sample(population, children - children // 3)
+                population = kept + [generator.new_child(year - 1) for _ in range(children // 3)]
+            path = os.path.join(la_folder, 'cin_{}.xml'.format(year))
+            generator.write_file(path, population, year, namespace)
+            paths.append(path)
+    return paths
+
+
+def la_name(i):
+    '''
+    Name of the i-th LA, with different first 3 letters for each LA
+    '''
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return 'A{}{}ton'.format(letters[i // 26 % 26], letters[i % 26]).capitalize()
+
+
+def category_codes(config):
+    '''
+    Returns field -> list of (code, name) of the category fields of the config (cin_datamap.yaml)
+    '''
+    codes = {}
+
+    def walk(section):
+        for field, spec in section.items():
+            if not isinstance(spec, dict):
+                continue
+            if 'category' in spec:
+                codes[field] = [(str(item['code']), str(item.get('name', item['code']))) for item in spec['category']]
+            else:
+                walk(spec)
+    walk(config)
+    return codes
+
+
+class CINGenerator:
+    '''
+    Generates children, their CIN events, and writes them as CIN Census XML
+    All the randomness comes from the random.Random given, so the same seed always gives the same files
+    '''
+
+    def __init__(self, codes, events, messy, random, invalid=0):
+        self.codes = codes
+        self.events = events
+        self.messy = messy
+        self.invalid = invalid
+        self.random = random
+        self.next_id = 0
+
+    # Children and their events
+
+    def new_child(self, year):
+        '''
+        A child with an id, characteristics and the referrals starting in the census year ending on 31 March of year + 1
+        '''
+        r = self.random
+        self.next_id += 1
+        birth = self.date(year - 17, year)
+        child = {
+            'LAchildID': 'C{:07d}'.format(self.next_id),
+            'UPN': '{}{:010d}'.format(r.choice('ABCDEFGHJK'), r.randrange(10 ** 10)) if r.random() < 0.8 else None,
+            'UPNunknown': None,
+            'PersonBirthDate': birth,
+            'GenderCurrent': self.code('GenderCurrent'),
+            'Ethnicity': self.code('Ethnicity'),
+            'Disabilities': [self.code('Disability') for _ in range(r.choice([1, 1, 1, 2, 3]))],
+            'CINdetails': [],
+        }
+        if child['UPN'] is None:
+            child['UPNunknown'] = self.code('UPNunknown')
+        for _ in range(r.choice([1, 1, 1, 2])):
+            child['CINdetails'].append(self.referral(datetime.date(year, 4, 1), birth))
+        return child
+
+    def referral(self, start, birth):
+        '''
+        A referral in the year from start, with its assessments, S47 and CPP in the following weeks
+        '''
+        r = self.random
+        referral_date = max(start + datetime.timedelta(days=r.randrange(365)), birth)
+        details = {
+            'CINreferralDate': referral_date,
+            'ReferralSource': self.code('ReferralSource'),
+            'PrimaryNeedCode': self.code('PrimaryNeedCode'),
+            'ReferralNFA': '0',
+            'CINclosureDate': None,
+            'ReasonForClosure': None,
+            'DateOfInitialCPC': None,
+            'Assessments': [],
+            'Section47': [],
+            'ChildProtectionPlans': [],
+        }
+        modules = r.randint(0, 2 * self.events - 1) if self.events > 0 else 0
+        if modules == 0:
+            details['ReferralNFA'] = '1'
+        last = referral_date
+        for _ in range(modules):
+            kind = r.choices(['Assessments', 'Section47', 'ChildProtectionPlans'], weights=[6, 3, 1])[0]
+            event_date = referral_date + datetime.timedelta(days=r.randrange(0, 45))
+            if kind == 'Assessments':
+                factors = r.sample([code for code, _ in self.codes['AssessmentFactors']], r.choice([0, 1, 2, 3, 4]))
+                module = {
+                    'AssessmentActualStartDate': event_date,
+                    'AssessmentInternalReviewDate': None,
+                    'AssessmentAuthorisationDate': event_date + datetime.timedelta(days=r.randrange(1, 45)),
+                    'AssessmentFactors': factors,
+                }
+                last = max(last, module['AssessmentAuthorisationDate'])
+            elif kind == 'Section47':
+                icpc = event_date + datetime.timedelta(days=r.randrange(5, 30)) if r.random() < 0.5 else None
+                module = {
+                    'S47ActualStartDate': event_date,
+                    'InitialCPCtarget': event_date + datetime.timedelta(days=15),
+                    'DateOfInitialCPC': icpc,
+                    'ICPCnotRequired': '0' if icpc is not None else self.code('ICPCnotRequired'),
+                }
+                if icpc is not None:
+                    details['DateOfInitialCPC'] = icpc
+                    last = max(last, icpc)
+            else:
+                cpp_start = event_date + datetime.timedelta(days=r.randrange(10, 60))
+                cpp_end = cpp_start + datetime.timedelta(days=r.randrange(90, 600)) if r.random() < 0.7 else None
+                module = {
+                    'CPPstartDate': cpp_start,
+                    'CPPendDate': cpp_end,
+                    'InitialCategoryOfAbuse': self.code('InitialCategoryOfAbuse'),
+                    'LatestCategoryOfAbuse': self.code('LatestCategoryOfAbuse'),
+                    'NumberOfPreviousCPP': str(r.choice([0, 0, 0, 1, 2])),
+                    'CPPreviewDate': [cpp_start + datetime.timedelta(days=90 * (i + 1)) for i in range(r.randint(0, 3))],
+                }
+                last = max(last, cpp_end or cpp_start)
+            details[kind].append(module)
+        if r.random() < 0.6:
+            details['CINclosureDate'] = last + datetime.timedelta(days=r.randrange(1, 120))
+            details['ReasonForClosure'] = self.code('ReasonForClosure')
+        return details
+
+    def code(self, field):
+        return self.random.choice(self.codes[field])[0]
+
+    def date(self, first_year, last_year):
+        first = datetime.date(first_year, 1, 1)
+        return first + datetime.timedelta(days=self.random.randrange((datetime.date(last_year, 12, 31) - first).days))
+
+    # Writing
+
+    def write_file(self, path, population, year, namespace=None):
+        '''
+        Writes the census return of the year: the children with their referrals open during the year to 31 March
+        Children without an open referral, and a few others, are referred again during the year
+        '''
+        reference_date = datetime.date(year, 3, 31)
+        start = datetime.date(year - 1, 4, 1)
+        ns = '{{{}}}'.format(namespace) if namespace else ''
+        with etree.xmlfile(path, encoding='utf-8') as xf:
+            xf.write_declaration()
+            with xf.element(ns + 'Message', nsmap={None: namespace} if namespace else None):
+                xf.write(self.header(ns, year, reference_date))
+                with xf.element(ns + 'Children'):
+                    for child in population:
+                        # Referrals open during the year: referred before the reference date, and not closed before the year
+                        referrals = [details for details in child['CINdetails']
+                                     if details['CINreferralDate'] <= reference_date
+                                     and (details['CINclosureDate'] is None or details['CINclosureDate'] >= start)]
+                        if len(referrals) == 0 or self.random.random() < 0.1:
+                            referrals.append(self.referral(start, child['PersonBirthDate']))
+                            child['CINdetails'].append(referrals[-1])
+                        xf.write(self.child(ns, child, referrals, reference_date))
+
+    def header(self, ns, year, reference_date):
+        header = etree.Element(ns + 'Header')
+        collection = etree.SubElement(header, ns + 'CollectionDetails')
+        self.add(collection, ns + 'Collection', 'CIN', clean=True)
+        self.add(collection, ns + 'Year', str(year), clean=True)
+        self.add(collection, ns + 'ReferenceDate', reference_date, clean=True)
+        return header
+
+    def child(self, ns, child, referrals, reference_date):
+        '''
+        Child element, with the referrals given
+        '''
+        element = etree.Element(ns + 'Child')
+        identifiers = etree.SubElement(element, ns + 'ChildIdentifiers')
+        self.add(identifiers, ns + 'LAchildID', child['LAchildID'], clean=True)
+        self.add(identifiers, ns + 'UPN', child['UPN'])
+        self.add(identifiers, ns + 'UPNunknown', child['UPNunknown'], field='UPNunknown')
+        # Birth dates are degraded before cleaning, and the degrade step expects a date
+        self.add(identifiers, ns + 'PersonBirthDate', self.messy_date(child['PersonBirthDate']), clean=True)
+        self.add(identifiers, ns + 'GenderCurrent', child['GenderCurrent'], field='GenderCurrent')
+        characteristics = etree.SubElement(element, ns + 'ChildCharacteristics')
+        self.add(characteristics, ns + 'Ethnicity', child['Ethnicity'], field='Ethnicity')
+        disabilities = etree.SubElement(characteristics, ns + 'Disabilities')
+        for disability in child['Disabilities']:
+            self.add(disabilities, ns + 'Disability', disability, field='Disability')
+        for details in referrals:
+            element.append(self.cindetails(ns, details, reference_date))
+        return element
+
+    def cindetails(self, ns, details, reference_date):
+        '''
+        CINdetails element, with the events up to the reference date only
+        '''
+        def known(date):
+            return date if date is not None and date <= reference_date else None
+
+        element = etree.Element(ns + 'CINdetails')
+        self.add(element, ns + 'CINreferralDate', details['CINreferralDate'])
+        self.add(element, ns + 'ReferralSource', details['ReferralSource'], field='ReferralSource')
+        self.add(element, ns + 'PrimaryNeedCode', details['PrimaryNeedCode'], field='PrimaryNeedCode')
+        closed = known(details['CINclosureDate'])
+        self.add(element, ns + 'CINclosureDate', closed)
+        self.add(element, ns + 'ReasonForClosure', details['ReasonForClosure'] if closed else None, field='ReasonForClosure')
+        self.add(element, ns + 'DateOfInitialCPC', known(details['DateOfInitialCPC']))
+        self.add(element, ns + 'ReferralNFA', details['ReferralNFA'], field='ReferralNFA')
+        for module in details['Assessments']:
+            if known(module['AssessmentActualStartDate']) is None:
+                continue
+            assessment = etree.SubElement(element, ns + 'Assessments')
+            self.add(assessment, ns + 'AssessmentActualStartDate', module['AssessmentActualStartDate'])
+            self.add(assessment, ns + 'AssessmentInternalReviewDate', module['AssessmentInternalReviewDate'])
+            authorised = known(module['AssessmentAuthorisationDate'])
+            self.add(assessment, ns + 'AssessmentAuthorisationDate', authorised)
+            if authorised is not None:
+                factors = etree.SubElement(assessment, ns + 'FactorsIdentifiedAtAssessment')
+                for line in self.factor_lines(module['AssessmentFactors']):
+                    self.add(factors, ns + 'AssessmentFactors', line, clean=True)
+        for module in details['Section47']:
+            if known(module['S47ActualStartDate']) is None:
+                continue
+            s47 = etree.SubElement(element, ns + 'Section47')
+            self.add(s47, ns + 'S47ActualStartDate', module['S47ActualStartDate'])
+            self.add(s47, ns + 'InitialCPCtarget', module['InitialCPCtarget'])
+            self.add(s47, ns + 'DateOfInitialCPC', known(module['DateOfInitialCPC']))
+            self.add(s47, ns + 'ICPCnotRequired', module['ICPCnotRequired'], field='ICPCnotRequired')
+        for module in details['ChildProtectionPlans']:
+            if known(module['CPPstartDate']) is None:
+                continue
+            cpp = etree.SubElement(element, ns + 'ChildProtectionPlans')
+            self.add(cpp, ns + 'CPPstartDate', module['CPPstartDate'])
+            self.add(cpp, ns + 'CPPendDate', known(module['CPPendDate']))
+            self.add(cpp, ns + 'InitialCategoryOfAbuse', module['InitialCategoryOfAbuse'], field='InitialCategoryOfAbuse')
+            self.add(cpp, ns + 'LatestCategoryOfAbuse', module['LatestCategoryOfAbuse'], field='LatestCategoryOfAbuse')
+            self.add(cpp, ns + 'NumberOfPreviousCPP', module['NumberOfPreviousCPP'], field='NumberOfPreviousCPP')
+            reviews = etree.SubElement(cpp, ns + 'Reviews')
+            for review in module['CPPreviewDate']:
+                if known(review) is not None:
+                    self.add(reviews, ns + 'CPPreviewDate', review)
+        return element
+
+    def factor_lines(self, factors):
+        '''
+        Factors usually have one AssessmentFactors tag each, but some files put several on one line
+        '''
+        if len(factors) > 1 and self.random.random() < self.messy * 4:
+            separator = self.random.choice([',', ', ', ' '])
+            return [separator.join(factors)]
+        return factors
+
+    def messy_date(self, date):
+        '''
+        Date as text, sometimes with '/' instead of '-'
+        '''
+        if self.random.random() < self.messy:
+            return date.isoformat().replace('-', '/')
+        return date.isoformat()
+
+    def invalid_value(self, value, field=None):
+        '''
+        A value the cleaners cannot make valid: an impossible date, an unknown code, or a number in words
+        '''
+        if isinstance(value, datetime.date):
+            return '{}-13-40'.format(value.year)
+        if field in self.codes:
+            return 'XX'
+        return self.random.choice(['two', 'unknown'])
+
+    def add(self, parent, tag, value, field=None, clean=False):
+        '''
+        Adds a sub element, unless value is None. Unless clean, the value is sometimes written in a messy way:
+        empty tag, date with '/', padded with spaces, code in lower case or given by its name.
+        Dates, and the values of fields given, are also sometimes invalid (see invalid_value)
+        '''
+        if value is None:
+            return
+        r = self.random
+        if not clean and (field is not None or isinstance(value, datetime.date)) and r.random() < self.invalid:
+            value = self.invalid_value(value, field)
+        elif isinstance(value, datetime.date):
+            value = value.isoformat() if clean else self.messy_date(value)
+        if not clean and r.random() < self.messy:
+            value = r.choice([
+                '',
+                ' {} '.format(value),
+                value.lower(),
+                dict(self.codes.get(field, [])).get(value, value),
+            ])
+        sub = etree.SubElement(parent, tag)
+        if value != '':
+            sub.text = value
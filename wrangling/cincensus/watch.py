@@ -0,0 +1,197 @@
+'''Ingestion service: watches the LA folders of the CIN Census and keeps the flat files and main_flatcin up to date
+
+    python -m wrangling.cincensus watch <cin_folder> <flatfile_folder> --cache-folder <cache_folder> --partitioned
+
+Every poll_interval seconds the LA folders are scanned (name, size and modification time of their CIN Census files):
+- An LA whose files changed since it was last processed is queued once its files have settled: unchanged since the
+  previous scan and not modified for settle seconds. A file written several times, or copied slowly, is processed once
+- Queued LAs go through step 1 (main, for that LA only), at most workers LAs at once. With the extraction cache,
+  only the new or changed files of the LA are extracted again
+- Once no LA is queued or being processed, step 2 (concat) updates main_flatcin. Partitioned, only the LAs which changed
+  are written again
+The files each LA was last processed from, and whether concat is due, are saved in <flatfile_folder>/ingest_state.json,
+always after the outputs themselves (which are written atomically). After a crash the service starts again from there:
+an LA interrupted mid-file is processed again, and a concat which did not finish is run again.
+LA folders which are removed are left as they are: their flat files are kept.
+'''
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from wrangling.cincensus.cache import write_atomic
+from wrangling.cincensus.concat import concat
+from wrangling.cincensus.inputs import INPUT_EXTENSIONS
+from wrangling.cincensus.main import main
+
+
+def scan_la(folder):
+    '''
+    The files of an LA folder which may hold CIN Census data, as {name: [size, modification time in ns]}
+    Other files, e.g. uploads in progress (.part, .tmp) or hidden files, are ignored
+    '''
+    files = {}
+    for entry in os.scandir(folder):
+        if entry.is_file() and not entry.name.startswith('.') and entry.name.lower().endswith(INPUT_EXTENSIONS):
+            stat = entry.stat()
+            files[entry.name] = [stat.st_size, stat.st_mtime_ns]
+    return files
+
+
+def ingest_la(input_folder, output_folder, config, la, **kwargs):
+    '''
+    Step 1 for one LA
+    '''
+    main(input_folder, output_folder, config, process_missing_only=False, las=[la], **kwargs)
+
+
+class IngestService:
+    '''
+    Polls cin_folder and processes the LAs with new or changed files into flatfile_folder (see the module docstring)
+    - workers: number of LAs processed at once, in worker processes (default: 1, one LA at a time in this process)
+    - poll_interval: seconds between scans of the LA folders
+    - settle: seconds a file must be left unchanged before it is processed
+    cache_folder, output_format and tiebreak are passed to main, partitioned and event_store to concat,
+    metrics to both (except to main with workers > 1)
+    '''
+
+    def __init__(self, cin_folder, flatfile_folder, config, cache_folder=None, output_format='csv', tiebreak='first',
+                 partitioned=False, event_store=None, workers=1, poll_interval=30, settle=60, metrics=None):
+        self.cin_folder = cin_folder
+        self.flatfile_folder = flatfile_folder
+        self.config = config
+        self.main_options = dict(cache_folder=cache_folder, output_format=output_format, tiebreak=tiebreak)
+        self.concat_options = dict(output_format=output_format, partitioned=partitioned, event_store=event_store)
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.settle = settle
+        self.metrics = metrics
+        self.state_file = os.path.join(flatfile_folder, 'ingest_state.json')
+        self.state = self.load_state()
+        self.seen = {} # LA -> files at the last scan
+        self.failed = {} # LA -> files which failed, only tried again once they change
+        self.queue = []
+        self.running = {} # future -> (LA, files)
+        self.pool = None
+
+    def load_state(self):
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'las': {}, 'concat_due': False}
+
+    def save_state(self):
+        write_atomic(self.state_file, json.dumps(self.state, indent=1, sort_keys=True).encode('utf-8'))
+
+    def scan(self, now=None):
+        '''
+        Scans the LA folders, queues the LAs whose files changed and have settled. Returns the LAs queued
+        '''
+        now = time.time() if now is None else now
+        busy = set(self.queue) | set(la for la, _ in self.running.values())
+        queued = []
+        for la in sorted(os.listdir(self.cin_folder)):
+            folder = os.path.join(self.cin_folder, la)
+            if not os.path.isdir(folder):
+                continue
+            files = scan_la(folder)
+            previous = self.seen.get(la)
+            self.seen[la] = files
+            if (len(files) == 0 or la in busy or files == self.state['las'].get(la) or files == self.failed.get(la)):
+                continue
+            # Still being written: wait for the files to settle
+            newest = max(mtime for _, mtime in files.values()) / 1e9
+            if (previous is None or files == previous) and now - newest >= self.settle:
+                queued.append(la)
+        self.queue += queued
+        return queued
+
+    def start(self):
+        '''
+        Starts processing queued LAs, up to workers at once
+        '''
+        while self.queue and len(self.running) < max(self.workers, 1):
+            la = self.queue.pop(0)
+            files = self.seen[la]
+            print("Ingesting {}: {} files".format(la, len(files)))
+            if self.workers <= 1:
+                self.finish(la, files, lambda: ingest_la(self.cin_folder, self.flatfile_folder, self.config, la,
+                                                         metrics=self.metrics, **self.main_options))
+                continue
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=self.workers)
+            future = self.pool.submit(ingest_la, self.cin_folder, self.flatfile_folder, self.config, la, **self.main_options)
+            self.running[future] = (la, files)
+
+    def finish(self, la, files, result):
+        try:
+            result()
+        except Exception as error:
+            print("Ingesting {}: failed ({!r}), will try again when its files change".format(la, error))
+            self.failed[la] = files
+            return
+        # The lag from the last file landing to the LA's flat file
+        lag = time.time() - max(mtime for _, mtime in files.values()) / 1e9
+        print("Ingesting {}: done, {:.0f}s after its last file changed".format(la, lag))
+        self.failed.pop(la, None)
+        self.state['las'][la] = files
+        self.state['concat_due'] = True
+        self.save_state()
+
+    def collect(self, timeout):
+        '''
+        Waits up to timeout seconds for LAs being processed, and records those finished
+        '''
+        finished, _ = wait(self.running, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in finished:
+            la, files = self.running.pop(future)
+            self.finish(la, files, future.result)
+
+    def update_main_flatcin(self):
+        '''
+        Runs concat once no LA is queued or being processed, if an LA was processed since the last concat
+        '''
+        if not self.state['concat_due'] or self.queue or self.running:
+            return
+        try:
+            concat(self.flatfile_folder, metrics=self.metrics, **self.concat_options)
+        except Exception as error:
+            print("Updating main_flatcin: failed ({!r}), will try again".format(error))
+            return
+        self.state['concat_due'] = False
+        self.save_state()
+
+    def poll(self):
+        '''
+        One round: scan, process what is queued (or start it, with workers), and update main_flatcin if due
+        '''
+        self.scan()
+        self.start()
+        self.update_main_flatcin()
+
+    def run(self, polls=None):
+        '''
+        Polls until interrupted (Ctrl+C), or for the number of polls given, then waits for the LAs being processed
+        '''
+        print("Watching {} every {}s".format(self.cin_folder, self.poll_interval))
+        try:
+            done = 0
+            while polls is None or done < polls:
+                self.poll()
+                done += 1
+                if polls is not None and done >= polls:
+                    break
+                if self.running:
+                    self.collect(self.poll_interval)
+                else:
+                    time.sleep(self.poll_interval)
+            while self.running:
+                self.collect(None)
+                self.start()
+            self.update_main_flatcin()
+        except KeyboardInterrupt:
+            print("Stopped: LAs being processed will be processed again on the next start")
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown(cancel_futures=True)